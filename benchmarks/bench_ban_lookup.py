@@ -0,0 +1,57 @@
+"""对比封禁查询：每次 connect 的旧实现 vs 内存 BanIndex。
+
+用法：python benchmarks/bench_ban_lookup.py [封禁条数] [查询次数]
+"""
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import bot  # noqa: E402
+
+
+def legacy_is_banned(db_path: str, user_id: int) -> bool:
+    conn = sqlite3.connect(db_path)
+    c = conn.cursor()
+    c.execute("SELECT 1 FROM banned WHERE user_id=? LIMIT 1", (user_id,))
+    r = c.fetchone()
+    conn.close()
+    return r is not None
+
+
+def run(n_banned: int, n_lookups: int):
+    with tempfile.TemporaryDirectory() as tmp:
+        db = bot.Database(os.path.join(tmp, "bench.db"))
+        t = bot.Tenant(db, "", [])
+        t.init_db()
+        conn = db.get()
+        conn.executemany("INSERT INTO banned(user_id) VALUES (?)", ((i * 2,) for i in range(n_banned)))
+        conn.commit()
+        t.banned_index.load(t.state_store.backend)
+
+        ids = [i % (n_banned * 2) for i in range(n_lookups)]
+
+        t0 = time.perf_counter()
+        for uid in ids:
+            legacy_is_banned(db.path, uid)
+        legacy = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        for uid in ids:
+            t.is_banned(uid)
+        indexed = time.perf_counter() - t0
+
+        db.close()
+
+    print(f"banned={n_banned} lookups={n_lookups}")
+    print(f"connect-per-lookup: {n_lookups / legacy:>14,.0f} lookups/s")
+    print(f"BanIndex:           {n_lookups / indexed:>14,.0f} lookups/s")
+    print(f"speedup:            {legacy / indexed:>14,.0f}x")
+
+
+if __name__ == "__main__":
+    n_banned = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000
+    n_lookups = int(sys.argv[2]) if len(sys.argv) > 2 else 20_000
+    run(n_banned, n_lookups)
@@ -0,0 +1,61 @@
+"""对比批量封禁：逐个 Tenant.ban_user（每个 id 一次提交）vs Tenant.ban_users（一次 executemany），
+以及从文件流式导入和导出封禁列表。
+
+用法：python benchmarks/bench_bulk_bans.py [id 个数]
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import bot  # noqa: E402
+
+
+def run(n: int):
+    with tempfile.TemporaryDirectory() as tmp:
+        db = bot.Database(os.path.join(tmp, "bench.db"))
+        t = bot.Tenant(db, "", [])
+        t.init_db()
+
+        t0 = time.perf_counter()
+        for uid in range(n):
+            t.ban_user(uid)
+        single = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        added = t.ban_users(range(n, 2 * n))
+        bulk = time.perf_counter() - t0
+        assert added == n
+
+        # 一半是活动会话 / 待处理申请，验证批量封禁后一次清理
+        for uid in range(2 * n, 2 * n + 1000):
+            (t.active_sessions if uid % 2 else t.pending_requests).add(uid)
+        path = os.path.join(tmp, "blocklist.csv")
+        with open(path, "w") as f:
+            f.write("user_id\n")
+            f.writelines(f"{uid}\n" for uid in range(2 * n, 3 * n))
+        t0 = time.perf_counter()
+        with open(path, "rb") as f:
+            added, seen, bad = bot.import_bans_file(t, f)
+        ended, dropped = t.purge_banned_sessions()
+        imported = time.perf_counter() - t0
+        assert (added, seen, bad) == (n, n, ["user_id"]) and len(ended) + len(dropped) == 1000
+
+        t0 = time.perf_counter()
+        with tempfile.TemporaryFile() as f:
+            exported = bot.export_bans_file(t, f)
+        export = time.perf_counter() - t0
+        assert exported == 3 * n
+
+        db.close()
+
+    print(f"ids={n}")
+    print(f"ban_user x{n}:      {single * 1e3:>9.1f} ms  ({n / single:>10,.0f} ids/s)")
+    print(f"ban_users:           {bulk * 1e3:>9.1f} ms  ({n / bulk:>10,.0f} ids/s)")
+    print(f"file import + purge: {imported * 1e3:>9.1f} ms  ({n / imported:>10,.0f} ids/s)")
+    print(f"export {3 * n} ids:   {export * 1e3:>9.1f} ms")
+
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 50_000)
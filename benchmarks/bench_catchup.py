@@ -0,0 +1,186 @@
+"""积压回放基准：停机期间在假 Bot API 里攒下一批更新，再启动真实的 bot.py 子进程（polling）。
+
+假定上次以 webhook 模式运行、webhook 还挂着（假 API 的 getUpdates 在删除 webhook 前返回 409）。
+
+积压内容：
+    --chatty 个已连接用户，每人 --messages 条消息（应逐条转发给管理员，且保持顺序）
+    --appliers 个未连接用户，每人连发 3 次 /start，再依次点 申请 / 取消 / 申请
+启动后另有一个已连接用户持续发实时消息，统计它的转发延迟；--live-chatty 时改由第一个积压用户发实时消息
+（他的积压应全部排在实时消息之前转发，超过 UPDATE_LANE_LIMIT 的积压也不能丢）。
+
+对比 CATCHUP_RATE=0（积压当作实时更新全速处理）和 CATCHUP_RATE=--rate，输出：处理完积压的用时、
+Bot API 调用的峰值速率、发给管理员的通知条数、转发顺序、实时消息延迟。
+--crash 时额外做一次崩溃测试：回放到一半 kill -9，重启后检查转发有没有重复或缺失。
+
+用法：
+    python benchmarks/bench_catchup.py [--chatty 50] [--messages 10] [--appliers 50] [--rate 20]
+                                       [--concurrency 64] [--live-chatty] [--crash]
+"""
+import argparse
+import asyncio
+import os
+import signal
+import statistics
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, ".."))
+import bot  # noqa: E402
+from fake_bot_api import FakeBotAPI, callback_update, message_update  # noqa: E402
+
+ADMIN_ID = 999
+CHATTY_BASE = 10_000
+APPLIER_BASE = 20_000
+LIVE_USER = 30_000
+
+
+def seed(tmp: str, args):
+    db = bot.Database(os.path.join(tmp, "bot_state.db"))
+    backend = bot.SQLiteStateBackend(db)
+    backend.init()
+    ops = [("set", "admin_ids", "admin", ADMIN_ID)]
+    for uid in [CHATTY_BASE + u for u in range(args.chatty)] + [LIVE_USER]:
+        ops.append(("add", "active", uid))
+        ops.append(("set", "session_admin", uid, ADMIN_ID))
+    backend.apply(ops)
+    db.close()
+
+
+def fill_backlog(api: FakeBotAPI, args) -> int:
+    update_id = 1
+    for i in range(args.messages):
+        for u in range(args.chatty):
+            api.updates.put_nowait(message_update(update_id, CHATTY_BASE + u, i + 1, text=f"m{i}"))
+            update_id += 1
+    for u in range(args.appliers):
+        uid = APPLIER_BASE + u
+        for i in range(3):
+            api.updates.put_nowait(message_update(update_id, uid, i + 1, text="/start"))
+            update_id += 1
+        for data in ("user_apply", "user_cancel", "user_apply"):
+            api.updates.put_nowait(callback_update(update_id, uid, data, message_id=3))
+            update_id += 1
+    return update_id
+
+
+def start_bot(api: FakeBotAPI, tmp: str, rate: float, args):
+    env = dict(os.environ, BOT_TOKEN="123456:FAKE", BOT_API_BASE_URL=api.base_url, ADMIN_USERNAMES="admin",
+               RELAY_BATCH_WINDOW="0", CATCHUP_RATE=str(rate), DIGEST_THRESHOLD="1000000",
+               UPDATE_CONCURRENCY=str(args.concurrency))
+    return asyncio.create_subprocess_exec(
+        sys.executable, os.path.join(HERE, "..", "bot.py"), cwd=tmp, env=env,
+        stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL)
+
+
+async def run(rate: float, args, tmp: str):
+    seed(tmp, args)
+    api = FakeBotAPI(latency=args.latency)
+    api.webhook_url = "https://bot.example/webhook"
+    await api.start()
+    next_id = fill_backlog(api, args)
+    copies = defaultdict(list)
+    live_sent = {}
+    live_lat = []
+    # 积压用户发实时消息时，message_id 接在他的积压之后
+    live_uid, live_base = (CHATTY_BASE, args.messages) if args.live_chatty else (LIVE_USER, 0)
+
+    def on_call(ts, method, params):
+        if method == "copyMessage":
+            chat = params.get("from_chat_id")
+            copies[chat].append(params.get("message_id"))
+            if chat == live_uid and params.get("message_id") in live_sent:
+                live_lat.append(ts - live_sent.pop(params.get("message_id")))
+
+    api.listeners.append(on_call)
+    expected = args.chatty * args.messages
+    proc = await start_bot(api, tmp, rate, args)
+    while api.counts["getMe"] < 1:
+        await asyncio.sleep(0.02)
+    t0 = time.perf_counter()
+
+    async def live_traffic():
+        nonlocal next_id
+        for i in range(args.live):
+            live_sent[live_base + i + 1] = time.perf_counter()
+            api.updates.put_nowait(message_update(next_id, live_uid, live_base + i + 1, text=f"live{i}"))
+            next_id += 1
+            await asyncio.sleep(0.5)
+
+    live = asyncio.create_task(live_traffic())
+    deadline = t0 + args.timeout
+    backlog_copies = lambda: sum(m <= args.messages for k, v in copies.items() if k != LIVE_USER for m in v)  # noqa: E731
+    while (backlog_copies() < expected or not live.done()) and time.perf_counter() < deadline:
+        await asyncio.sleep(0.05)
+    elapsed = time.perf_counter() - t0
+    await asyncio.sleep(1.0)  # 让申请通知等收尾的调用发完
+    proc.send_signal(signal.SIGINT)
+    await proc.wait()
+    await api.stop()
+
+    per_sec = Counter(int(ts - t0) for ts, m, _ in api.calls if m not in ("getUpdates", "getMe") and ts >= t0)
+    admin_msgs = sum(1 for _, m, p in api.calls if m == "sendMessage" and p.get("chat_id") == ADMIN_ID)
+    ordered = all(v == sorted(v) for v in copies.values())
+    lat = sorted(live_lat)
+    label = f"catch-up {rate:g}/s" if rate else "no catch-up"
+    print(f"[{label}] backlog relayed {backlog_copies()}/{expected} in {elapsed:.1f}s, "
+          f"peak {max(per_sec.values(), default=0)} API calls/s, {admin_msgs} admin notifications, "
+          f"order {'kept' if ordered else 'BROKEN'}, live relay latency "
+          f"p50={statistics.median(lat) * 1000 if lat else float('nan'):.0f}ms "
+          f"max={lat[-1] * 1000 if lat else float('nan'):.0f}ms ({len(lat)}/{args.live})")
+
+
+async def crash(args, tmp: str):
+    """回放到一半 kill -9，再启动一次，检查转发是否重复 / 缺失"""
+    seed(tmp, args)
+    api = FakeBotAPI(latency=args.latency)
+    api.webhook_url = "https://bot.example/webhook"
+    await api.start()
+    fill_backlog(api, args)
+    seen = Counter()
+    api.listeners.append(lambda ts, m, p: m == "copyMessage" and seen.update([(p.get("from_chat_id"), p.get("message_id"))]))
+    expected = args.chatty * args.messages
+    proc = await start_bot(api, tmp, args.rate, args)
+    while sum(seen.values()) < expected // 2:
+        await asyncio.sleep(0.02)
+    proc.kill()
+    await proc.wait()
+    before = sum(seen.values())
+    proc = await start_bot(api, tmp, args.rate, args)
+    deadline = time.perf_counter() + args.timeout
+    while len(seen) < expected and time.perf_counter() < deadline:
+        await asyncio.sleep(0.05)
+    await asyncio.sleep(1.0)
+    proc.send_signal(signal.SIGINT)
+    await proc.wait()
+    await api.stop()
+    dup = sum(n - 1 for n in seen.values())
+    print(f"[crash] killed after {before} relays; after restart {len(seen)}/{expected} distinct messages relayed, "
+          f"{dup} duplicates")
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--chatty", type=int, default=50)
+    ap.add_argument("--messages", type=int, default=10)
+    ap.add_argument("--appliers", type=int, default=50)
+    ap.add_argument("--live", type=int, default=20, help="启动后实时用户发的消息数（每 0.5 秒一条）")
+    ap.add_argument("--rate", type=float, default=20.0)
+    ap.add_argument("--concurrency", type=int, default=64, help="UPDATE_CONCURRENCY")
+    ap.add_argument("--live-chatty", action="store_true", help="实时消息由第一个积压用户发送")
+    ap.add_argument("--latency", type=float, default=0.02, help="假 API 每次调用的延迟（秒）")
+    ap.add_argument("--crash", action="store_true")
+    ap.add_argument("--timeout", type=float, default=180.0)
+    args = ap.parse_args()
+    for rate in (0, args.rate):
+        with tempfile.TemporaryDirectory() as tmp:
+            asyncio.run(run(rate, args, tmp))
+    if args.crash:
+        with tempfile.TemporaryDirectory() as tmp:
+            asyncio.run(crash(args, tmp))
+
+
+if __name__ == "__main__":
+    main()
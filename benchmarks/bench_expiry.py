@@ -0,0 +1,55 @@
+"""ExpiryTimer 规模测试：跟踪大量会话，relay 路径上的 touch 开销，以及到期扫描的耗时和堆大小。
+
+用法：python benchmarks/bench_expiry.py [条目数] [touch 次数]
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import bot  # noqa: E402
+
+
+def run(n: int, touches: int):
+    timer = bot.ExpiryTimer({"active": 600.0, "pending": 0})
+    members = {"active": set(range(n)), "pending": set()}
+
+    t0 = time.perf_counter()
+    for uid in range(n):
+        timer.track("active", uid, now=0.0)
+    track = time.perf_counter() - t0
+
+    rnd = random.Random(0)
+    ids = [rnd.randrange(n) for _ in range(touches)]
+    t0 = time.perf_counter()
+    for uid in ids:
+        timer.touch("active", uid)
+    touch = time.perf_counter() - t0
+
+    # 在 t=600 扫描（track 时 now=0）：touch 过的最后活动时间是当前时钟，按新截止时间重新入堆，其余到期
+    t0 = time.perf_counter()
+    expired = timer.due(600.0, members)
+    scan = time.perf_counter() - t0
+
+    # 同样的工作量按 tick 切片时，单个 tick 的最长耗时
+    timer2 = bot.ExpiryTimer({"active": 600.0, "pending": 0})
+    for uid in range(n):
+        timer2.track("active", uid, now=0.0)
+    worst, ticks = 0.0, 0
+    while timer2._heap and timer2._heap[0][0] <= 600.0:
+        t0 = time.perf_counter()
+        timer2.due(600.0, members, bot.ExpiryTimer.MAX_PER_TICK)
+        worst = max(worst, time.perf_counter() - t0)
+        ticks += 1
+
+    print(f"tracked={n} touches={touches}")
+    print(f"track:   {track / n * 1e9:>8.0f} ns/entry")
+    print(f"touch:   {touch / touches * 1e9:>8.0f} ns/op")
+    print(f"due():   {scan * 1e3:>8.1f} ms, expired {len(expired)}, still tracked {len(timer)}, heap {len(timer._heap)}")
+    print(f"sliced:  {ticks} ticks of <= {bot.ExpiryTimer.MAX_PER_TICK}, worst tick {worst * 1e3:.1f} ms")
+
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 200_000,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 1_000_000)
@@ -0,0 +1,170 @@
+"""HTTP 传输基准：以固定并发（--concurrency，相当于 OUTBOUND_CONCURRENCY）对本地假 Bot API 发出一波
+sendMessage（模拟广播），同时保持一个 getUpdates 长轮询，比较不同连接池配置下的吞吐、客户端 CPU、
+等池时间（bot_http_pool_wait_seconds）、Pool timeout 次数和新建连接数。
+
+配置：
+    shared     发送和长轮询共用一个不分片的池，大小等于并发数，等池上限 1 秒（PTB 默认）
+    small      长轮询单独一个池，发送池只有 --small 条连接（小于并发数，请求在池里排队）
+    single     长轮询单独一个池，发送池 HTTP_POOL_SIZE 条连接，不分片
+    sharded    同上，发送池拆成 HTTP_POOL_SHARDS 个小池
+另外用两波发送、中间空闲 --idle 秒，比较空闲长连接保留时间（keep-alive expiry）对新建连接数的影响。
+
+假 API 跑在单独的进程里，不和被测的客户端抢 CPU。
+
+用法：
+    python benchmarks/bench_http_transport.py [--sends 400] [--concurrency 64] [--latency 0.2]
+                                              [--small 8] [--idle 2]
+"""
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import bot  # noqa: E402
+from fake_bot_api import FakeBotAPI  # noqa: E402
+from telegram import Bot  # noqa: E402
+from telegram.error import TimedOut  # noqa: E402
+
+TOKEN = "123456:FAKE"
+logging.getLogger("httpx").setLevel(logging.WARNING)
+_api_metrics = bot.MetricsRegistry()
+API_LATENCY = _api_metrics.histogram("bot_api_request_seconds", "Bot API request latency", ("method",))
+API_ERRORS = _api_metrics.counter("bot_api_errors_total", "Bot API errors by status code", ("method", "code"))
+
+
+def hist_quantile(pool: str, q: float) -> float:
+    """按桶估计分位数（取桶上界）"""
+    row = bot.http_pool_wait._series.get((pool,))
+    if not row:
+        return 0.0
+    target = q * row[-1]
+    acc = 0
+    for le, n in zip(bot.http_pool_wait.buckets, row):
+        acc += n
+        if acc >= target:
+            return le
+    return float("inf")
+
+
+class RemoteAPI:
+    """在子进程里运行 FakeBotAPI；connections() 取该进程累计接受的连接数"""
+
+    def __init__(self, latency: float):
+        self._conn, child = multiprocessing.Pipe()
+        self._proc = multiprocessing.get_context("spawn").Process(target=_serve_api, args=(latency, child))
+        self._proc.start()
+        self.base_url = self._conn.recv()
+
+    def connections(self) -> int:
+        self._conn.send("count")
+        return self._conn.recv()
+
+    def stop(self):
+        self._conn.send("stop")
+        self._proc.join()
+
+
+def _serve_api(latency: float, conn):
+    async def serve():
+        api = FakeBotAPI(latency=latency)
+        await api.start()
+        conn.send(api.base_url)
+        while await asyncio.to_thread(conn.recv) != "stop":
+            conn.send(api.connections)
+        await api.stop()
+    asyncio.run(serve())
+
+
+def make_request(pool: str, size: int, shards: int = 1, **overrides) -> bot.InstrumentedRequest:
+    bot.HTTP_POOL_SHARDS = shards
+    kwargs = bot.http_request_kwargs(pool, size)
+    kwargs.update(overrides)
+    return bot.InstrumentedRequest(latency=API_LATENCY, errors=API_ERRORS, **kwargs)
+
+
+async def burst(b: Bot, n: int, concurrency: int) -> tuple:
+    sem = asyncio.Semaphore(concurrency)
+
+    async def one(i):
+        async with sem:
+            try:
+                await b.send_message(chat_id=10_000 + i, text="broadcast")
+                return True
+            except TimedOut:
+                return False
+
+    t0 = time.perf_counter()
+    results = await asyncio.gather(*(one(i) for i in range(n)))
+    return time.perf_counter() - t0, results.count(False)
+
+
+async def long_poll(b: Bot):
+    while True:
+        await b.get_updates(timeout=10)
+
+
+async def scenario(name: str, args, send_req, poll_req):
+    bot.http_pool_wait._series.clear()
+    api = RemoteAPI(args.latency)
+    b = Bot(TOKEN, base_url=api.base_url, request=send_req, get_updates_request=poll_req)
+    async with b:
+        poller = asyncio.create_task(long_poll(b))
+        await asyncio.sleep(0.2)
+        cpu = time.process_time()
+        elapsed, timeouts = await burst(b, args.sends, args.concurrency)
+        cpu = time.process_time() - cpu
+        poller.cancel()
+        with_conns = api.connections()
+    api.stop()
+    pool = "send"
+    print(f"[{name}] {args.sends - timeouts}/{args.sends} sent in {elapsed:.2f}s "
+          f"-> {(args.sends - timeouts) / elapsed:,.0f}/s, client CPU {cpu:.2f}s, pool timeouts {timeouts}, "
+          f"pool wait p50<={hist_quantile(pool, 0.5) * 1000:g}ms p99<={hist_quantile(pool, 0.99) * 1000:g}ms, "
+          f"connections opened {with_conns}")
+
+
+async def keepalive(args, expiry: float):
+    bot.HTTP_KEEPALIVE_EXPIRY = expiry
+    api = RemoteAPI(args.latency)
+    b = Bot(TOKEN, base_url=api.base_url, request=make_request("send", bot.HTTP_POOL_SIZE, args.shards))
+    async with b:
+        await burst(b, args.sends // 4, args.concurrency)
+        first = api.connections()
+        await asyncio.sleep(args.idle)
+        await burst(b, args.sends // 4, args.concurrency)
+        second = api.connections() - first
+    api.stop()
+    print(f"[keep-alive expiry={expiry:g}s] connections opened: first burst {first}, "
+          f"after {args.idle:g}s idle {second}")
+
+
+async def run(args):
+    print(f"HTTP version: {bot.http_version()}, pool size {bot.HTTP_POOL_SIZE}, shards {args.shards}")
+    default_expiry = bot.HTTP_KEEPALIVE_EXPIRY
+    shared = make_request("send", args.concurrency, pool_timeout=1.0)
+    await scenario("shared", args, shared, shared)
+    await scenario("small", args, make_request("send", args.small), make_request("poll", 1))
+    await scenario("single", args, make_request("send", bot.HTTP_POOL_SIZE), make_request("poll", 1))
+    await scenario("sharded", args, make_request("send", bot.HTTP_POOL_SIZE, args.shards), make_request("poll", 1))
+    await keepalive(args, max(args.idle / 2, 0.1))
+    await keepalive(args, default_expiry)
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--sends", type=int, default=400)
+    ap.add_argument("--concurrency", type=int, default=64)
+    ap.add_argument("--latency", type=float, default=0.2, help="假 API 每次调用的延迟（秒）")
+    ap.add_argument("--small", type=int, default=8)
+    ap.add_argument("--idle", type=float, default=2.0)
+    args = ap.parse_args()
+    args.shards = bot.HTTP_POOL_SHARDS
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+"""指标埋点在热路径上的额外开销：包装前后的 handler 调用、timed_db 包装的同步调用。
+
+用法：python benchmarks/bench_metrics_overhead.py [次数]
+"""
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import bot  # noqa: E402
+
+
+async def relay_like(update, context):
+    return None
+
+
+async def time_handler(fn, n: int) -> float:
+    t0 = time.perf_counter()
+    for _ in range(n):
+        await fn(None, None)
+    return (time.perf_counter() - t0) / n
+
+
+def noop_db(i):
+    return None
+
+
+def time_sync(fn, n: int) -> float:
+    t0 = time.perf_counter()
+    for i in range(n):
+        fn(i)
+    return (time.perf_counter() - t0) / n
+
+
+def run(n: int):
+    registry = bot.MetricsRegistry()
+    wrapped = bot.instrument_handler(relay_like,
+                                     registry.histogram("bot_handler_seconds", "Update handler latency", ("handler",)),
+                                     registry.counter("bot_handler_errors_total", "Update handler exceptions", ("handler",)))
+    raw_h = asyncio.run(time_handler(relay_like, n))
+    inst_h = asyncio.run(time_handler(wrapped, n))
+    raw_db = time_sync(noop_db, n)
+    inst_db = time_sync(bot.timed_db("bench_noop")(noop_db), n)
+    print(f"calls={n}")
+    print(f"handler:      raw {raw_h * 1e9:7.0f} ns  instrumented {inst_h * 1e9:7.0f} ns  overhead {(inst_h - raw_h) * 1e9:6.0f} ns/call")
+    print(f"timed_db:     raw {raw_db * 1e9:7.0f} ns  instrumented {inst_db * 1e9:7.0f} ns  overhead {(inst_db - raw_db) * 1e9:6.0f} ns/call")
+
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 200_000)
@@ -0,0 +1,102 @@
+"""相册 / 连发场景下的转发 API 调用数：逐条 copyMessage vs RelayBatcher + copyMessages。
+
+用法：python benchmarks/bench_relay_batching.py [用户数] [每个用户的相册数]
+"""
+import asyncio
+import os
+import random
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import bot  # noqa: E402
+
+
+class FakeMessageId:
+    def __init__(self, message_id):
+        self.message_id = message_id
+
+
+class FakeBot:
+    def __init__(self):
+        self.calls = 0
+        self._next = 0
+
+    def new_id(self):
+        self._next += 1
+        return FakeMessageId(self._next)
+
+    async def copy_messages(self, chat_id, from_chat_id, message_ids):
+        self.calls += 1
+        await asyncio.sleep(0.01)
+        return tuple(self.new_id() for _ in message_ids)
+
+
+class FakeMessage:
+    def __init__(self, fake_bot, message_id):
+        self._bot = fake_bot
+        self.message_id = message_id
+
+    async def copy(self, chat_id):
+        self._bot.calls += 1
+        await asyncio.sleep(0.01)
+        return self._bot.new_id()
+
+    async def reply_text(self, text):
+        pass
+
+
+def replay(n_users: int, albums: int):
+    """每个用户发送若干相册（2-10 张）和若干连发文字，各条之间间隔几毫秒"""
+    rnd = random.Random(1)
+    events = []
+    for uid in range(1, n_users + 1):
+        mid = 0
+        t = rnd.random()
+        for _ in range(albums):
+            for _ in range(rnd.randint(2, 10) + rnd.randint(0, 3)):
+                mid += 1
+                events.append((t, uid, mid))
+                t += 0.005
+            t += 2.0
+    events.sort()
+    return events
+
+
+async def run_window(tenant: bot.Tenant, window: float, events):
+    fake = FakeBot()
+    tenant.relay_batcher = bot.RelayBatcher(tenant, window)
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    for t, uid, mid in events:
+        delay = start + t - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tenant.relay_batcher.add(fake, uid, FakeMessage(fake, mid))
+    await asyncio.sleep(window + 0.1)
+    while tenant.relay_batcher._tails:
+        await asyncio.sleep(0.05)
+    return fake.calls, tenant.relay_batcher.messages
+
+
+def run(n_users: int, albums: int):
+    events = replay(n_users, albums)
+    with tempfile.TemporaryDirectory() as tmp:
+        db = bot.Database(os.path.join(tmp, "bench.db"))
+        t = bot.Tenant(db, "", [])
+        t.init_db()
+        t.numeric_admin_ids.add(1)
+        for uid in range(1, n_users + 1):
+            t.start_session(uid, 1)
+        per_msg, n_msgs = asyncio.run(run_window(t, 0, events))
+        batched, _ = asyncio.run(run_window(t, bot.RELAY_BATCH_WINDOW, events))
+        db.close()
+    print(f"messages={n_msgs} users={n_users}")
+    print(f"per-message copy:   {per_msg:6d} API calls")
+    print(f"batched (window={bot.RELAY_BATCH_WINDOW}s): {batched:6d} API calls ({per_msg / batched:.1f}x fewer)")
+
+
+if __name__ == "__main__":
+    n_users = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    albums = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    run(n_users, albums)
@@ -0,0 +1,112 @@
+"""多进程分片基准：以 WORKERS=N 启动真实的 bot.py 子进程（polling，连接假 Bot API），
+向 users 个已连接用户注入消息洪峰，统计转发吞吐，并检查每个用户的消息顺序是否保持。
+
+状态后端默认 SQLite（子进程工作目录下的 bot_state.db），--redis 时使用进程内的 RESP 替身。
+
+用法：
+    python benchmarks/bench_sharded.py [--workers 1,2,4] [--users 200] [--messages 10]
+                                       [--latency 0.02] [--redis]
+"""
+import argparse
+import asyncio
+import os
+import signal
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, ".."))
+import bot  # noqa: E402
+from fake_bot_api import FakeBotAPI, message_update  # noqa: E402
+from fake_redis import FakeRedis  # noqa: E402
+
+ADMIN_ID = 999
+USER_BASE = 10_000
+
+
+def seed_ops(users: int) -> list:
+    ops = [("set", "admin_ids", "admin", ADMIN_ID)]
+    for u in range(users):
+        ops.append(("add", "active", USER_BASE + u))
+        ops.append(("set", "session_admin", USER_BASE + u, ADMIN_ID))
+    return ops
+
+
+async def run(workers: int, args, tmp: str) -> None:
+    api = FakeBotAPI(latency=args.latency)
+    await api.start()
+    env = dict(os.environ, BOT_TOKEN="123456:FAKE", BOT_API_BASE_URL=api.base_url, WORKERS=str(workers),
+               ADMIN_USERNAMES="admin", RELAY_BATCH_WINDOW="0", OUTBOUND_RATE="100000",
+               FLOOD_MSG_LIMIT=str(10**9), FLOOD_CB_LIMIT=str(10**9))
+
+    redis = None
+    if args.redis:
+        redis = FakeRedis()
+        await redis.start()
+        env.update(STATE_BACKEND="redis", REDIS_URL=redis.url, REDIS_PREFIX=f"bench{workers}")
+        backend = bot.RedisStateBackend(redis.url, f"bench{workers}")
+        await asyncio.to_thread(backend.apply, seed_ops(args.users))
+        await asyncio.to_thread(backend.close)
+    else:
+        db = bot.Database(os.path.join(tmp, "bot_state.db"))
+        backend = bot.SQLiteStateBackend(db)
+        backend.init()
+        backend.apply(seed_ops(args.users))
+        db.close()
+
+    seen = defaultdict(list)
+
+    def on_call(ts, method, params):
+        if method == "copyMessage":
+            seen[params.get("from_chat_id")].append((ts, params.get("message_id")))
+
+    api.listeners.append(on_call)
+    proc = await asyncio.create_subprocess_exec(
+        sys.executable, os.path.join(HERE, "..", "bot.py"), cwd=tmp, env=env,
+        stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL)
+    # 等所有 worker 起来（每个 worker 和分发进程启动时各调用一次 getMe）
+    while api.counts["getMe"] < (workers + 1 if workers > 1 else 1):
+        await asyncio.sleep(0.05)
+    await asyncio.sleep(0.5)
+
+    total = args.users * args.messages
+    t0 = time.perf_counter()
+    update_id = 1
+    for i in range(args.messages):
+        for u in range(args.users):
+            api.updates.put_nowait(message_update(update_id, USER_BASE + u, i + 1, text=f"m{i}"))
+            update_id += 1
+    deadline = t0 + args.timeout
+    while sum(map(len, seen.values())) < total and time.perf_counter() < deadline:
+        await asyncio.sleep(0.02)
+    done = sum(map(len, seen.values()))
+    elapsed = max((ts for calls in seen.values() for ts, _ in calls), default=t0) - t0
+    ordered = all([mid for _, mid in calls] == sorted(mid for _, mid in calls) for calls in seen.values())
+
+    proc.send_signal(signal.SIGINT)
+    await proc.wait()
+    await api.stop()
+    if redis is not None:
+        await redis.stop()
+    print(f"[workers={workers}{' redis' if args.redis else ''}] relayed {done}/{total} in {elapsed:.2f}s "
+          f"-> {done / max(elapsed, 1e-9):,.0f}/s, per-user order {'kept' if ordered else 'BROKEN'}")
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--workers", default="1,2,4")
+    ap.add_argument("--users", type=int, default=200)
+    ap.add_argument("--messages", type=int, default=10)
+    ap.add_argument("--latency", type=float, default=0.02, help="假 API 每次调用的延迟（秒）")
+    ap.add_argument("--redis", action="store_true", help="使用 RESP 替身作为状态后端")
+    ap.add_argument("--timeout", type=float, default=120.0)
+    args = ap.parse_args()
+    for n in map(int, args.workers.split(",")):
+        with tempfile.TemporaryDirectory() as tmp:
+            asyncio.run(run(n, args, tmp))
+
+
+if __name__ == "__main__":
+    main()
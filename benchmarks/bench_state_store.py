@@ -0,0 +1,54 @@
+"""会话状态持久化的开销：relay 路径上每次记录映射的耗时，以及重启时批量恢复的耗时。
+
+用法：python benchmarks/bench_state_store.py [映射条数]
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import bot  # noqa: E402
+
+
+async def fill(t: bot.Tenant, n: int):
+    t.state_store.start()
+    plain: dict = {}
+    t0 = time.perf_counter()
+    for i in range(n):
+        plain[i] = i % 1000
+    t_plain = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    for i in range(n):
+        t.admin_msgid_to_user[(1, i)] = i % 1000
+        t.session_admin[i % 1000] = i
+    t_store = (time.perf_counter() - t0) / 2
+    await t.state_store.stop()
+    return t_plain, t_store
+
+
+def run(n: int):
+    with tempfile.TemporaryDirectory() as tmp:
+        db = bot.Database(os.path.join(tmp, "bench.db"))
+        t = bot.Tenant(db, "", [])
+        t.init_db()
+        t_plain, t_store = asyncio.run(fill(t, n))
+        db.close()
+
+        t = bot.Tenant(db, "", [])
+        t0 = time.perf_counter()
+        t.init_db()
+        t_load = time.perf_counter() - t0
+        assert len(t.admin_msgid_to_user) == min(n, bot.REPLY_MAP_HOT_SIZE)
+        db.close()
+
+    print(f"entries={n}")
+    print(f"plain dict set:      {t_plain / n * 1e9:8.0f} ns/op")
+    print(f"persistent dict set: {t_store / n * 1e9:8.0f} ns/op")
+    print(f"restart reload:      {t_load * 1e3:8.1f} ms")
+
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 100_000)
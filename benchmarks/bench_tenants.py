@@ -0,0 +1,154 @@
+"""多租户基准：以 TENANTS_FILE 启动真实的 bot.py 子进程（N 个 bot 共用一个进程，连接假 Bot API），
+测量进程常驻内存随租户数的增长，并和“每个 bot 一个进程”对比；同时检查租户隔离和分租户指标：
+
+  - 每个租户的用户发 /start，应只由该租户的 token 回复；
+  - 在第一个租户里 /ban 某个用户，只有该租户的 banned 表里有这条记录；
+  - /metrics 里每个租户都有带 tenant 标签的样本。
+
+用法：
+    python benchmarks/bench_tenants.py [--tenants 1,10,50] [--messages 20]
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import sqlite3
+import sys
+import tempfile
+import time
+import urllib.request
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, ".."))
+from fake_bot_api import FakeBotAPI, message_update  # noqa: E402
+
+ADMIN_ID = 999
+USER_BASE = 10_000
+
+
+def rss_kb(pid: int) -> int:
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    return 0
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def token(i: int) -> str:
+    return f"{100000 + i}:FAKE{i}"
+
+
+def admin_update(update_id: int, message_id: int, text: str) -> dict:
+    upd = message_update(update_id, ADMIN_ID, message_id, text=text)
+    upd["message"]["from"]["username"] = "admin"
+    return upd
+
+
+async def wait_for(cond, timeout: float) -> bool:
+    deadline = time.perf_counter() + timeout
+    while not cond():
+        if time.perf_counter() > deadline:
+            return False
+        await asyncio.sleep(0.05)
+    return True
+
+
+async def run(n: int, args, tmp: str) -> int:
+    api = FakeBotAPI(latency=args.latency)
+    await api.start()
+    with open(os.path.join(tmp, "tenants.json"), "w") as f:
+        json.dump({"tenants": [{"name": f"t{i}", "token": token(i), "admins": ["admin"]} for i in range(n)]}, f)
+    port = free_port()
+    env = dict(os.environ, TENANTS_FILE="tenants.json", BOT_API_BASE_URL=api.base_url, METRICS_PORT=str(port),
+               METRICS_LISTEN="127.0.0.1", RELAY_BATCH_WINDOW="0")
+    proc = await asyncio.create_subprocess_exec(
+        sys.executable, os.path.join(HERE, "..", "bot.py"), cwd=tmp, env=env,
+        stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL)
+    t0 = time.perf_counter()
+    started = await wait_for(lambda: api.counts["getUpdates"] >= n, args.timeout)
+    startup = time.perf_counter() - t0
+    await asyncio.sleep(1.0)
+    idle_rss = rss_kb(proc.pid)
+
+    # 每个租户：若干用户发 /start；第一个租户的管理员封禁一个用户
+    update_id = 1
+    for i in range(n):
+        q = api.updates_for(token(i))
+        for m in range(args.messages):
+            q.put_nowait(message_update(update_id, USER_BASE + m, m + 1, text="/start"))
+            update_id += 1
+    api.updates_for(token(0)).put_nowait(admin_update(update_id, 10_000, f"/ban {USER_BASE}"))
+    replied = await wait_for(
+        lambda: all(api.token_counts[token(i), "sendMessage"] >= args.messages for i in range(n))
+        and api.token_counts[token(0), "sendMessage"] >= args.messages + 2, args.timeout)
+    busy_rss = rss_kb(proc.pid)
+
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=5) as resp:
+        text = resp.read().decode()
+    labelled = sum(f'tenant="t{i}"' in text for i in range(n))
+
+    proc.send_signal(2)
+    await proc.wait()
+    await api.stop()
+
+    conn = sqlite3.connect(os.path.join(tmp, "bot_state.db"))
+    banned = [conn.execute(f"SELECT count(*) FROM t{i}_banned").fetchone()[0] for i in range(n)]
+    conn.close()
+    isolated = banned[0] == 1 and not any(banned[1:])
+    print(f"[tenants={n}] started in {startup:.2f}s{'' if started else ' (TIMEOUT)'}, "
+          f"RSS idle {idle_rss / 1024:.1f} MiB / after traffic {busy_rss / 1024:.1f} MiB, "
+          f"replies {'ok' if replied else 'MISSING'}, bans {'isolated' if isolated else 'LEAKED'}, "
+          f"metrics for {labelled}/{n} tenants")
+    return idle_rss
+
+
+async def single_bot_rss(args, tmp: str) -> int:
+    """对照组：普通单 bot 进程的常驻内存"""
+    api = FakeBotAPI()
+    await api.start()
+    env = dict(os.environ, BOT_TOKEN=token(0), BOT_API_BASE_URL=api.base_url)
+    env.pop("TENANTS_FILE", None)
+    proc = await asyncio.create_subprocess_exec(
+        sys.executable, os.path.join(HERE, "..", "bot.py"), cwd=tmp, env=env,
+        stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL)
+    await wait_for(lambda: api.counts["getUpdates"] >= 1, args.timeout)
+    await asyncio.sleep(1.0)
+    rss = rss_kb(proc.pid)
+    proc.send_signal(2)
+    await proc.wait()
+    await api.stop()
+    return rss
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--tenants", default="1,10,50")
+    ap.add_argument("--messages", type=int, default=20, help="每个租户的 /start 次数")
+    ap.add_argument("--latency", type=float, default=0.0, help="假 API 每次调用的延迟（秒）")
+    ap.add_argument("--timeout", type=float, default=60.0)
+    args = ap.parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        single = asyncio.run(single_bot_rss(args, tmp))
+    print(f"[single bot process] RSS {single / 1024:.1f} MiB")
+    results = {}
+    for n in map(int, args.tenants.split(",")):
+        with tempfile.TemporaryDirectory() as tmp:
+            results[n] = asyncio.run(run(n, args, tmp))
+    counts = sorted(results)
+    if len(counts) > 1:
+        lo, hi = counts[0], counts[-1]
+        per = (results[hi] - results[lo]) / (hi - lo)
+        print(f"memory per additional tenant: {per / 1024:.2f} MiB "
+              f"(vs {single / 1024:.1f} MiB for a separate process, {hi} bots: "
+              f"{results[hi] / 1024:.0f} MiB shared vs {hi * single / 1024:.0f} MiB as processes)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+"""本地假 Telegram Bot API 服务，供基准测试 / webhook 回放使用（只用标准库）。
+
+bot 通过 BOT_API_BASE_URL=http://127.0.0.1:<port>/bot 指向这里。每次调用都会记录到
+``calls``，并可注入固定延迟（``latency``；``chat_latency`` 可给个别 chat 单独设置，模拟不可达的对端）
+和按比例返回 429（``flood_ratio``）。
+
+多个 bot token 可以连同一个实例：``updates_for(token)`` 给某个 token 单独一个更新队列，
+``token_counts`` 按 (token, 方法) 计数；未单独注册的 token 共用 ``updates``。
+"""
+import asyncio
+import json
+import random
+import time
+from collections import Counter
+from typing import Callable, Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl
+
+BOT_USER = {"id": 1000, "is_bot": True, "first_name": "FakeBot", "username": "fake_bot"}
+
+
+class FakeBotAPI:
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency: float = 0.0,
+                 flood_ratio: float = 0.0, retry_after: int = 1, seed: int = 0,
+                 chat_latency: Optional[Dict[int, float]] = None):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.chat_latency = chat_latency or {}
+        self.flood_ratio = flood_ratio
+        self.retry_after = retry_after
+        self.calls: List[Tuple[float, str, dict]] = []
+        self.counts: Counter = Counter()
+        self.listeners: List[Callable[[float, str, dict], None]] = []
+        self.updates: asyncio.Queue = asyncio.Queue()
+        self.token_updates: Dict[str, asyncio.Queue] = {}
+        self.token_counts: Counter = Counter()
+        self.connections = 0  # 累计接受的 TCP 连接数（观察长连接复用）
+        self._rnd = random.Random(seed)
+        self._next_message_id: Dict[int, int] = {}  # 和真实 Bot API 一样，message_id 按聊天各自编号
+        self.webhook_url = ""  # 和真实 Bot API 一样，设置了 webhook 时 getUpdates 返回 409
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}/bot"
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_conn, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    def updates_for(self, token: str) -> asyncio.Queue:
+        return self.token_updates.setdefault(token, asyncio.Queue())
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    # ----------------- HTTP -----------------
+    async def _handle_conn(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connections += 1
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    return
+                _, path, _ = request_line.decode().split(" ", 2)
+                headers: Dict[str, str] = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    k, v = line.decode().split(":", 1)
+                    headers[k.strip().lower()] = v.strip()
+                body = await reader.readexactly(int(headers.get("content-length", "0")))
+                status, payload = await self._dispatch(path, headers.get("content-type", ""), body)
+                data = json.dumps(payload).encode()
+                writer.write(
+                    f"HTTP/1.1 {status} OK\r\nContent-Type: application/json\r\n"
+                    f"Content-Length: {len(data)}\r\n\r\n".encode() + data
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    def _parse_params(content_type: str, body: bytes) -> dict:
+        if not body:
+            return {}
+        if content_type.startswith("application/json"):
+            return json.loads(body)
+        if content_type.startswith("multipart/form-data"):
+            return {"_multipart_bytes": len(body)}
+        params = {}
+        for k, v in parse_qsl(body.decode()):
+            try:
+                params[k] = json.loads(v)
+            except ValueError:
+                params[k] = v
+        return params
+
+    async def _dispatch(self, path: str, content_type: str, body: bytes):
+        token, method = path.rsplit("/", 2)[-2:]
+        token = token[len("bot"):]
+        params = self._parse_params(content_type, body)
+        now = time.perf_counter()
+        self.calls.append((now, method, params))
+        self.counts[method] += 1
+        self.token_counts[token, method] += 1
+        for listener in self.listeners:
+            listener(now, method, params)
+        if method == "getUpdates":
+            if self.webhook_url:
+                self.counts["409"] += 1
+                return 409, {"ok": False, "error_code": 409,
+                             "description": "Conflict: can't use getUpdates method while webhook is active; "
+                                            "use deleteWebhook to delete the webhook first"}
+            queue = self.token_updates.get(token, self.updates)
+            return 200, {"ok": True, "result": await self._get_updates(queue, params)}
+        latency = self.chat_latency.get(params.get("chat_id"), self.latency)
+        if latency:
+            await asyncio.sleep(latency)
+        if self.flood_ratio and method not in ("getMe", "setWebhook", "deleteWebhook") and self._rnd.random() < self.flood_ratio:
+            self.counts["429"] += 1
+            return 429, {"ok": False, "error_code": 429, "description": "Too Many Requests",
+                         "parameters": {"retry_after": self.retry_after}}
+        handler = getattr(self, f"_m_{method}", None)
+        result = handler(params) if handler else True
+        return 200, {"ok": True, "result": result}
+
+    # ----------------- METHODS -----------------
+    @staticmethod
+    def _chat_id(chat_id) -> int:
+        # "@name" 形式的目标映射成一个稳定的数字 id，getChat 和发出的消息用同一个
+        return chat_id if isinstance(chat_id, int) else -abs(hash(chat_id)) % 10**9
+
+    def _new_message(self, chat_id, **extra) -> dict:
+        chat_id = self._chat_id(chat_id)
+        mid = self._next_message_id.get(chat_id, 1)
+        self._next_message_id[chat_id] = mid + 1
+        msg = {"message_id": mid, "date": int(time.time()), "chat": {"id": chat_id, "type": "private"}, "from": BOT_USER}
+        msg.update(extra)
+        return msg
+
+    async def _get_updates(self, queue: asyncio.Queue, params: dict) -> list:
+        timeout = float(params.get("timeout", 0) or 0)
+        offset = int(params.get("offset", 0) or 0)
+        limit = int(params.get("limit", 100) or 100)
+        try:
+            first = await asyncio.wait_for(queue.get(), timeout) if timeout else queue.get_nowait()
+        except (asyncio.TimeoutError, asyncio.QueueEmpty):
+            return []
+        result = [first] if first["update_id"] >= offset else []
+        while len(result) < limit and not queue.empty():
+            upd = queue.get_nowait()
+            if upd["update_id"] >= offset:
+                result.append(upd)
+        return result
+
+    def _m_setWebhook(self, params):
+        self.webhook_url = params.get("url", "")
+        return True
+
+    def _m_deleteWebhook(self, params):
+        self.webhook_url = ""
+        return True
+
+    def _m_getMe(self, params):
+        return BOT_USER
+
+    def _m_getChat(self, params):
+        return {"id": self._chat_id(params.get("chat_id")), "type": "private", "accent_color_id": 0,
+                "max_reaction_count": 11, "accepted_gift_types": {"unlimited_gifts": False, "limited_gifts": False,
+                                                                  "unique_gifts": False, "premium_subscription": False,
+                                                                  "gifts_from_channels": False}}
+
+    def _m_sendMessage(self, params):
+        return self._new_message(params.get("chat_id"), text=params.get("text", ""))
+
+    def _m_editMessageText(self, params):
+        return self._new_message(params.get("chat_id", 0), text=params.get("text", ""))
+
+    def _m_sendDocument(self, params):
+        return self._new_message(params.get("chat_id", 0))
+
+    def _m_copyMessage(self, params):
+        return {"message_id": self._new_message(params.get("chat_id"))["message_id"]}
+
+    def _m_copyMessages(self, params):
+        return [{"message_id": self._new_message(params.get("chat_id"))["message_id"]}
+                for _ in params.get("message_ids", [])]
+
+    def _m_forwardMessage(self, params):
+        return self._new_message(params.get("chat_id"))
+
+
+# ----------------- UPDATE FACTORIES -----------------
+def user_dict(user_id: int) -> dict:
+    return {"id": user_id, "is_bot": False, "first_name": f"u{user_id}", "username": f"user{user_id}"}
+
+
+def message_update(update_id: int, user_id: int, message_id: int, text: str = "hi",
+                   reply_to: Optional[int] = None, media_group_id: Optional[str] = None) -> dict:
+    msg = {"message_id": message_id, "date": int(time.time()),
+           "chat": {"id": user_id, "type": "private"}, "from": user_dict(user_id), "text": text}
+    if text.startswith("/"):
+        msg["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    if reply_to is not None:
+        msg["reply_to_message"] = {"message_id": reply_to, "date": int(time.time()),
+                                   "chat": {"id": user_id, "type": "private"}, "from": BOT_USER, "text": "x"}
+    if media_group_id is not None:
+        msg["media_group_id"] = media_group_id
+    return {"update_id": update_id, "message": msg}
+
+
+def callback_update(update_id: int, user_id: int, data: str, message_id: int = 1) -> dict:
+    return {"update_id": update_id, "callback_query": {
+        "id": str(update_id), "from": user_dict(user_id), "chat_instance": "ci", "data": data,
+        "message": {"message_id": message_id, "date": int(time.time()),
+                    "chat": {"id": user_id, "type": "private"}, "from": BOT_USER, "text": "menu"}}}
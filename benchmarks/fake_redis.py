@@ -0,0 +1,154 @@
+"""本地 Redis 协议（RESP2）替身，供 STATE_BACKEND=redis 的测试 / 基准使用（只用标准库）。
+
+只实现 bot 用到的命令：PING、AUTH、SELECT、SADD、SREM、SMEMBERS、SCARD、SSCAN、HSET、HDEL、HGET、
+HGETALL、DEL、FLUSHALL。数据只在内存里，进程退出即丢失。
+
+用法：
+    python benchmarks/fake_redis.py [--port 6379]
+"""
+import argparse
+import asyncio
+from typing import Dict, List, Optional, Set
+
+
+class FakeRedis:
+    def __init__(self, host: str = "127.0.0.1", port: int = 0):
+        self.host = host
+        self.port = port
+        self.sets: Dict[bytes, Set[bytes]] = {}
+        self.hashes: Dict[bytes, Dict[bytes, bytes]] = {}
+        self.commands = 0
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    @property
+    def url(self) -> str:
+        return f"redis://{self.host}:{self.port}/0"
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_conn, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    # ----------------- RESP -----------------
+    async def _read_command(self, reader: asyncio.StreamReader) -> Optional[List[bytes]]:
+        line = await reader.readline()
+        if not line:
+            return None
+        if not line.startswith(b"*"):
+            return line.split()  # inline 命令（redis-cli / telnet）
+        args = []
+        for _ in range(int(line[1:])):
+            n = int((await reader.readline())[1:])
+            args.append((await reader.readexactly(n + 2))[:-2])
+        return args
+
+    @staticmethod
+    def _encode(value) -> bytes:
+        if value is None:
+            return b"$-1\r\n"
+        if isinstance(value, Exception):
+            return b"-ERR %s\r\n" % str(value).encode()
+        if isinstance(value, str):
+            return b"+%s\r\n" % value.encode()
+        if isinstance(value, int):
+            return b":%d\r\n" % value
+        if isinstance(value, bytes):
+            return b"$%d\r\n%s\r\n" % (len(value), value)
+        return b"*%d\r\n" % len(value) + b"".join(FakeRedis._encode(v) for v in value)
+
+    async def _handle_conn(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                args = await self._read_command(reader)
+                if args is None:
+                    return
+                self.commands += 1
+                handler = getattr(self, f"_c_{args[0].decode().lower()}", None)
+                try:
+                    reply = handler(*args[1:]) if handler else ValueError(f"unknown command '{args[0].decode()}'")
+                except TypeError:
+                    reply = ValueError(f"wrong number of arguments for '{args[0].decode()}'")
+                writer.write(self._encode(reply))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    # ----------------- COMMANDS -----------------
+    def _c_ping(self, *args):
+        return args[0] if args else "PONG"
+
+    def _c_auth(self, *args):
+        return "OK"
+
+    def _c_select(self, db):
+        return "OK"
+
+    def _c_sadd(self, key, *members):
+        s = self.sets.setdefault(key, set())
+        before = len(s)
+        s.update(members)
+        return len(s) - before
+
+    def _c_srem(self, key, *members):
+        s = self.sets.get(key, set())
+        removed = len(s & set(members))
+        s.difference_update(members)
+        return removed
+
+    def _c_smembers(self, key):
+        return list(self.sets.get(key, ()))
+
+    def _c_scard(self, key):
+        return len(self.sets.get(key, ()))
+
+    def _c_sscan(self, key, cursor, *opts):
+        # 一次返回全部成员，游标直接归零
+        return [b"0", list(self.sets.get(key, ()))]
+
+    def _c_hset(self, key, *pairs):
+        h = self.hashes.setdefault(key, {})
+        added = 0
+        for i in range(0, len(pairs), 2):
+            added += pairs[i] not in h
+            h[pairs[i]] = pairs[i + 1]
+        return added
+
+    def _c_hdel(self, key, *fields):
+        h = self.hashes.get(key, {})
+        return sum(h.pop(f, None) is not None for f in fields)
+
+    def _c_hget(self, key, field):
+        return self.hashes.get(key, {}).get(field)
+
+    def _c_hgetall(self, key):
+        return [x for kv in self.hashes.get(key, {}).items() for x in kv]
+
+    def _c_del(self, *keys):
+        return sum((self.sets.pop(k, None) is not None) + (self.hashes.pop(k, None) is not None) for k in keys)
+
+    def _c_flushall(self, *args):
+        self.sets.clear()
+        self.hashes.clear()
+        return "OK"
+
+
+async def _serve(port: int):
+    server = FakeRedis(port=port)
+    await server.start()
+    print(f"fake redis listening on {server.url}")
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--port", type=int, default=6379)
+    try:
+        asyncio.run(_serve(ap.parse_args().port))
+    except KeyboardInterrupt:
+        pass
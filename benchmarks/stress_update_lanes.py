@@ -0,0 +1,121 @@
+"""更新车道压力测试：同一批混合流量（用户消息转发 + 管理员回复），分别以顺序处理（--concurrency 1）
+和车道并发处理运行，比较完成时间，并检查每个用户两个方向的消息顺序是否都保持。
+
+一部分用户的 chat 被设为“慢对端”（单独的高延迟），顺序处理时发给他们的回复会拖住所有人。
+
+用法：
+    python benchmarks/stress_update_lanes.py [--concurrency 1,64] [--users 200] [--rounds 5]
+                                             [--latency 0.01] [--slow-ratio 0.05] [--slow-latency 1.0]
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import bot  # noqa: E402
+from fake_bot_api import FakeBotAPI, message_update  # noqa: E402
+
+ADMIN_ID = 999
+USER_BASE = 10_000
+ANCHOR_BASE = 50_000  # 每个用户一条已转发的 admin 侧消息，管理员回复它
+
+
+async def run(concurrency: int, args, db_path: str) -> None:
+    rnd = random.Random(0)
+    users = [USER_BASE + u for u in range(args.users)]
+    slow = {uid: args.slow_latency for uid in users if rnd.random() < args.slow_ratio}
+    api = FakeBotAPI(latency=args.latency, chat_latency=slow)
+    await api.start()
+
+    bot.BOT_API_BASE_URL = api.base_url
+    db = bot.Database(db_path)
+    t = bot.Tenant(db, "123456:FAKE", ["admin"], settings={
+        "UPDATE_CONCURRENCY": concurrency,
+        "UPDATE_LANE_LIMIT": 10**6,
+        "RELAY_BATCH_WINDOW": 0,
+        # 测的是更新处理，不是出站限速：放开令牌桶，admin chat 允许并发
+        "OUTBOUND_RATE": 10**6,
+        "OUTBOUND_CONCURRENCY": 256,
+        "OUTBOUND_PER_CHAT": 8,
+        "OUTBOUND_QUEUE_LIMIT": 10**6,
+    })
+    t.init_db()
+    t.numeric_admin_ids.add(ADMIN_ID)
+    t.message_limiter = bot.FloodLimiter("消息", 10**9, 1)
+    for uid in users:
+        t.start_session(uid, ADMIN_ID)
+        t.admin_msgid_to_user[(ADMIN_ID, ANCHOR_BASE + uid)] = uid
+
+    relayed = defaultdict(list)   # user -> 按到达顺序的 user message_id（user -> admin）
+    replied = defaultdict(list)   # user -> 按到达顺序的 admin message_id（admin -> user）
+
+    def on_call(ts, method, params):
+        if method == "copyMessage":
+            if params.get("chat_id") == ADMIN_ID:
+                relayed[params.get("from_chat_id")].append(params.get("message_id"))
+            else:
+                replied[params.get("chat_id")].append(params.get("message_id"))
+
+    api.listeners.append(on_call)
+    app = t.build_application()
+    await app.initialize()
+    await t.post_init(app)
+    await app.updater.start_polling(poll_interval=0, timeout=1)
+    await app.start()
+
+    update_id = 0
+    admin_mid = 1_000_000
+    t0 = time.perf_counter()
+    for r in range(args.rounds):
+        for uid in users:
+            update_id += 1
+            api.updates.put_nowait(message_update(update_id, uid, r + 1, text=f"u{r}"))
+            update_id += 1
+            admin_mid += 1
+            upd = message_update(update_id, ADMIN_ID, admin_mid, text=f"a{r}", reply_to=ANCHOR_BASE + uid)
+            upd["message"]["from"]["username"] = "admin"
+            api.updates.put_nowait(upd)
+    total = 2 * args.rounds * len(users)
+    deadline = t0 + args.timeout
+    while sum(map(len, relayed.values())) + sum(map(len, replied.values())) < total and time.perf_counter() < deadline:
+        await asyncio.sleep(0.02)
+    elapsed = time.perf_counter() - t0
+    done = sum(map(len, relayed.values())) + sum(map(len, replied.values()))
+    ordered = all(v == sorted(v) for v in relayed.values()) and all(v == sorted(v) for v in replied.values())
+
+    await app.updater.stop()
+    await app.stop()
+    await t.post_stop(app)
+    await app.shutdown()
+    await t.post_shutdown(app)
+    db.close()
+    await api.stop()
+    print(f"[concurrency={concurrency}] {done}/{total} copies in {elapsed:.2f}s -> {done / elapsed:,.0f}/s, "
+          f"slow chats {len(slow)}, per-user order {'kept' if ordered else 'BROKEN'}")
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--concurrency", default="1,64")
+    ap.add_argument("--users", type=int, default=200)
+    ap.add_argument("--rounds", type=int, default=5)
+    ap.add_argument("--latency", type=float, default=0.01, help="假 API 每次调用的延迟（秒）")
+    ap.add_argument("--slow-ratio", type=float, default=0.05, help="慢对端用户的比例")
+    ap.add_argument("--slow-latency", type=float, default=1.0, help="慢对端 chat 的调用延迟（秒）")
+    ap.add_argument("--timeout", type=float, default=300.0)
+    args = ap.parse_args()
+
+    import logging
+    logging.getLogger().setLevel(logging.WARNING)
+    for c in map(int, args.concurrency.split(",")):
+        with tempfile.TemporaryDirectory() as tmp:
+            asyncio.run(run(c, args, os.path.join(tmp, "stress.db")))
+
+
+if __name__ == "__main__":
+    main()
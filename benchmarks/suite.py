@@ -0,0 +1,305 @@
+"""离线基准测试套件：bot 以 polling 模式连接本地假 Bot API（fake_bot_api.FakeBotAPI），
+按场景注入更新，统计吞吐、p50/p99 延迟和各 API 调用次数。
+
+场景：
+    relay      用户 -> 管理员转发洪峰（users x messages）
+    replies    管理员回复已转发的消息
+    admins     两个管理员各自回复同号消息（message_id 按聊天编号），检查回复送达正确的用户
+    reload     热加载移除一个管理员后，其名下会话迁移给剩下的管理员
+    apply      大量用户同时点击“申请”
+    broadcast  /broadcast 给 users 个活动用户
+    bans       一半被封禁的用户发消息（封禁检查路径）
+
+用法：
+    python benchmarks/suite.py [--scenario relay,replies,...] [--users 200] [--messages 5]
+                               [--latency 0.02] [--flood-ratio 0.01] [--window 0]
+
+延迟 = 更新进入 getUpdates 队列到 bot 发出对应 API 调用的时间。
+测的是处理能力而不是限流策略，因此套件会放开单用户限流。
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, Hashable, Optional
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import bot  # noqa: E402
+from fake_bot_api import FakeBotAPI, callback_update, message_update  # noqa: E402
+
+ADMIN_ID = 999
+USER_BASE = 10_000
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+class Run:
+    """一次场景运行：注入更新，用 API 调用匹配完成时间"""
+
+    def __init__(self, api: FakeBotAPI, match: Callable[[str, dict], list]):
+        self.api = api
+        self.match = match
+        self.started: Dict[Hashable, float] = {}
+        self.done: Dict[Hashable, float] = {}
+        self._next_update = 1
+        api.listeners.append(self._on_call)
+
+    def _on_call(self, ts: float, method: str, params: dict):
+        for key in self.match(method, params):
+            self.done.setdefault(key, ts)
+
+    def expect(self, key: Hashable, at: Optional[float] = None):
+        self.started[key] = at if at is not None else time.perf_counter()
+
+    def inject(self, update: dict):
+        update["update_id"] = self._next_update
+        self._next_update += 1
+        self.api.updates.put_nowait(update)
+
+    async def wait(self, timeout: float):
+        deadline = time.perf_counter() + timeout
+        while len(self.done.keys() & self.started.keys()) < len(self.started) and time.perf_counter() < deadline:
+            await asyncio.sleep(0.02)
+
+    def report(self, name: str, t_start: float):
+        lat = [self.done[k] - t for k, t in self.started.items() if k in self.done]
+        finished = max((self.done[k] for k in self.started if k in self.done), default=t_start)
+        elapsed = max(finished - t_start, 1e-9)
+        calls = ", ".join(f"{k}={v}" for k, v in sorted(self.api.counts.items()) if k not in ("getUpdates", "getMe", "getChat", "deleteWebhook"))
+        print(f"[{name}] completed {len(lat)}/{len(self.started)} in {elapsed:.2f}s -> {len(lat) / elapsed:,.0f}/s")
+        if lat:
+            print(f"[{name}] latency p50={statistics.median(lat) * 1e3:.1f}ms p99={percentile(lat, 0.99) * 1e3:.1f}ms")
+        print(f"[{name}] api calls: {calls}")
+
+
+# ----------------- SCENARIOS -----------------
+def copies_from(method: str, params: dict) -> list:
+    if method == "copyMessage":
+        return [(params.get("from_chat_id"), params.get("message_id"))]
+    if method == "copyMessages":
+        return [(params.get("from_chat_id"), mid) for mid in params.get("message_ids", [])]
+    return []
+
+
+async def scenario_relay(t, api, args):
+    for u in range(args.users):
+        t.start_session(USER_BASE + u, ADMIN_ID)
+    run = Run(api, copies_from)
+    t0 = time.perf_counter()
+    for i in range(args.messages):
+        for u in range(args.users):
+            uid = USER_BASE + u
+            run.expect((uid, i + 1))
+            run.inject(message_update(0, uid, i + 1, text=f"m{i}"))
+    await run.wait(args.timeout)
+    run.report("relay", t0)
+
+
+async def scenario_replies(t, api, args):
+    for u in range(args.users):
+        uid = USER_BASE + u
+        t.start_session(uid, ADMIN_ID)
+        t.admin_msgid_to_user[(ADMIN_ID, 50_000 + u)] = uid
+    run = Run(api, copies_from)
+    t0 = time.perf_counter()
+    mid = 100_000
+    for i in range(args.messages):
+        for u in range(args.users):
+            mid += 1
+            run.expect((ADMIN_ID, mid))
+            run.inject(message_update(0, ADMIN_ID, mid, text=f"r{i}", reply_to=50_000 + u))
+    await run.wait(args.timeout)
+    run.report("replies", t0)
+
+
+async def scenario_admins(t, api, args):
+    # 用户两两一组分给两个管理员；每组的两条转发在各自管理员聊天里拿到同一个 message_id
+    admins = (101, 202)
+    t.numeric_admin_ids.update(admins)
+
+    def match(method, params):
+        if method == "copyMessage" and params.get("from_chat_id") in admins:
+            return [(params.get("from_chat_id"), params.get("message_id"), params.get("chat_id"))]
+        return copies_from(method, params)
+
+    run = Run(api, match)
+    owner: Dict[tuple, int] = {}
+    t0 = time.perf_counter()
+    for r in range(max(1, args.users // 2)):
+        for aid in admins:
+            uid = USER_BASE + 2 * r + admins.index(aid)
+            t.start_session(uid, aid)
+            owner[(aid, r + 1)] = uid
+            run.expect((uid, 1))
+            run.inject(message_update(0, uid, 1))
+        await run.wait(args.timeout)
+    # 假 API 在请求到达时就记下调用，bot 要等响应回来才写映射
+    while not all(t.admin_msgid_to_user.cached(k)[1] for k in owner):
+        await asyncio.sleep(0.02)
+    mid = 100_000
+    for (aid, admin_mid), uid in owner.items():
+        mid += 1
+        run.expect((aid, mid, uid))
+        run.inject(message_update(0, aid, mid, text="r", reply_to=admin_mid))
+    await run.wait(args.timeout)
+    run.report("admins", t0)
+    misrouted = [k for k in run.done if k not in run.started]
+    print(f"[admins] replies {'ok' if not misrouted else f'MISROUTED {len(misrouted)}'}")
+
+
+async def scenario_reload(t, api, args):
+    alice, bob = 101, 202
+    t.admin_resolver.set_usernames(["alice", "bob"])
+    t.admin_resolver.learn("alice", alice)
+    t.admin_resolver.learn("bob", bob)
+    for u in range(args.users):
+        t.start_session(USER_BASE + u, bob if u % 2 else alice)
+    with tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False) as f:
+        f.write("alice\n")
+    t.admin_resolver.file = bot.AdminsFile(f.name)
+    t.admin_resolver.reload()
+    os.unlink(f.name)
+
+    def match(method, params):
+        return [k for k in copies_from(method, params) if params.get("chat_id") == alice]
+
+    run = Run(api, match)
+    t0 = time.perf_counter()
+    for u in range(args.users):
+        uid = USER_BASE + u
+        run.expect((uid, 1))
+        run.inject(message_update(0, uid, 1))
+    await run.wait(args.timeout)
+    run.report("reload", t0)
+    left = sum(t.session_router.admin_of(USER_BASE + u) == bob for u in range(args.users))
+    print(f"[reload] {'ok' if not left else f'{left} sessions still on removed admin'}")
+
+
+async def scenario_apply(t, api, args):
+    def match(method, params):
+        return [params.get("chat_id")] if method == "editMessageText" else []
+
+    run = Run(api, match)
+    t0 = time.perf_counter()
+    for u in range(args.users):
+        uid = USER_BASE + u
+        run.expect(uid)
+        run.inject(callback_update(0, uid, "user_apply"))
+    await run.wait(args.timeout)
+    await asyncio.sleep(0.5)  # 等管理员通知的后台 fan-out
+    run.report("apply", t0)
+
+
+async def scenario_broadcast(t, api, args):
+    for u in range(args.users):
+        t.start_session(USER_BASE + u, ADMIN_ID)
+
+    def match(method, params):
+        chat_id = params.get("chat_id")
+        return [chat_id] if method == "sendMessage" and chat_id != ADMIN_ID else []
+
+    run = Run(api, match)
+    t0 = time.perf_counter()
+    for u in range(args.users):
+        run.expect(USER_BASE + u, t0)
+    run.inject(message_update(0, ADMIN_ID, 1, text="/broadcast hello everyone"))
+    await run.wait(args.timeout)
+    run.report("broadcast", t0)
+
+
+async def scenario_bans(t, api, args):
+    for u in range(args.users):
+        uid = USER_BASE + u
+        if u % 2:
+            t.ban_user(uid)
+        else:
+            t.start_session(uid, ADMIN_ID)
+
+    def match(method, params):
+        if method == "sendMessage":
+            return [params.get("chat_id")]
+        return [k[0] for k in copies_from(method, params)]
+
+    run = Run(api, match)
+    t0 = time.perf_counter()
+    for u in range(args.users):
+        uid = USER_BASE + u
+        run.expect(uid)
+        run.inject(message_update(0, uid, 1))
+    await run.wait(args.timeout)
+    run.report("bans", t0)
+
+
+SCENARIOS = {
+    "relay": scenario_relay,
+    "replies": scenario_replies,
+    "admins": scenario_admins,
+    "reload": scenario_reload,
+    "apply": scenario_apply,
+    "broadcast": scenario_broadcast,
+    "bans": scenario_bans,
+}
+
+
+# ----------------- DRIVER -----------------
+async def run_scenario(name: str, args, db_path: str):
+    api = FakeBotAPI(latency=args.latency, flood_ratio=args.flood_ratio)
+    await api.start()
+
+    bot.BOT_API_BASE_URL = api.base_url
+    db = bot.Database(db_path)
+    # 每个场景使用全新的 Tenant
+    t = bot.Tenant(db, "123456:FAKE", ["admin"])
+    t.init_db()
+    t.numeric_admin_ids.add(ADMIN_ID)
+    t.message_limiter = bot.FloodLimiter("消息", 10**9, 1)
+    t.callback_limiter = bot.FloodLimiter("按钮", 10**9, 1)
+    if args.window is not None:
+        t.relay_batcher = bot.RelayBatcher(t, args.window)
+
+    app = t.build_application()
+    await app.initialize()
+    await t.post_init(app)
+    await app.updater.start_polling(poll_interval=0, timeout=1)
+    await app.start()
+    api.counts.clear()
+
+    try:
+        await SCENARIOS[name](t, api, args)
+    finally:
+        await app.updater.stop()
+        await app.stop()
+        await t.post_stop(app)
+        await app.shutdown()
+        await t.post_shutdown(app)
+        db.close()
+        await api.stop()
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--scenario", default=",".join(SCENARIOS))
+    ap.add_argument("--users", type=int, default=200)
+    ap.add_argument("--messages", type=int, default=5)
+    ap.add_argument("--latency", type=float, default=0.02, help="假 API 每次调用的延迟（秒）")
+    ap.add_argument("--flood-ratio", type=float, default=0.0, help="按比例返回 429 的概率")
+    ap.add_argument("--window", type=float, default=None, help="覆盖 RELAY_BATCH_WINDOW")
+    ap.add_argument("--timeout", type=float, default=120.0)
+    args = ap.parse_args()
+
+    import logging
+    logging.getLogger().setLevel(logging.WARNING)
+
+    for name in args.scenario.split(","):
+        with tempfile.TemporaryDirectory() as tmp:
+            asyncio.run(run_scenario(name, args, os.path.join(tmp, "suite.db")))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""webhook 模式端到端延迟测试：本地假 Bot API + 进程内 webhook，POST 录制的更新并测量
+从 POST 发出到 bot 调用 copyMessage(s) 把消息转给管理员的时间。不访问真实 Telegram。
+
+用法：
+    python benchmarks/webhook_replay.py [--updates recorded.jsonl] [--users 50] [--messages 20] [--rate 200]
+
+recorded.jsonl 每行一个 Telegram Update JSON；未提供时生成活动用户发文字消息的更新。
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+import httpx
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import bot  # noqa: E402
+from fake_bot_api import FakeBotAPI, message_update  # noqa: E402
+
+ADMIN_ID = 999
+SECRET = "replay-secret"
+PATH = "telegram"
+
+
+def synthetic_updates(n_users: int, per_user: int) -> list:
+    updates = []
+    uid_base = 10_000
+    for i in range(per_user):
+        for u in range(n_users):
+            updates.append(message_update(len(updates) + 1, uid_base + u, i + 1, text=f"msg {i}"))
+    return updates
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+async def replay(t, updates: list, rate: float):
+    api = FakeBotAPI()
+    await api.start()
+    delivered = {}
+
+    def on_call(ts, method, params):
+        if method == "copyMessage":
+            delivered[(params.get("from_chat_id"), params.get("message_id"))] = ts
+        elif method == "copyMessages":
+            for mid in params.get("message_ids", []):
+                delivered[(params.get("from_chat_id"), mid)] = ts
+
+    api.listeners.append(on_call)
+
+    bot.BOT_API_BASE_URL = api.base_url
+    bot.BOT_MODE = "webhook"  # 否则 post_init 会按 polling 先拉一遍积压
+    t.numeric_admin_ids.add(ADMIN_ID)
+    for upd in updates:
+        if "message" in upd:
+            t.start_session(upd["message"]["from"]["id"], ADMIN_ID)
+
+    app = t.build_application()
+    await app.initialize()
+    await t.post_init(app)
+    port = 18000 + os.getpid() % 1000
+    await app.updater.start_webhook(listen="127.0.0.1", port=port, url_path=PATH, secret_token=SECRET,
+                                    webhook_url=f"http://127.0.0.1:{port}/{PATH}")
+    await app.start()
+
+    sent = {}
+    post_latency = []
+    async with httpx.AsyncClient(headers={"X-Telegram-Bot-Api-Secret-Token": SECRET}) as client:
+        url = f"http://127.0.0.1:{port}/{PATH}"
+        start = time.perf_counter()
+        for i, upd in enumerate(updates):
+            delay = start + i / rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if "message" in upd:
+                m = upd["message"]
+                sent[(m["chat"]["id"], m["message_id"])] = time.perf_counter()
+            t0 = time.perf_counter()
+            r = await client.post(url, content=json.dumps(upd), headers={"Content-Type": "application/json"})
+            post_latency.append(time.perf_counter() - t0)
+            r.raise_for_status()
+
+    deadline = time.perf_counter() + 10
+    while len(delivered) < len(sent) and time.perf_counter() < deadline:
+        await asyncio.sleep(0.05)
+
+    await app.updater.stop()
+    await app.stop()
+    await t.post_stop(app)
+    await app.shutdown()
+    await t.post_shutdown(app)
+    await api.stop()
+
+    e2e = [delivered[k] - t for k, t in sent.items() if k in delivered]
+    print(f"updates={len(updates)} rate={rate:.0f}/s relay_batch_window={t.relay_batcher.window}s")
+    print(f"POST ack latency: p50={statistics.median(post_latency) * 1e3:.1f}ms p99={percentile(post_latency, 0.99) * 1e3:.1f}ms")
+    if e2e:
+        print(f"end-to-end (POST -> copy to admin): p50={statistics.median(e2e) * 1e3:.1f}ms "
+              f"p99={percentile(e2e, 0.99) * 1e3:.1f}ms delivered={len(e2e)}/{len(sent)}")
+    print("API calls: " + ", ".join(f"{k}={v}" for k, v in sorted(api.counts.items())))
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--updates", help="录制的更新（JSONL）")
+    ap.add_argument("--users", type=int, default=50)
+    ap.add_argument("--messages", type=int, default=20, help="每个用户的消息数（合成更新时）")
+    ap.add_argument("--rate", type=float, default=200.0, help="每秒 POST 的更新数")
+    ap.add_argument("--window", type=float, default=None, help="覆盖 RELAY_BATCH_WINDOW")
+    args = ap.parse_args()
+
+    if args.updates:
+        with open(args.updates, encoding="utf-8") as f:
+            updates = [json.loads(line) for line in f if line.strip()]
+    else:
+        updates = synthetic_updates(args.users, args.messages)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = bot.Database(os.path.join(tmp, "replay.db"))
+        t = bot.Tenant(db, "123456:FAKE", [])
+        t.init_db()
+        if args.window is not None:
+            t.relay_batcher = bot.RelayBatcher(t, args.window)
+        asyncio.run(replay(t, updates, args.rate))
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
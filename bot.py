@@ -1,194 +1,2673 @@
 
 import os
+import asyncio
+import contextlib
+import functools
+import heapq
+import importlib.util
+import io
+import itertools
+import json
 import logging
+import multiprocessing
+import re
+import socket
+import signal
 import sqlite3
-from typing import Dict, Set, Optional, List
+import tempfile
+import threading
+import time
+import types
+from datetime import timedelta
+from bisect import bisect_left, insort
+from collections import OrderedDict, deque
+from contextvars import ContextVar
+from urllib.parse import urlparse
+from typing import Callable, Dict, Set, Optional, List, Tuple, Iterable, Iterator
 
+import httpx
 from telegram import (
+    Bot,
     Update,
     InlineKeyboardMarkup,
     InlineKeyboardButton,
+    InputFile,
     Message,
 )
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError, TimedOut
 from telegram.ext import (
     ApplicationBuilder,
+    BaseRateLimiter,
+    BaseUpdateProcessor,
+    CallbackContext,
     ContextTypes,
     CommandHandler,
     CallbackQueryHandler,
     MessageHandler,
     filters,
 )
+from telegram.request import HTTPXRequest
 
 # ----------------- CONFIG -----------------
 # TOKEN: 推荐用环境变量 BOT_TOKEN（不会写到仓库里）
 BOT_TOKEN = os.environ.get("BOT_TOKEN") or "PUT_YOUR_BOT_TOKEN_HERE"
-# 管理员用户名（不带 @），可以放多个
-ADMIN_USERNAMES: List[str] = ["ap114514666"]
+# 管理员用户名（不带 @），可以放多个；也可用环境变量 ADMIN_USERNAMES（逗号分隔）覆盖
+ADMIN_USERNAMES: List[str] = [u.strip().lstrip("@") for u in os.environ.get("ADMIN_USERNAMES", "ap114514666").split(",") if u.strip()]
+# 可选：管理员列表文件（每行一个用户名），修改后无需重启，自动热加载
+ADMINS_FILE = os.environ.get("ADMINS_FILE", "")
 
-# sqlite db path for persistent ban list
-DB_PATH = "bot_state.db"
+# 运行模式：polling（默认）或 webhook
+BOT_MODE = os.environ.get("BOT_MODE", "polling").lower()
+# webhook 模式：监听地址/端口/路径，Telegram 访问的公网 URL（通常指向前置 HTTP 服务），
+# secret token（校验 X-Telegram-Bot-Api-Secret-Token 头），证书留空表示 TLS 由前置服务终止
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT") or os.environ.get("PORT") or "8443")
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "telegram")
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")
+WEBHOOK_CERT = os.environ.get("WEBHOOK_CERT", "")
+WEBHOOK_KEY = os.environ.get("WEBHOOK_KEY", "")
+# Bot API 地址，默认官方；可指向本地 Bot API 服务或测试用的假服务（形如 http://127.0.0.1:8081/bot）
+BOT_API_BASE_URL = os.environ.get("BOT_API_BASE_URL", "")
+# Bot API 的 HTTP 传输。发送请求（copy / send 等）和 getUpdates 长轮询各用一个连接池，长轮询不占发送的连接。
+# 发送连接池大小（多租户时为所有租户共用的大小）；等空闲连接的上限（秒，超过即报 Pool timeout）
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", "256"))
+# 连接池拆成几个小池（请求交给在途最少的那个）：httpcore 分配连接的开销随单个池里的并发成倍增长
+HTTP_POOL_SHARDS = int(os.environ.get("HTTP_POOL_SHARDS", "4"))
+HTTP_POOL_TIMEOUT = float(os.environ.get("HTTP_POOL_TIMEOUT", "5"))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_READ_TIMEOUT = float(os.environ.get("HTTP_READ_TIMEOUT", "5"))
+HTTP_WRITE_TIMEOUT = float(os.environ.get("HTTP_WRITE_TIMEOUT", "5"))
+# "1.1" 或 "2"；HTTP/2 需要 h2（pip install "python-telegram-bot[http2]"），没装时退回 1.1
+HTTP_VERSION = os.environ.get("HTTP_VERSION", "1.1")
+# 空闲时保留的长连接数（默认等于连接池大小）和空闲多久（秒）后关闭
+HTTP_KEEPALIVE = int(os.environ.get("HTTP_KEEPALIVE") or HTTP_POOL_SIZE)
+HTTP_KEEPALIVE_EXPIRY = float(os.environ.get("HTTP_KEEPALIVE_EXPIRY", "30"))
+
+# Prometheus 指标端点（/metrics），端口为 0 表示不开启
+METRICS_LISTEN = os.environ.get("METRICS_LISTEN", "0.0.0.0")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))
+
+# sqlite db path for persistent ban list / session state
+DB_PATH = os.environ.get("DB_PATH", "bot_state.db")
+# 表名前缀：多租户共用一个库时每个租户一套表（单 bot 部署留空，表名不变）
+DB_TABLE_PREFIX = os.environ.get("DB_TABLE_PREFIX", "")
+# 状态后端：sqlite（默认，DB_PATH）或 redis（多台机器共享时使用，REDIS_URL 形如 redis://:pass@host:6379/0）
+STATE_BACKEND = os.environ.get("STATE_BACKEND", "sqlite").lower()
+REDIS_URL = os.environ.get("REDIS_URL", "redis://127.0.0.1:6379/0")
+REDIS_PREFIX = os.environ.get("REDIS_PREFIX", "tgbot")
+# worker 进程数：>1 时主进程拉取更新，按用户 id 分片交给各 worker 处理（仅 polling 模式）
+WORKERS = int(os.environ.get("WORKERS", "1"))
+# 多进程时各 worker 重新加载封禁列表的间隔（秒）
+BAN_SYNC_INTERVAL = 5.0
+# 本进程是第几个 worker（由分片调度器在子进程里设置）
+WORKER_INDEX = 0
+# 多租户：JSON 配置文件，一个进程里跑多个 bot（见 MULTI-TENANT 一节）；为空时是普通的单 bot
+TENANTS_FILE = os.environ.get("TENANTS_FILE", "")
+# 回复映射（admin_msg_id -> user_id）在内存中最多保留的条数，更旧的只在 sqlite 中
+REPLY_MAP_HOT_SIZE = int(os.environ.get("REPLY_MAP_HOT_SIZE", "10000"))
+# 会话存档：双向转发的消息写入 DB_PATH 的 transcript 表（带全文索引），供 /search、/export 使用
+ARCHIVE_ENABLED = os.environ.get("ARCHIVE_ENABLED", "1") != "0"
+SEARCH_PAGE_SIZE = 5
+
+# 管理面板“查看申请 / 活动会话”每页显示的条数
+ADMIN_PAGE_SIZE = 8
+
+# 用户连续发送的消息（相册 / 连发）在这个时间窗口（秒）内合并成一次 copyMessages；0 表示逐条转发
+RELAY_BATCH_WINDOW = float(os.environ.get("RELAY_BATCH_WINDOW", "0.3"))
+
+# 更新处理：不同用户的更新最多 UPDATE_CONCURRENCY 个并发（1 表示逐个顺序处理），同一用户严格按顺序；
+# 每个用户最多积压 UPDATE_LANE_LIMIT 个未处理的更新
+UPDATE_CONCURRENCY = int(os.environ.get("UPDATE_CONCURRENCY", "64"))
+UPDATE_LANE_LIMIT = int(os.environ.get("UPDATE_LANE_LIMIT", "100"))
+
+# 出站调度：全局每秒调用上限（Telegram 约 30 条/秒）、全局并发、单个 chat 并发、
+# 每个优先级队列的长度上限（满了之后生产者等待）、每次调用最多尝试次数
+OUTBOUND_RATE = float(os.environ.get("OUTBOUND_RATE", "25"))
+OUTBOUND_CONCURRENCY = int(os.environ.get("OUTBOUND_CONCURRENCY", "16"))
+OUTBOUND_PER_CHAT = int(os.environ.get("OUTBOUND_PER_CHAT", "1"))
+OUTBOUND_QUEUE_LIMIT = int(os.environ.get("OUTBOUND_QUEUE_LIMIT", "1000"))
+OUTBOUND_MAX_ATTEMPTS = 5
+
+# 广播：并发 worker 数、进度刷新间隔（秒）
+BROADCAST_CONCURRENCY = int(os.environ.get("BROADCAST_CONCURRENCY", "10"))
+BROADCAST_PROGRESS_INTERVAL = 3.0
+
+# 新申请通知：最近 DIGEST_RATE_WINDOW 秒内的申请达到 DIGEST_THRESHOLD 个时改为汇总模式，每 DIGEST_INTERVAL 秒
+# 把新申请并入每个管理员的一条汇总消息（原地编辑）；DIGEST_THRESHOLD=0 表示总是逐条通知
+DIGEST_THRESHOLD = int(os.environ.get("DIGEST_THRESHOLD", "10"))
+DIGEST_RATE_WINDOW = 60.0
+DIGEST_INTERVAL = float(os.environ.get("DIGEST_INTERVAL", "5"))
+
+# 单用户限流：window 秒内最多 limit 条消息 / 按钮操作；FLOOD_BAN_STRIKES>0 时，
+# 累计在这么多个窗口里超限的用户会被自动封禁（0 表示不自动封禁）
+FLOOD_MSG_LIMIT = int(os.environ.get("FLOOD_MSG_LIMIT", "20"))
+FLOOD_MSG_WINDOW = float(os.environ.get("FLOOD_MSG_WINDOW", "10"))
+FLOOD_CB_LIMIT = int(os.environ.get("FLOOD_CB_LIMIT", "10"))
+FLOOD_CB_WINDOW = float(os.environ.get("FLOOD_CB_WINDOW", "10"))
+FLOOD_BAN_STRIKES = int(os.environ.get("FLOOD_BAN_STRIKES", "0"))
+
+# 过期：活动会话超过 SESSION_IDLE_TIMEOUT 秒没有消息往来自动结束，申请超过 PENDING_TTL 秒未处理自动撤销
+# （0 表示不过期）；过期通知每 EXPIRY_NOTICE_INTERVAL 秒合并发送一次
+SESSION_IDLE_TIMEOUT = float(os.environ.get("SESSION_IDLE_TIMEOUT", "0"))
+PENDING_TTL = float(os.environ.get("PENDING_TTL", "0"))
+EXPIRY_NOTICE_INTERVAL = 10.0
+
+# 停机后积压的更新（仅 polling）：启动时先全部取回并落盘，合并冗余后以每秒 CATCHUP_RATE 条回放，
+# 实时更新照常拉取、优先于回放；0 表示不做特殊处理（积压当作实时更新全速处理）
+CATCHUP_RATE = float(os.environ.get("CATCHUP_RATE", "20"))
 
 # ----------------- LOGGING -----------------
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 logger = logging.getLogger(__name__)
 
-# ----------------- IN-MEMORY STATE -----------------
-pending_requests: Set[int] = set()       # user ids waiting approval
-active_sessions: Set[int] = set()        # user ids connected
-admin_msgid_to_user: Dict[int, int] = {} # admin_msg_id -> user_id mapping
-user_last_admin_msgid: Dict[int, int] = {}  # user -> last admin message id
-
-# resolved numeric admin ids (may be empty until resolved or registered)
-numeric_admin_ids: Set[int] = set()
-
-# ----------------- SQLITE HELPERS (ban list) -----------------
-def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("CREATE TABLE IF NOT EXISTS banned (user_id INTEGER PRIMARY KEY)")
-    conn.commit()
-    conn.close()
-
-def ban_user_db(user_id: int):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("INSERT OR IGNORE INTO banned(user_id) VALUES (?)", (user_id,))
-    conn.commit()
-    conn.close()
-
-def unban_user_db(user_id: int):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("DELETE FROM banned WHERE user_id=?", (user_id,))
-    conn.commit()
-    conn.close()
-
-def is_banned_db(user_id: int) -> bool:
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT 1 FROM banned WHERE user_id=? LIMIT 1", (user_id,))
-    r = c.fetchone()
-    conn.close()
-    return r is not None
+class TenantLogAdapter(logging.LoggerAdapter):
+    """每个 bot 的日志：多租户时行首带上租户名，单 bot 时原样输出"""
+
+    def process(self, msg, kwargs):
+        name = self.extra["tenant"]
+        return (f"[{name}] {msg}" if name else msg), kwargs
+
+# ----------------- METRICS -----------------
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def _fmt_labels(names: Tuple[str, ...], values: tuple, *extra: str) -> str:
+    parts = [f'{n}="{v}"' for n, v in zip(names, values)]
+    parts += [e for e in extra if e]
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+class Histogram:
+    """Prometheus 风格直方图；每组标签一行计数：[各桶计数..., 超出最大桶, sum, count]"""
+
+    def __init__(self, name: str, help_text: str, label_names: Tuple[str, ...], buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self._series: Dict[tuple, List[float]] = {}
+
+    def observe(self, labels: tuple, value: float):
+        row = self._series.get(labels)
+        if row is None:
+            row = self._series[labels] = [0] * (len(self.buckets) + 3)
+        row[bisect_left(self.buckets, value)] += 1
+        row[-2] += value
+        row[-1] += 1
+
+    kind = "histogram"
+
+    def samples(self, const: str = "") -> List[str]:
+        out = []
+        for labels, row in self._series.items():
+            acc = 0
+            for le, n in zip(self.buckets, row):
+                acc += n
+                le_label = _fmt_labels(self.label_names, labels, const, 'le="%s"' % le)
+                out.append(f"{self.name}_bucket{le_label} {acc}")
+            inf_label = _fmt_labels(self.label_names, labels, const, 'le="+Inf"')
+            out.append(f"{self.name}_bucket{inf_label} {row[-1]}")
+            out.append(f"{self.name}_sum{_fmt_labels(self.label_names, labels, const)} {row[-2]}")
+            out.append(f"{self.name}_count{_fmt_labels(self.label_names, labels, const)} {row[-1]}")
+        return out
+
+class Counter:
+    def __init__(self, name: str, help_text: str, label_names: Tuple[str, ...]):
+        self.name = name
+        self.help = help_text
+        self.label_names = label_names
+        self._values: Dict[tuple, float] = {}
+
+    def inc(self, labels: tuple, n: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + n
+
+    kind = "counter"
+
+    def samples(self, const: str = "") -> List[str]:
+        return [f"{self.name}{_fmt_labels(self.label_names, k, const)} {v}" for k, v in self._values.items()]
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: List[object] = []
+        self._callbacks: List[Tuple[str, str, str, object]] = []  # (name, help, kind, fn)
+        # 附加的子注册表（多租户时每个租户一个），输出时带上各自的常量标签
+        self._children: List[Tuple["MetricsRegistry", str]] = []
+
+    def histogram(self, name: str, help_text: str, label_names: Tuple[str, ...] = ()) -> Histogram:
+        h = Histogram(name, help_text, label_names)
+        self._metrics.append(h)
+        return h
+
+    def counter(self, name: str, help_text: str, label_names: Tuple[str, ...] = ()) -> Counter:
+        c = Counter(name, help_text, label_names)
+        self._metrics.append(c)
+        return c
+
+    def gauge(self, name: str, help_text: str, fn):
+        """采集时调用 fn() 取值，热路径上没有任何开销"""
+        self._callbacks.append((name, help_text, "gauge", fn))
+
+    def counter_fn(self, name: str, help_text: str, fn):
+        """同 gauge，但 fn() 是只增不减的累计值，按 counter 输出（name 以 _total 结尾）"""
+        self._callbacks.append((name, help_text, "counter", fn))
+
+    def attach(self, registry: "MetricsRegistry", const: str):
+        self._children.append((registry, const))
+
+    def families(self, const: str = "") -> Iterator[Tuple[str, str, str, List[str]]]:
+        for m in self._metrics:
+            yield m.name, m.help, m.kind, m.samples(const)
+        for name, help_text, kind, fn in self._callbacks:
+            yield name, help_text, kind, [f"{name}{_fmt_labels((), (), const)} {fn()}"]
+
+    def render(self) -> str:
+        # 同名指标只写一次 HELP / TYPE，子注册表的样本并入同一组
+        grouped: Dict[str, Tuple[str, str, List[str]]] = {}
+        for registry, const in [(self, "")] + self._children:
+            for name, help_text, kind, samples in registry.families(const):
+                grouped.setdefault(name, (help_text, kind, []))[2].extend(samples)
+        out: List[str] = []
+        for name, (help_text, kind, samples) in grouped.items():
+            out += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"] + samples
+        return "\n".join(out) + "\n"
+
+# 进程级的注册表：SQLite 和连接池属于进程（多租户时由所有租户共用），/metrics 输出它；
+# 每个 bot 的 handler / Bot API 指标在各自 Tenant.metrics 里，附加到这里（多租户时带 tenant 标签）
+metrics = MetricsRegistry()
+db_latency = metrics.histogram("bot_sqlite_seconds", "SQLite helper latency", ("op",))
+http_pool_wait = metrics.histogram("bot_http_pool_wait_seconds", "Time Bot API requests waited for a pooled connection", ("pool",))
+
+def instrument_handler(fn, latency: Histogram, errors: Counter):
+    """包装 handler：记录耗时和异常次数"""
+    name = fn.__name__
+
+    @functools.wraps(fn)
+    async def wrapper(update, context):
+        t0 = time.perf_counter()
+        try:
+            return await fn(update, context)
+        except Exception:
+            errors.inc((name,))
+            raise
+        finally:
+            latency.observe((name,), time.perf_counter() - t0)
+    return wrapper
+
+def timed_db(op: str):
+    def deco(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            t0 = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                db_latency.observe((op,), time.perf_counter() - t0)
+        return wrapper
+    return deco
+
+class InstrumentedRequest(HTTPXRequest):
+    """所有 Bot API 调用都经过这里：按方法名把耗时和错误码记到所属 bot 的 latency / errors"""
+
+    def __init__(self, *args, latency: Histogram, errors: Counter, **kwargs):
+        self.latency = latency
+        self.errors = errors
+        super().__init__(*args, **kwargs)
+
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        t0 = time.perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+        except Exception as e:
+            self.errors.inc((api_method, type(e).__name__))
+            raise
+        finally:
+            self.latency.observe((api_method,), time.perf_counter() - t0)
+        if code >= 400:
+            self.errors.inc((api_method, str(code)))
+        return code, payload
+
+class ShardedPoolTransport(httpx.AsyncBaseTransport):
+    """Bot API 的传输层：连接池拆成 shards 个小池，每个请求交给在途请求最少的那个，并记录等池时间。
+
+    httpcore 每次分配连接都要把排队的请求和池里的连接两两扫一遍（还要检查 socket 是否可读），
+    几十个并发落在同一个池里时 CPU 开销成倍上升；拆成几个小池后每次扫描的规模小得多。
+    等池时间 = 进入传输层到 httpcore 的第一个 trace 事件（新建连接时是 connect_tcp，
+    复用长连接时是 send_request_headers），连接池本身不产生事件"""
+
+    def __init__(self, pool: str, shards: int, limits: httpx.Limits, http2: bool):
+        per_shard = -(-limits.max_connections // shards)
+        shard_limits = httpx.Limits(
+            max_connections=per_shard,
+            max_keepalive_connections=min(limits.max_keepalive_connections, per_shard),
+            keepalive_expiry=limits.keepalive_expiry,
+        )
+        self.pool = pool
+        self._shards = [httpx.AsyncHTTPTransport(limits=shard_limits, http1=not http2, http2=http2) for _ in range(shards)]
+        self._inflight = [0] * shards
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        t0 = time.perf_counter()
+        acquired = False
+
+        async def trace(event: str, info: dict):
+            nonlocal acquired
+            if not acquired:
+                acquired = True
+                http_pool_wait.observe((self.pool,), time.perf_counter() - t0)
+
+        request.extensions["trace"] = trace
+        # 在途数只算到拿到响应头为止；Bot API 的响应体很小，httpx 随即读完
+        i = min(range(len(self._shards)), key=self._inflight.__getitem__)
+        self._inflight[i] += 1
+        try:
+            return await self._shards[i].handle_async_request(request)
+        finally:
+            self._inflight[i] -= 1
+            if not acquired:
+                # Pool timeout / 取消：等到放弃为止的时间也算
+                http_pool_wait.observe((self.pool,), time.perf_counter() - t0)
+
+    async def aclose(self):
+        for shard in self._shards:
+            await shard.aclose()
+
+class SharedTransport(httpx.AsyncBaseTransport):
+    """多租户时宿主的连接池：各租户的 HTTPXRequest 经 httpx_kwargs 拿到的是这个包装。
+    租户关闭自己的 httpx client 时会连带关闭 transport，这里的 aclose 什么都不做，
+    真正的连接池由宿主在所有租户停止后关闭"""
+
+    def __init__(self, inner: httpx.AsyncBaseTransport):
+        self.inner = inner
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        return await self.inner.handle_async_request(request)
+
+    async def aclose(self):
+        pass
+
+@functools.lru_cache(maxsize=None)
+def http_version() -> str:
+    if HTTP_VERSION in ("2", "2.0") and importlib.util.find_spec("h2") is None:
+        logger.warning('HTTP_VERSION=2 需要 h2（pip install "python-telegram-bot[http2]"），改用 HTTP/1.1')
+        return "1.1"
+    return HTTP_VERSION
+
+def http_limits(pool_size: int) -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=pool_size,
+        max_keepalive_connections=min(HTTP_KEEPALIVE, pool_size),
+        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+    )
+
+def http_transport(pool: str, pool_size: int) -> ShardedPoolTransport:
+    """分片并记录等池时间的传输层。自带 transport 时 httpx 不再使用 client 上的 limits / http2，所以都设在这里"""
+    shards = max(1, min(HTTP_POOL_SHARDS, pool_size))
+    return ShardedPoolTransport(pool, shards, http_limits(pool_size), http2=http_version() != "1.1")
+
+def http_request_kwargs(pool: str, pool_size: int, transport: Optional[httpx.AsyncBaseTransport] = None) -> dict:
+    """HTTPXRequest 的参数：连接池大小、超时、HTTP 版本、长连接和传输层。
+    不传 transport 时新建一个，归这个 HTTPXRequest 所有、随它关闭；多租户时传入宿主连接池的 SharedTransport"""
+    version = http_version()
+    limits = http_limits(pool_size)
+    if transport is None:
+        transport = http_transport(pool, pool_size)
+    return dict(
+        connection_pool_size=pool_size,
+        connect_timeout=HTTP_CONNECT_TIMEOUT,
+        read_timeout=HTTP_READ_TIMEOUT,
+        write_timeout=HTTP_WRITE_TIMEOUT,
+        pool_timeout=HTTP_POOL_TIMEOUT,
+        http_version=version,
+        httpx_kwargs={"transport": transport, "limits": limits},
+    )
+
+async def _serve_metrics(registry: MetricsRegistry, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        parts = request_line.decode(errors="replace").split()
+        if len(parts) >= 2 and parts[1].split("?")[0] == "/metrics":
+            body = registry.render().encode()
+            head = "HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4"
+        else:
+            body = b"not found\n"
+            head = "HTTP/1.1 404 Not Found\r\nContent-Type: text/plain"
+        writer.write(f"{head}\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+        await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+async def start_metrics_server(registry: Optional[MetricsRegistry] = None) -> Optional[asyncio.AbstractServer]:
+    if not METRICS_PORT:
+        return None
+    handler = functools.partial(_serve_metrics, registry or metrics)
+    server = await asyncio.start_server(handler, METRICS_LISTEN, METRICS_PORT)
+    logger.info(f"Prometheus metrics on http://{METRICS_LISTEN}:{METRICS_PORT}/metrics")
+    return server
+
+# ----------------- SQLITE HELPERS -----------------
+class Database:
+    """一个 SQLite 文件的共享长连接（WAL 模式）和锁，避免每次查询都 connect/close。
+    多租户时所有租户共用宿主的一个（同一时刻只有一个写事务），由创建它的一方最后关闭"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def get(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            # 多个 worker 进程共用同一个库时，写锁冲突等待而不是立即报错
+            conn.execute("PRAGMA busy_timeout=5000")
+            self._conn = conn
+        return self._conn
+
+    def close(self):
+        if self._conn is not None:
+            with self.lock:
+                self._conn.close()
+            self._conn = None
+
+# ----------------- STATE BACKENDS -----------------
+class StateBackend:
+    """会话 / 申请 / 回复映射 / 封禁的共享存储。多个 worker 进程连接同一个后端。
+
+    命名空间分两种：集合（pending、active、banned）和映射（admin_msg_map、
+    session_admin、admin_ids）。写操作是逻辑操作元组：
+    ("add", ns, member)、("discard", ns, member)、("set", ns, key, value)、("del", ns, key)。
+    admin_msg_map 的 key 是 (admin_chat_id, admin_msg_id)：message_id 只在各自的聊天里唯一"""
+
+    SETS = ("pending", "active", "banned")
+    MAPS = ("admin_msg_map", "session_admin", "admin_ids")
+    TEXT_KEYS = ("admin_ids",)
+    PAIR_KEYS = ("admin_msg_map",)
+
+    def init(self):
+        pass
+
+    def apply(self, ops: List[tuple]):
+        raise NotImplementedError
+
+    def members(self, ns: str) -> List[int]:
+        raise NotImplementedError
+
+    def items(self, ns: str, newest: Optional[int] = None) -> List[tuple]:
+        """映射的全部条目；newest=N 时只取 key 最大的 N 条（按 key 倒序）"""
+        raise NotImplementedError
+
+    def get(self, ns: str, key) -> Optional[int]:
+        raise NotImplementedError
+
+    def count(self, ns: str) -> int:
+        """集合的成员数（不读出成员）"""
+        raise NotImplementedError
+
+    def bulk(self, op: str, ns: str, members: Iterable[int]):
+        """集合的批量 add / discard：members 可以是生成器，边读边写，不整体放进内存"""
+        raise NotImplementedError
+
+    def iter_members(self, ns: str) -> Iterator[int]:
+        """逐批遍历集合（用于导出），不一次性读入"""
+        raise NotImplementedError
+
+    def snapshot(self):
+        """启动时批量读取用的上下文（SQLite 下是一个读事务）"""
+        return contextlib.nullcontext()
+
+    def close(self):
+        pass
+
+class SQLiteStateBackend(StateBackend):
+    """bot_state.db（WAL 模式，多进程可同时打开）。连接归 Database 所有，close 不关闭它"""
+
+    COLUMNS = {
+        "pending": ("user_id", None),
+        "active": ("user_id", None),
+        "banned": ("user_id", None),
+        "admin_msg_map": (("admin_chat_id", "admin_msg_id"), "user_id"),
+        "session_admin": ("user_id", "admin_id"),
+        "admin_ids": ("username", "user_id"),
+    }
+    SQL = {
+        "add": "INSERT OR IGNORE INTO {t}({k}) VALUES (?)",
+        "discard": "DELETE FROM {t} WHERE {where}",
+        "set": "INSERT OR REPLACE INTO {t}({k}, {v}) VALUES ({q}, ?)",
+        "del": "DELETE FROM {t} WHERE {where}",
+    }
+
+    def __init__(self, db: Database, table_prefix: str = ""):
+        self.db = db
+        self.table_prefix = table_prefix
+
+    def init(self):
+        conn = self.db.get()
+        with self.db.lock:
+            self._drop_legacy_reply_map(conn)
+            for ns, (k, v) in self.COLUMNS.items():
+                if ns in self.PAIR_KEYS:
+                    cols = ", ".join(f"{c} INTEGER NOT NULL" for c in k) + f", {v} INTEGER NOT NULL, PRIMARY KEY ({', '.join(k)})"
+                else:
+                    ktype = "TEXT" if ns in self.TEXT_KEYS else "INTEGER"
+                    cols = f"{k} {ktype} PRIMARY KEY" + (f", {v} INTEGER NOT NULL" if v else "")
+                conn.execute(f"CREATE TABLE IF NOT EXISTS {self._table(ns)} ({cols})")
+            conn.commit()
+
+    def _drop_legacy_reply_map(self, conn: sqlite3.Connection):
+        # 旧表只按 admin_msg_id 记映射，不知道消息在哪个管理员的聊天里，无法换算成新 key
+        table = self._table("admin_msg_map")
+        cols = [r[1] for r in conn.execute(f"PRAGMA table_info({table})")]
+        if cols and "admin_chat_id" not in cols:
+            n = conn.execute(f"SELECT count(*) FROM {table}").fetchone()[0]
+            conn.execute(f"DROP TABLE {table}")
+            logger.warning(f"{table} 是旧格式（不含 admin_chat_id），已丢弃 {n} 条回复映射")
+
+    def _table(self, ns: str) -> str:
+        return self.table_prefix + ns
+
+    def _key_columns(self, ns: str) -> Tuple[str, ...]:
+        k = self.COLUMNS[ns][0]
+        return k if ns in self.PAIR_KEYS else (k,)
+
+    def _sql(self, op: str, ns: str) -> str:
+        _, v = self.COLUMNS[ns]
+        cols = self._key_columns(ns)
+        return self.SQL[op].format(t=self._table(ns), k=", ".join(cols), v=v, q=", ".join("?" * len(cols)),
+                                   where=" AND ".join(f"{c}=?" for c in cols))
+
+    def _params(self, ns: str, key, *rest) -> tuple:
+        return (*key, *rest) if ns in self.PAIR_KEYS else (key, *rest)
+
+    def apply(self, ops: List[tuple]):
+        """一个事务内写入；连续相同的 (op, ns) 合并为 executemany"""
+        conn = self.db.get()
+        with self.db.lock:
+            i = 0
+            while i < len(ops):
+                op, ns = ops[i][0], ops[i][1]
+                j = i
+                while j < len(ops) and ops[j][0] == op and ops[j][1] == ns:
+                    j += 1
+                conn.executemany(self._sql(op, ns), [self._params(ns, *o[2:]) for o in ops[i:j]])
+                i = j
+            conn.commit()
+
+    def members(self, ns: str) -> List[int]:
+        k, _ = self.COLUMNS[ns]
+        with self.db.lock:
+            return [r[0] for r in self.db.get().execute(f"SELECT {k} FROM {self._table(ns)} ORDER BY {k}")]
+
+    def items(self, ns: str, newest: Optional[int] = None) -> List[tuple]:
+        _, v = self.COLUMNS[ns]
+        cols = self._key_columns(ns)
+        sql = f"SELECT {', '.join(cols)}, {v} FROM {self._table(ns)}"
+        if newest is not None:
+            sql += f" ORDER BY {cols[-1]} DESC LIMIT {int(newest)}"
+        with self.db.lock:
+            rows = self.db.get().execute(sql).fetchall()
+        if ns in self.PAIR_KEYS:
+            return [(tuple(r[:-1]), r[-1]) for r in rows]
+        return rows
+
+    def get(self, ns: str, key) -> Optional[int]:
+        _, v = self.COLUMNS[ns]
+        where = " AND ".join(f"{c}=?" for c in self._key_columns(ns))
+        with self.db.lock:
+            row = self.db.get().execute(f"SELECT {v} FROM {self._table(ns)} WHERE {where}", self._params(ns, key)).fetchone()
+        return row[0] if row else None
+
+    def count(self, ns: str) -> int:
+        with self.db.lock:
+            return self.db.get().execute(f"SELECT count(*) FROM {self._table(ns)}").fetchone()[0]
+
+    def bulk(self, op: str, ns: str, members: Iterable[int]):
+        """一次 executemany、一个事务"""
+        conn = self.db.get()
+        with self.db.lock:
+            conn.executemany(self._sql(op, ns), ((m,) for m in members))
+            conn.commit()
+
+    def iter_members(self, ns: str) -> Iterator[int]:
+        # 独立连接迭代游标，不长时间占用共享连接
+        k, _ = self.COLUMNS[ns]
+        conn = sqlite3.connect(self.db.path)
+        try:
+            for (member,) in conn.execute(f"SELECT {k} FROM {self._table(ns)} ORDER BY {k}"):
+                yield member
+        finally:
+            conn.close()
+
+    @contextlib.contextmanager
+    def snapshot(self):
+        conn = self.db.get()
+        with self.db.lock:
+            conn.execute("BEGIN")
+        try:
+            yield
+        finally:
+            with self.db.lock:
+                conn.execute("COMMIT")
+
+class RespError(Exception):
+    pass
+
+class RespClient:
+    """极简的同步 Redis（RESP2）客户端，只用到集合 / 哈希的几条命令，省去额外依赖；
+    支持流水线，线程安全"""
+
+    def __init__(self, url: str):
+        u = urlparse(url)
+        self.host = u.hostname or "127.0.0.1"
+        self.port = u.port or 6379
+        self.db = int((u.path or "/").lstrip("/") or 0)
+        self.password = u.password
+        self._sock: Optional[socket.socket] = None
+        self._file = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _encode(cmd: tuple) -> bytes:
+        out = [b"*%d\r\n" % len(cmd)]
+        for arg in cmd:
+            b = arg if isinstance(arg, bytes) else str(arg).encode()
+            out.append(b"$%d\r\n%s\r\n" % (len(b), b))
+        return b"".join(out)
+
+    def _read(self):
+        line = self._file.readline()
+        if not line:
+            raise ConnectionError("redis connection closed")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b"+":
+            return rest.decode()
+        if kind == b"-":
+            return RespError(rest.decode())
+        if kind == b":":
+            return int(rest)
+        if kind == b"$":
+            n = int(rest)
+            return None if n < 0 else self._file.read(n + 2)[:-2]
+        if kind == b"*":
+            n = int(rest)
+            return None if n < 0 else [self._read() for _ in range(n)]
+        raise ConnectionError(f"unexpected redis reply: {line!r}")
+
+    def _roundtrip(self, cmds: List[tuple]) -> list:
+        self._sock.sendall(b"".join(self._encode(c) for c in cmds))
+        replies = [self._read() for _ in cmds]
+        for r in replies:
+            if isinstance(r, RespError):
+                raise r
+        return replies
+
+    def pipeline(self, cmds: List[tuple]) -> list:
+        with self._lock:
+            if self._sock is None:
+                self._sock = socket.create_connection((self.host, self.port), timeout=10)
+                self._file = self._sock.makefile("rb")
+                setup = ([("AUTH", self.password)] if self.password else []) + ([("SELECT", self.db)] if self.db else [])
+                if setup:
+                    self._roundtrip(setup)
+            try:
+                return self._roundtrip(cmds)
+            except (OSError, ConnectionError):
+                self._close()
+                raise
+
+    def execute(self, *cmd):
+        return self.pipeline([cmd])[0]
+
+    def _close(self):
+        if self._sock is not None:
+            self._sock.close()
+        self._sock = None
+        self._file = None
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+class RedisStateBackend(StateBackend):
+    """集合用 SADD/SREM，映射用 HSET/HDEL，key 为 <prefix>:<ns>；
+    admin_msg_map 的 field 是 "<admin_chat_id>:<admin_msg_id>"（旧格式只有 admin_msg_id，读取时忽略）"""
+
+    COMMANDS = {"add": "SADD", "discard": "SREM", "set": "HSET", "del": "HDEL"}
+    BULK_CHUNK = 100
+
+    def __init__(self, url: str, prefix: str):
+        self.client = RespClient(url)
+        self.prefix = prefix
+
+    def _key(self, ns: str) -> str:
+        return f"{self.prefix}:{ns}"
+
+    def _encode_key(self, ns: str, key):
+        return f"{key[0]}:{key[1]}" if ns in self.PAIR_KEYS else key
+
+    def _decode_key(self, ns: str, raw: bytes):
+        if ns in self.PAIR_KEYS:
+            chat, sep, msg = raw.partition(b":")
+            return (int(chat), int(msg)) if sep else None
+        return raw.decode() if ns in self.TEXT_KEYS else int(raw)
+
+    def init(self):
+        self.client.execute("PING")
+
+    def apply(self, ops: List[tuple]):
+        if ops:
+            self.client.pipeline([(self.COMMANDS[o[0]], self._key(o[1]), self._encode_key(o[1], o[2])) + tuple(o[3:]) for o in ops])
+
+    def members(self, ns: str) -> List[int]:
+        return sorted(int(m) for m in self.client.execute("SMEMBERS", self._key(ns)))
+
+    def items(self, ns: str, newest: Optional[int] = None) -> List[tuple]:
+        flat = self.client.execute("HGETALL", self._key(ns))
+        pairs = [(self._decode_key(ns, flat[i]), int(flat[i + 1])) for i in range(0, len(flat), 2)]
+        pairs = [p for p in pairs if p[0] is not None]
+        if newest is not None:
+            order = (lambda p: p[0][1]) if ns in self.PAIR_KEYS else None
+            pairs = sorted(pairs, key=order, reverse=True)[:newest]
+        return pairs
+
+    def get(self, ns: str, key) -> Optional[int]:
+        v = self.client.execute("HGET", self._key(ns), self._encode_key(ns, key))
+        return int(v) if v is not None else None
+
+    def count(self, ns: str) -> int:
+        return self.client.execute("SCARD", self._key(ns))
+
+    def bulk(self, op: str, ns: str, members: Iterable[int]):
+        """每 BULK_CHUNK 个成员一条 SADD / SREM，BULK_CHUNK 条命令一次流水线"""
+        cmd, key = self.COMMANDS[op], self._key(ns)
+        it = iter(members)
+        while True:
+            cmds = []
+            for _ in range(self.BULK_CHUNK):
+                chunk = tuple(itertools.islice(it, self.BULK_CHUNK))
+                if not chunk:
+                    break
+                cmds.append((cmd, key) + chunk)
+            if not cmds:
+                return
+            self.client.pipeline(cmds)
+
+    def iter_members(self, ns: str) -> Iterator[int]:
+        cursor = b"0"
+        while True:
+            cursor, batch = self.client.execute("SSCAN", self._key(ns), cursor, "COUNT", 1000)
+            for m in batch:
+                yield int(m)
+            if cursor == b"0":
+                return
+
+    def close(self):
+        self.client.close()
+
+def make_state_backend(db: Database, table_prefix: str = "", redis_prefix: str = REDIS_PREFIX) -> StateBackend:
+    if STATE_BACKEND == "redis":
+        return RedisStateBackend(REDIS_URL, redis_prefix)
+    if STATE_BACKEND != "sqlite":
+        raise ValueError(f"未知的 STATE_BACKEND: {STATE_BACKEND}")
+    return SQLiteStateBackend(db, table_prefix)
+
+# ----------------- BAN INDEX -----------------
+class BanIndex:
+    """banned 集合的内存索引：启动时一次性加载，查询只走内存，写入直写后端"""
+
+    def __init__(self, log: logging.LoggerAdapter):
+        self.log = log
+        self._ids: Set[int] = set()
+
+    def load(self, backend: StateBackend):
+        self._ids = set(backend.members("banned"))
+        self.log.info(f"已加载 {len(self._ids)} 个封禁用户")
+
+    def add(self, backend: StateBackend, user_id: int):
+        backend.apply([("add", "banned", user_id)])
+        self._ids.add(user_id)
+
+    def remove(self, backend: StateBackend, user_id: int):
+        backend.apply([("discard", "banned", user_id)])
+        self._ids.discard(user_id)
+
+    def add_many(self, backend: StateBackend, user_ids: Iterable[int]) -> int:
+        """流式批量封禁：只把新 id 交给后端的一次批量写入，返回新增个数"""
+        before = len(self._ids)
+
+        def fresh():
+            for uid in user_ids:
+                if uid not in self._ids:
+                    self._ids.add(uid)
+                    yield uid
+
+        backend.bulk("add", "banned", fresh())
+        return len(self._ids) - before
+
+    def remove_many(self, backend: StateBackend, user_ids: Iterable[int]) -> int:
+        before = len(self._ids)
+
+        def present():
+            for uid in user_ids:
+                if uid in self._ids:
+                    self._ids.discard(uid)
+                    yield uid
+
+        backend.bulk("discard", "banned", present())
+        return before - len(self._ids)
+
+    async def sync_forever(self, backend: StateBackend, interval: float, on_change):
+        """多进程时其它 worker 的封禁 / 解封只写到后端：定期重新加载，有变化时调用 on_change
+        （清掉本进程里被封用户的会话）"""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                ids = set(await asyncio.to_thread(backend.members, "banned"))
+            except Exception:
+                self.log.exception("同步封禁列表失败")
+                continue
+            if ids != self._ids:
+                self._ids = ids
+                on_change()
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._ids
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+def iter_user_ids(lines: Iterable[str], bad: List[str]) -> Iterator[int]:
+    """从 CSV / 每行一个 / 空格分隔的文本里逐个取出 user_id；表头等非数字项记到 bad"""
+    for line in lines:
+        for token in line.replace(",", " ").replace(";", " ").split():
+            try:
+                yield int(token)
+            except ValueError:
+                bad.append(token)
+
+# ----------------- STATE STORE (sessions) -----------------
+class WriteBehindQueue:
+    """写后批量落盘：调用方只把条目追加到内存队列，后台任务每 interval 秒攒一批，
+    在线程中调用 _write 写入（热路径上不等待 fsync / 网络）"""
+
+    def __init__(self, interval: float, log: logging.LoggerAdapter):
+        self.interval = interval
+        self.log = log
+        self._items: List[tuple] = []
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        # 从交换缓冲区到写完后端全程持有：后台线程和事件循环里的 flush_sync 可能同时刷，
+        # 必须按交换的先后提交，否则较新的 discard 可能先于较旧的 add 落盘
+        self._flush_lock = threading.Lock()
+
+    def _write(self, items: List[tuple]):
+        raise NotImplementedError
+
+    def record(self, *item):
+        self._items.append(item)
+        if self._wakeup is not None and len(self._items) == 1:
+            self._wakeup.set()
+
+    def flush_sync(self):
+        with self._flush_lock:
+            items, self._items = self._items, []
+            if items:
+                self._write(items)
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            await asyncio.sleep(self.interval)  # 攒批
+            self._wakeup.clear()
+            try:
+                await asyncio.to_thread(self.flush_sync)
+            except Exception:
+                self.log.exception(f"{type(self).__name__} 写入失败")
+
+    def start(self):
+        self._wakeup = asyncio.Event()
+        if self._items:
+            self._wakeup.set()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self.flush_sync()
+
+class StateStore(WriteBehindQueue):
+    """会话状态持久化：内存结构是本进程的读路径，修改只记录为逻辑操作，
+    批量写入状态后端"""
+
+    FLUSH_INTERVAL = 0.2  # seconds
+
+    def __init__(self, log: logging.LoggerAdapter):
+        super().__init__(self.FLUSH_INTERVAL, log)
+        self.backend: Optional[StateBackend] = None
+
+    def load(self, views: Dict[str, object]):
+        """启动时批量读取后端，重建内存视图（不经过写队列）"""
+        with self.backend.snapshot():
+            for view in views.values():
+                view._load(self.backend)
+        self.log.info("已恢复会话状态：" + ", ".join(f"{t}={len(v)}" for t, v in views.items()))
+
+    @timed_db("state_flush")
+    def _write(self, ops: List[tuple]):
+        self.backend.apply(ops)
+
+class PersistentSet(set):
+    """所有修改都写入 state store 的 set（都归结为 add/discard）；
+    同时维护一个有序列表，分页时直接切片"""
+
+    GLOBAL_TTL = 2.0  # seconds，多进程时 global_members 读后端的结果缓存这么久
+
+    def __init__(self, store: StateStore, ns: str):
+        super().__init__()
+        self._store = store
+        self.ns = ns
+        self._sorted: List[int] = []
+        self._global: Optional[Tuple[float, List[int]]] = None  # (过期时刻, 全部成员)
+
+    def _load(self, backend: StateBackend):
+        super().update(backend.members(self.ns))
+        self._sorted = sorted(self)
+
+    def add(self, item: int):
+        if item not in self:
+            super().add(item)
+            insort(self._sorted, item)
+            self._global = None
+            self._store.record("add", self.ns, item)
+
+    def discard(self, item: int):
+        if item in self:
+            super().discard(item)
+            del self._sorted[bisect_left(self._sorted, item)]
+            self._global = None
+            self._store.record("discard", self.ns, item)
+
+    def remove(self, item: int):
+        if item not in self:
+            raise KeyError(item)
+        self.discard(item)
+
+    def pop(self) -> int:
+        if not self:
+            raise KeyError("pop from an empty set")
+        item = self._sorted[-1]
+        self.discard(item)
+        return item
+
+    def clear(self):
+        for item in list(self._sorted):
+            self.discard(item)
+
+    def update(self, *others: Iterable[int]):
+        for other in others:
+            for item in other:
+                self.add(item)
+
+    def difference_update(self, *others: Iterable[int]):
+        for other in others:
+            for item in other:
+                self.discard(item)
+
+    def intersection_update(self, *others: Iterable[int]):
+        keep = set(self).intersection(*others)
+        self.difference_update([item for item in self._sorted if item not in keep])
+
+    def symmetric_difference_update(self, other: Iterable[int]):
+        for item in set(other):
+            if item in self:
+                self.discard(item)
+            else:
+                self.add(item)
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def __isub__(self, other):
+        self.difference_update(other)
+        return self
+
+    def __iand__(self, other):
+        self.intersection_update(other)
+        return self
+
+    def __ixor__(self, other):
+        self.symmetric_difference_update(other)
+        return self
+
+    async def global_members(self) -> List[int]:
+        """所有 worker 的成员（有序，只读）。多进程时本地视图只覆盖本分片的用户，需要读后端：
+        在线程里读，结果缓存 GLOBAL_TTL 秒（本进程的修改会让缓存立即失效）"""
+        if WORKERS <= 1:
+            return self._sorted
+        if self._global is None or self._global[0] <= time.monotonic():
+            members = await asyncio.to_thread(self._read_global)
+            self._global = (time.monotonic() + self.GLOBAL_TTL, members)
+        return self._global[1]
+
+    def _read_global(self) -> List[int]:
+        self._store.flush_sync()
+        return self._store.backend.members(self.ns)
+
+class PersistentDict(dict):
+    """所有修改都写入 state store 的 dict（都归结为赋值/删除）"""
+
+    def __init__(self, store: StateStore, ns: str):
+        super().__init__()
+        self._store = store
+        self.ns = ns
+
+    def _load(self, backend: StateBackend):
+        super().update(backend.items(self.ns))
+
+    def __setitem__(self, key, value: int):
+        super().__setitem__(key, value)
+        self._store.record("set", self.ns, key, value)
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._store.record("del", self.ns, key)
+
+    def pop(self, key, *default):
+        if key in self:
+            self._store.record("del", self.ns, key)
+        return super().pop(key, *default)
+
+    def popitem(self) -> tuple:
+        key, value = super().popitem()
+        self._store.record("del", self.ns, key)
+        return key, value
+
+    def setdefault(self, key, default: int = None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def clear(self):
+        for key in list(self):
+            del self[key]
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+ReplyKey = Tuple[int, int]  # (admin_chat_id, admin_msg_id)
+
+
+class ReplyMap:
+    """(admin_chat_id, admin_msg_id) -> user_id 的分层映射：内存中只保留最近 hot_size 条（LRU），
+    全部映射都写入后端（admin_msg_map），热层未命中时在线程里回后端查询；
+    查不到的 key 记住 NEGATIVE_TTL 秒，同一条回复在分道和处理时只回表一次。
+    message_id 只在各自的聊天里递增，两个管理员会收到同号的消息，所以 key 必须带上聊天 id"""
+
+    ns = "admin_msg_map"
+    NEGATIVE_TTL = 5.0  # seconds
+    NEGATIVE_SIZE = 1024
+
+    def __init__(self, store: StateStore, hot_size: int):
+        self._store = store
+        self.hot_size = hot_size
+        self._hot: "OrderedDict[ReplyKey, int]" = OrderedDict()
+        self._negative: "OrderedDict[ReplyKey, float]" = OrderedDict()  # key -> 过期时刻
+        self._uncounted: Set[ReplyKey] = set()  # count=False 回表装入热层、还没计入统计的
+        self.hits = 0
+        self.cold_hits = 0
+        self.misses = 0
+
+    def _load(self, backend: StateBackend):
+        # 按 admin_msg_id 倒序返回，最旧的先插入，使最新的排在 LRU 末尾
+        for key, user_id in reversed(backend.items(self.ns, newest=self.hot_size)):
+            self._hot[key] = user_id
+
+    def _put_hot(self, key: ReplyKey, user_id: int):
+        self._hot[key] = user_id
+        self._hot.move_to_end(key)
+        while len(self._hot) > self.hot_size:
+            self._uncounted.discard(self._hot.popitem(last=False)[0])
+
+    def _put_negative(self, key: ReplyKey):
+        self._negative[key] = time.monotonic() + self.NEGATIVE_TTL
+        self._negative.move_to_end(key)
+        while len(self._negative) > self.NEGATIVE_SIZE:
+            self._negative.popitem(last=False)
+
+    def __setitem__(self, key: ReplyKey, user_id: int):
+        self._put_hot(key, user_id)
+        self._negative.pop(key, None)
+        self._store.record("set", self.ns, key, user_id)
+
+    def cached(self, key: ReplyKey) -> Tuple[bool, Optional[int]]:
+        """只查内存，不做 I/O：(是否已知, user_id)。热层命中或最近确认过不存在时算已知"""
+        user_id = self._hot.get(key)
+        if user_id is not None:
+            return True, user_id
+        expires = self._negative.get(key)
+        if expires is not None:
+            if expires > time.monotonic():
+                return True, None
+            del self._negative[key]
+        return False, None
+
+    async def get(self, key: ReplyKey, count: bool = True) -> Optional[int]:
+        """count=False 时不计入命中统计（更新分道时会先查一次，处理时再取就不重复计数）"""
+        known, user_id = self.cached(key)
+        if not known:
+            user_id = await asyncio.to_thread(self._cold_get, key)
+            if user_id is None:
+                self._put_negative(key)
+            else:
+                self._put_hot(key, user_id)
+                if not count:
+                    self._uncounted.add(key)
+                    return user_id
+                self.cold_hits += 1
+                return user_id
+        if user_id is None:
+            self.misses += count
+            return None
+        self._hot.move_to_end(key)
+        if count:
+            if key in self._uncounted:
+                self._uncounted.discard(key)
+                self.cold_hits += 1
+            else:
+                self.hits += 1
+        return user_id
+
+    @timed_db("reply_map_cold_get")
+    def _cold_get(self, key: ReplyKey) -> Optional[int]:
+        # 冷层：先把尚未落盘的写入刷下去，保证刚被挤出热层的映射也能查到
+        self._store.flush_sync()
+        return self._store.backend.get(self.ns, key)
+
+    def __len__(self) -> int:
+        return len(self._hot)
+
+    def stats_text(self) -> str:
+        total = self.hits + self.cold_hits + self.misses
+        rate = (self.hits / total * 100) if total else 0.0
+        return (
+            f"回复映射热层：{len(self._hot)}/{self.hot_size}\n"
+            f"命中 {self.hits}，回表命中 {self.cold_hits}，未命中 {self.misses}（热层命中率 {rate:.1f}%）"
+        )
+
+# ----------------- CONVERSATION ARCHIVE -----------------
+class ConversationArchive(WriteBehindQueue):
+    """双向转发消息的存档：DB_PATH 里的 transcript 表 + FTS5 全文索引（文字和说明文字）。
+    写入走写后批量，一批一个事务；状态后端是 Redis 时存档仍在本地 SQLite。
+    表、索引和触发器名都带所属 bot 的表名前缀"""
+
+    FLUSH_INTERVAL = 0.5  # seconds
+    MEDIA_KINDS = ("photo", "video", "animation", "document", "audio", "voice", "video_note", "sticker", "contact", "location", "poll")
+    DIRECTIONS = {"in": "用户→管理员", "out": "管理员→用户"}
+    SEARCH_SQL = (
+        "SELECT t.user_id, t.direction, t.ts, snippet({t}_fts, 0, '«', '»', '…', 48) "
+        "FROM {t}_fts JOIN {t} t ON t.id = {t}_fts.rowid "
+        "WHERE {t}_fts MATCH ? ORDER BY rank LIMIT ? OFFSET ?"
+    )
+
+    def __init__(self, db: Database, table_prefix: str, enabled: bool, log: logging.LoggerAdapter):
+        super().__init__(self.FLUSH_INTERVAL, log)
+        self.db = db
+        self.enabled = enabled
+        self.tokenizer = "trigram"
+        self.written = 0
+        self.table = table_prefix + "transcript"
+
+    def init_schema(self):
+        t = self.table
+        conn = self.db.get()
+        with self.db.lock:
+            conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {t} (id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL, "
+                "direction TEXT NOT NULL, admin_id INTEGER, message_id INTEGER, ts INTEGER NOT NULL, "
+                "kind TEXT NOT NULL, text TEXT)"
+            )
+            conn.execute(f"CREATE INDEX IF NOT EXISTS {t}_user ON {t}(user_id, id)")
+            # trigram 分词不依赖空格，中文也能按子串检索；SQLite < 3.34 没有它时退回 unicode61
+            for tokenizer in ("trigram", "unicode61"):
+                try:
+                    conn.execute(
+                        f"CREATE VIRTUAL TABLE IF NOT EXISTS {t}_fts USING "
+                        f"fts5(text, content='{t}', content_rowid='id', tokenize='{tokenizer}')"
+                    )
+                    break
+                except sqlite3.OperationalError:
+                    continue
+            conn.execute(
+                f"CREATE TRIGGER IF NOT EXISTS {t}_ai AFTER INSERT ON {t} WHEN new.text IS NOT NULL "
+                f"BEGIN INSERT INTO {t}_fts(rowid, text) VALUES (new.id, new.text); END"
+            )
+            conn.commit()
+            sql = conn.execute("SELECT sql FROM sqlite_master WHERE name=?", (f"{t}_fts",)).fetchone()[0]
+        self.tokenizer = "trigram" if "trigram" in sql else "unicode61"
+
+    def add_message(self, user_id: int, direction: str, msg: Message, admin_id: Optional[int] = None):
+        if not self.enabled:
+            return
+        kind = "text" if msg.text else next((k for k in self.MEDIA_KINDS if getattr(msg, k, None)), "other")
+        self.record(user_id, direction, admin_id, msg.message_id, int(msg.date.timestamp()), kind, msg.text or msg.caption)
+
+    @timed_db("archive_flush")
+    def _write(self, rows: List[tuple]):
+        conn = self.db.get()
+        with self.db.lock:
+            conn.executemany(
+                f"INSERT INTO {self.table}(user_id, direction, admin_id, message_id, ts, kind, text) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            conn.commit()
+        self.written += len(rows)
+
+    @timed_db("archive_search")
+    def search(self, query: str, offset: int, limit: int) -> Tuple[int, List[tuple]]:
+        """返回 (命中总数, [(user_id, direction, ts, snippet)])，按 bm25 相关度排序"""
+        self.flush_sync()
+        terms = query.split()
+        t = self.table
+        conn = self.db.get()
+        if self.tokenizer != "trigram" or all(len(t) >= 3 for t in terms):
+            match = " ".join('"%s"' % t.replace('"', '""') for t in terms)
+            with self.db.lock:
+                total = conn.execute(f"SELECT count(*) FROM {t}_fts WHERE {t}_fts MATCH ?", (match,)).fetchone()[0]
+                rows = conn.execute(self.SEARCH_SQL.format(t=t), (match, limit, offset)).fetchall()
+            return total, rows
+        # trigram 索引查不了少于 3 个字符的词（如两个字的中文词），退化为按时间倒序的子串扫描
+        where = " AND ".join("text LIKE ? ESCAPE '\\'" for _ in terms)
+        params = ["%" + t.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%" for t in terms]
+        with self.db.lock:
+            total = conn.execute(f"SELECT count(*) FROM {t} WHERE {where}", params).fetchone()[0]
+            rows = conn.execute(
+                f"SELECT user_id, direction, ts, text FROM {t} WHERE {where} ORDER BY id DESC LIMIT ? OFFSET ?",
+                params + [limit, offset],
+            ).fetchall()
+        return total, [(uid, d, ts, self._snippet(text, terms[0])) for uid, d, ts, text in rows]
+
+    @staticmethod
+    def _snippet(text: str, term: str, width: int = 40) -> str:
+        # LIKE 不区分大小写，这里也一样；casefold 改变了长度（如 ß -> ss）时下标对不上，按未找到处理
+        folded, fterm = text.casefold(), term.casefold()
+        i = folded.find(fterm) if len(folded) == len(text) and len(fterm) == len(term) else -1
+        if i < 0:
+            return text[:width] + ("…" if len(text) > width else "")
+        j = i + len(term)
+        start = max(0, i - width // 2)
+        end = j + width // 2
+        return ("…" if start else "") + text[start:i] + "«" + text[i:j] + "»" + text[j:end] + ("…" if end < len(text) else "")
+
+    @timed_db("archive_export")
+    def export(self, user_id: int, out) -> int:
+        """把某个用户的全部记录逐行写进 out（二进制文件），返回条数。
+        用独立连接迭代游标：不占用共享连接，也不把整段历史读进内存"""
+        self.flush_sync()
+        conn = sqlite3.connect(self.db.path)
+        n = 0
+        try:
+            cur = conn.execute(f"SELECT direction, ts, kind, text FROM {self.table} WHERE user_id=? ORDER BY id", (user_id,))
+            for direction, ts, kind, text in cur:
+                stamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(ts))
+                media = f"[{kind}] " if kind != "text" else ""
+                out.write(f"{stamp} [{self.DIRECTIONS[direction]}] {media}{text or ''}\n".encode("utf-8"))
+                n += 1
+        finally:
+            conn.close()
+        return n
+
+    def stats_text(self) -> str:
+        return f"会话存档：已写入 {self.written} 条，待写入 {len(self._items)} 条（{self.tokenizer} 索引）"
+
+# ----------------- SESSION ROUTING -----------------
+class SessionRouter:
+    """每个活动会话固定分配给一个管理员（按最少负载选择），整个会话期间不变；
+    管理员不可达时自动迁移到其他管理员，也可由管理员 /handoff 手动移交"""
+
+    UNREACHABLE_COOLDOWN = 60.0  # seconds
+
+    def __init__(self, assignments: Dict[int, int], active: Set[int], admin_ids: Set[int], log: logging.LoggerAdapter):
+        self._assign = assignments
+        self._active = active
+        self._admin_ids = admin_ids
+        self.log = log
+        self._load: Dict[int, int] = {}
+        self._down_until: Dict[int, float] = {}
+
+    def rebuild(self):
+        for uid in [u for u in self._assign if u not in self._active]:
+            del self._assign[uid]
+        self._load = {}
+        for aid in self._assign.values():
+            self._load[aid] = self._load.get(aid, 0) + 1
+
+    def admin_of(self, user_id: int) -> Optional[int]:
+        return self._assign.get(user_id)
+
+    def load_of(self, admin_id: int) -> int:
+        return self._load.get(admin_id, 0)
+
+    def is_up(self, admin_id: int) -> bool:
+        return self._down_until.get(admin_id, 0.0) <= time.monotonic()
+
+    def pick(self, exclude: Set[int] = frozenset()) -> Optional[int]:
+        candidates = [a for a in self._admin_ids if a not in exclude and self.is_up(a)]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda a: (self.load_of(a), a))
+
+    def assign(self, user_id: int, admin_id: int):
+        old = self._assign.get(user_id)
+        if old == admin_id:
+            return
+        if old is not None:
+            self._load[old] -= 1
+        self._assign[user_id] = admin_id
+        self._load[admin_id] = self._load.get(admin_id, 0) + 1
+
+    def release(self, user_id: int):
+        old = self._assign.pop(user_id, None)
+        if old is not None:
+            self._load[old] -= 1
+
+    def route(self, user_id: int) -> Optional[int]:
+        """返回会话当前负责的管理员；未分配、其已不再是管理员或已不可达时重新分配"""
+        aid = self._assign.get(user_id)
+        if aid is not None and aid not in self._admin_ids:
+            self.release(user_id)
+            aid = None
+        if aid is not None and self.is_up(aid):
+            return aid
+        new = self.pick()
+        if new is not None:
+            self.assign(user_id, new)
+            if aid is not None:
+                self.log.info(f"会话 {user_id} 从管理员 {aid} 迁移到 {new}")
+            return new
+        return aid
+
+    def reassign_orphans(self):
+        """管理员列表变更后，把已移除管理员名下的会话迁移给其他管理员；没有可用管理员时释放"""
+        orphans = [uid for uid, aid in self._assign.items() if aid not in self._admin_ids]
+        for uid in orphans:
+            old = self._assign[uid]
+            new = self.pick()
+            if new is None:
+                self.release(uid)
+                self.log.info(f"管理员 {old} 已移除，会话 {uid} 暂无管理员接手")
+            else:
+                self.assign(uid, new)
+                self.log.info(f"管理员 {old} 已移除，会话 {uid} 迁移到 {new}")
+
+    def mark_unreachable(self, admin_id: int):
+        self._down_until[admin_id] = time.monotonic() + self.UNREACHABLE_COOLDOWN
+        self.log.warning(f"管理员 {admin_id} 暂时不可达，{self.UNREACHABLE_COOLDOWN:.0f}s 内不再分配")
+
+# ----------------- KEYBOARDS -----------------
+def user_main_keyboard(is_pending: bool, is_active: bool) -> InlineKeyboardMarkup:
+    if is_active:
+        kb = [[InlineKeyboardButton("🔚 结束聊天", callback_data="user_end")]]
+    elif is_pending:
+        kb = [[InlineKeyboardButton("⏳ 取消申请", callback_data="user_cancel")]]
+    else:
+        kb = [[InlineKeyboardButton("📨 申请与管理员连接", callback_data="user_apply")]]
+    return InlineKeyboardMarkup(kb)
+
+def admin_panel_keyboard() -> InlineKeyboardMarkup:
+    kb = [
+        [
+            InlineKeyboardButton("📥 查看申请", callback_data="admin_view_pending"),
+            InlineKeyboardButton("📋 活动会话", callback_data="admin_view_active"),
+        ],
+        [
+            InlineKeyboardButton("📤 主动连接（/connect）", callback_data="admin_hint_connect"),
+            InlineKeyboardButton("🔧 管理帮助", callback_data="admin_help"),
+        ],
+    ]
+    return InlineKeyboardMarkup(kb)
+
+def pending_item_kb(user_id: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([
+        [
+            InlineKeyboardButton("✅ 同意", callback_data=f"admin_accept:{user_id}"),
+            InlineKeyboardButton("❌ 拒绝", callback_data=f"admin_reject:{user_id}"),
+        ]
+    ])
+
+def active_item_kb(user_id: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([
+        [
+            InlineKeyboardButton("🔚 结束该会话", callback_data=f"admin_end:{user_id}"),
+            InlineKeyboardButton("🚫 封禁该用户", callback_data=f"admin_ban:{user_id}"),
+        ]
+    ])
+
+async def admin_view_page(t: "Tenant", kind: str, page: int) -> Tuple[str, InlineKeyboardMarkup]:
+    """待处理申请 / 活动会话的分页视图：一条消息 + 每项操作按钮 + 翻页按钮"""
+    members = await (t.pending_requests if kind == "pending" else t.active_sessions).global_members()
+    total = len(members)
+    pages = max(1, -(-total // ADMIN_PAGE_SIZE))
+    page = min(max(page, 0), pages - 1)
+    rows = []
+    for uid in members[page * ADMIN_PAGE_SIZE:(page + 1) * ADMIN_PAGE_SIZE]:
+        if kind == "pending":
+            rows.append([
+                InlineKeyboardButton(f"✅ 同意 {uid}", callback_data=f"admin_accept:{uid}:{page}"),
+                InlineKeyboardButton("❌ 拒绝", callback_data=f"admin_reject:{uid}:{page}"),
+            ])
+        else:
+            rows.append([
+                InlineKeyboardButton(f"🔚 结束 {uid}", callback_data=f"admin_end:{uid}:{page}"),
+                InlineKeyboardButton("🚫 封禁", callback_data=f"admin_ban:{uid}:{page}"),
+            ])
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton("⬅️ 上一页", callback_data=f"admin_page:{kind}:{page - 1}"))
+    nav.append(InlineKeyboardButton(f"🔄 {page + 1}/{pages}", callback_data=f"admin_page:{kind}:{page}"))
+    if page < pages - 1:
+        nav.append(InlineKeyboardButton("下一页 ➡️", callback_data=f"admin_page:{kind}:{page + 1}"))
+    rows.append(nav)
+    rows.append([InlineKeyboardButton("🔙 返回管理面板", callback_data="admin_panel")])
+    title = "📥 待处理申请" if kind == "pending" else "📋 活动会话"
+    return f"{title}（共 {total} 个，第 {page + 1}/{pages} 页）", InlineKeyboardMarkup(rows)
+
+# ----------------- HELPERS -----------------
+class AdminsFile:
+    """管理员列表文件（每行一个用户名，# 开头为注释），按修改时间判断是否需要重新读取"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._mtime: Optional[float] = None
+
+    def read(self, force: bool = False) -> Optional[List[str]]:
+        """文件有变化（或 force）时返回新的列表，否则返回 None"""
+        if not self.path:
+            return None
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            return None
+        if mtime == self._mtime and not force:
+            return None
+        self._mtime = mtime
+        with open(self.path, encoding="utf-8") as f:
+            return [line.strip().lstrip("@") for line in f if line.strip() and not line.startswith("#")]
+
+class AdminResolver:
+    """管理员身份：用户名小写集合预先算好（O(1) 判断），numeric id 持久化在 admin_ids 表；
+    尚未解析的管理员在后台按指数退避重试 get_chat；管理员列表可从 admins_file 热加载"""
+
+    TICK = 5.0            # seconds
+    BACKOFF_MIN = 30.0
+    BACKOFF_MAX = 3600.0
+
+    def __init__(self, usernames: List[str], admins_file: str, ids_by_username: Dict[str, int],
+                 numeric_ids: Set[int], log: logging.LoggerAdapter, on_change: Optional[Callable[[], None]] = None):
+        self.usernames: List[str] = list(usernames)
+        self.usernames_lower: frozenset = frozenset(n.lower() for n in usernames)
+        self.file = AdminsFile(admins_file)
+        self._ids_by_username = ids_by_username
+        self._numeric_ids = numeric_ids
+        self.log = log
+        self.on_change = on_change  # 热加载改变了管理员列表后调用（迁移被移除管理员的会话）
+        self._retry: Dict[str, Tuple[float, float]] = {}  # lowercase name -> (next attempt, delay)
+        self._task: Optional[asyncio.Task] = None
+
+    def set_usernames(self, names: List[str]):
+        self.usernames = list(names)
+        self.usernames_lower = frozenset(n.lower() for n in names)
+        known = {self._ids_by_username[n] for n in self.usernames_lower if n in self._ids_by_username}
+        self._numeric_ids.intersection_update(known)
+        self._numeric_ids.update(known)
+        now = time.monotonic()
+        self._retry = {n: self._retry.get(n, (now, self.BACKOFF_MIN)) for n in self.usernames_lower if n not in self._ids_by_username}
+
+    def learn(self, username: str, user_id: int):
+        name = username.lower()
+        if name not in self.usernames_lower:
+            return
+        if self._ids_by_username.get(name) != user_id:
+            self._ids_by_username[name] = user_id
+            self.log.info(f"管理员 @{username} -> {user_id}")
+        self._numeric_ids.add(user_id)
+        self._retry.pop(name, None)
+
+    def unresolved(self) -> List[str]:
+        return sorted(self._retry)
+
+    async def resolve_due(self, bot):
+        now = time.monotonic()
+        for name, (next_at, delay) in list(self._retry.items()):
+            if next_at > now:
+                continue
+            try:
+                chat = await bot.get_chat(f"@{name}")
+                self.learn(name, chat.id)
+            except RetryAfter as e:
+                self._retry[name] = (now + retry_after_seconds(e), delay)
+            except Exception:
+                self.log.warning(f"无法解析 @{name}（管理员可能尚未与 bot 对话），{delay:.0f}s 后重试")
+                self._retry[name] = (now + delay, min(delay * 2, self.BACKOFF_MAX))
+
+    def reload(self, force: bool = False) -> bool:
+        names = self.file.read(force)
+        if names is None or names == self.usernames:
+            return False
+        self.set_usernames(names)
+        self.log.info(f"已热加载管理员列表：{', '.join(names)}")
+        if self.on_change is not None:
+            self.on_change()
+        return True
+
+    async def _run(self, bot):
+        while True:
+            try:
+                self.reload()
+                await self.resolve_due(bot)
+            except Exception:
+                self.log.exception("管理员解析失败")
+            await asyncio.sleep(self.TICK)
+
+    def start(self, bot):
+        self._task = asyncio.create_task(self._run(bot))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+def fan_out_to_admins(context: "TenantContext", text: str, **kwargs):
+    """并发通知所有管理员；只负责派发，调用方不等待送达"""
+    t = context.tenant
+
+    async def _send(target):
+        try:
+            await context.bot.send_message(chat_id=target, text=text, **kwargs)
+        except Exception:
+            t.log.exception(f"无法通知管理员 {target}")
+
+    async def _fan_out():
+        outbound_priority.set(PRIO_NOTIFY)
+        await asyncio.gather(*(_send(target) for target in t.admin_chat_targets()))
+
+    context.application.create_task(_fan_out())
+
+def notify_users_bulk(context: "TenantContext", user_ids: List[int], text: str):
+    """批量操作后通知一批用户：bulk 优先级，后台派发，不阻塞命令"""
+    async def _send(uid):
+        try:
+            await context.bot.send_message(chat_id=uid, text=text)
+        except Exception:
+            pass
+
+    async def _fan_out():
+        outbound_priority.set(PRIO_BULK)
+        await asyncio.gather(*(_send(u) for u in user_ids))
+
+    if user_ids:
+        context.application.create_task(_fan_out())
+
+def notify_admins_new_request(user_id: int, username: Optional[str], context: "TenantContext"):
+    text = f"📌 新请求：用户 {'@'+username if username else user_id}\nID: `{user_id}`\n是否同意？"
+    fan_out_to_admins(context, text, reply_markup=pending_item_kb(user_id), parse_mode="Markdown")
+
+# ----------------- OUTBOUND SCHEDULER -----------------
+def retry_after_seconds(e: RetryAfter) -> float:
+    ra = e.retry_after
+    return ra.total_seconds() if isinstance(ra, timedelta) else float(ra)
+
+class TokenBucket:
+    """全局令牌桶：每秒 rate 个令牌，最多攒 capacity 个；遇到 RetryAfter 时整体暂停"""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def refund(self):
+        self._tokens = min(self.capacity, self._tokens + 1)
+
+    def pause(self, seconds: float):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+PRIO_RELAY, PRIO_NOTIFY, PRIO_BULK = 0, 1, 2
+PRIORITY_NAMES = ("relay", "notify", "bulk")
+# 当前任务发出的 Bot API 调用属于哪个优先级；handler 内默认是实时转发/交互
+outbound_priority: ContextVar[int] = ContextVar("outbound_priority", default=PRIO_RELAY)
+
+class OutboundScheduler(BaseRateLimiter):
+    """所有 Bot API 调用的统一出口（作为 Application 的 rate_limiter 接入）：
+    - 按优先级排队：实时转发 > 管理员通知 > 批量广播，优先级取自 outbound_priority；
+    - 全局令牌桶限速 + 全局并发上限 + 每个 chat 的并发上限（同一 chat 内保持顺序）；
+    - RetryAfter 暂停整个令牌桶后重排队，网络错误指数退避重试；
+    - 每个优先级的队列有上限，满了之后生产者等待（背压）"""
+
+    UNSCHEDULED = frozenset({"getMe", "getChat", "setWebhook", "deleteWebhook", "answerCallbackQuery"})
+    BACKOFF_BASE = 0.5   # seconds
+    BACKOFF_MAX = 30.0
+
+    def __init__(self, rate: float, concurrency: int, per_chat: int, queue_limit: int, max_attempts: int,
+                 log: logging.LoggerAdapter = logger):
+        self.log = log
+        self.concurrency = concurrency
+        self.per_chat = per_chat
+        self.queue_limit = queue_limit
+        self.max_attempts = max_attempts
+        self._bucket = TokenBucket(rate)
+        self._queues: List["OrderedDict[object, deque]"] = [OrderedDict() for _ in PRIORITY_NAMES]
+        self._depth = [0] * len(PRIORITY_NAMES)
+        self._space: List[List[asyncio.Future]] = [[] for _ in PRIORITY_NAMES]
+        self._busy: Dict[object, int] = {}
+        self._active = 0
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self.sent = [0] * len(PRIORITY_NAMES)
+        self.retries = 0
+        self.failed = 0
+
+    async def initialize(self):
+        if self._task is not None:
+            return
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._dispatch_loop())
+
+    async def shutdown(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            self._wakeup = None
+
+    # ---- queue ----
+    def _pick(self, pop: bool) -> bool:
+        """找优先级最高、且所在 chat 未满并发的等待者；pop=True 时放行它"""
+        for prio, queue in enumerate(self._queues):
+            empty = []
+            found = None
+            for chat, waiters in queue.items():
+                while waiters and waiters[0].done():  # 调用方已取消
+                    waiters.popleft()
+                    self._depth[prio] -= 1
+                if not waiters:
+                    empty.append(chat)
+                    continue
+                if chat is None or self._busy.get(chat, 0) < self.per_chat:
+                    found = chat
+                    break
+            for chat in empty:
+                del queue[chat]
+            if empty:
+                self._wake_producers(prio)
+            if found is None:
+                continue
+            if pop:
+                waiters = queue[found]
+                fut = waiters.popleft()
+                self._depth[prio] -= 1
+                if waiters:
+                    queue.move_to_end(found)
+                else:
+                    del queue[found]
+                self._busy[found] = self._busy.get(found, 0) + 1
+                self._active += 1
+                fut.set_result(None)
+                self._wake_producers(prio)
+            return True
+        return False
+
+    def _wake_producers(self, prio: int):
+        while self._space[prio] and self._depth[prio] < self.queue_limit:
+            fut = self._space[prio].pop(0)
+            if not fut.done():
+                fut.set_result(None)
+
+    async def _dispatch_loop(self):
+        while True:
+            if self._active >= self.concurrency or not self._pick(pop=False):
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                continue
+            # 先拿令牌再选人：等令牌期间到达的更高优先级请求也能排到前面
+            await self._bucket.acquire()
+            if self._active >= self.concurrency or not self._pick(pop=True):
+                self._bucket.refund()
+
+    async def _acquire(self, prio: int, chat):
+        while self._depth[prio] >= self.queue_limit:
+            space = asyncio.get_running_loop().create_future()
+            self._space[prio].append(space)
+            await space
+        fut = asyncio.get_running_loop().create_future()
+        self._queues[prio].setdefault(chat, deque()).append(fut)
+        self._depth[prio] += 1
+        self._wakeup.set()
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self._release(chat)
+            raise
+
+    def _release(self, chat):
+        self._active -= 1
+        n = self._busy.get(chat, 0) - 1
+        if n > 0:
+            self._busy[chat] = n
+        else:
+            self._busy.pop(chat, None)
+        self._wakeup.set()
+
+    # ---- BaseRateLimiter ----
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        if endpoint in self.UNSCHEDULED or self._wakeup is None:
+            return await callback(*args, **kwargs)
+        prio = rate_limit_args if isinstance(rate_limit_args, int) else outbound_priority.get()
+        chat = data.get("chat_id")
+        error: Optional[Exception] = None
+        for attempt in range(self.max_attempts):
+            await self._acquire(prio, chat)
+            delay = 0.0
+            try:
+                result = await callback(*args, **kwargs)
+                self.sent[prio] += 1
+                return result
+            except RetryAfter as e:
+                error = e
+                self._bucket.pause(retry_after_seconds(e))
+            except (BadRequest, TimedOut):
+                # 参数错误不会因重试而成功；超时的请求可能已经送达，重试会重复发送
+                self.failed += 1
+                raise
+            except NetworkError as e:
+                error = e
+                delay = min(self.BACKOFF_BASE * 2 ** attempt, self.BACKOFF_MAX)
+            except Exception:
+                self.failed += 1
+                raise
+            finally:
+                self._release(chat)
+            self.retries += 1
+            self.log.warning(f"{endpoint} -> {chat} 失败（{error!r}），第 {attempt + 1} 次重试")
+            if delay:
+                await asyncio.sleep(delay)
+        self.failed += 1
+        raise error
+
+    def depth(self, prio: int) -> int:
+        return self._depth[prio]
+
+    def stats_text(self) -> str:
+        queues = "，".join(f"{n} 排队 {self._depth[i]}/已发 {self.sent[i]}" for i, n in enumerate(PRIORITY_NAMES))
+        return f"出站队列：{queues}；进行中 {self._active}，重试 {self.retries}，失败 {self.failed}"
+
+# ----------------- BROADCAST ENGINE -----------------
+
+async def run_broadcast(t: "Tenant", bot, text: str, recipients: List[int], progress: Message):
+    """并发广播：以 bulk 优先级经 outbox 发送（限速 / RetryAfter 重试都在 outbox 里），
+    定期编辑 progress 消息，结束时汇报结果"""
+    outbound_priority.set(PRIO_BULK)
+    queue: asyncio.Queue = asyncio.Queue()
+    for uid in recipients:
+        queue.put_nowait(uid)
+    counts = {"delivered": 0, "failed": 0, "blocked": 0}
+    total = len(recipients)
+
+    async def worker():
+        while True:
+            try:
+                uid = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            try:
+                await bot.send_message(chat_id=uid, text=text)
+                counts["delivered"] += 1
+            except Forbidden:
+                counts["blocked"] += 1
+            except TelegramError:
+                counts["failed"] += 1
+
+    def summary() -> str:
+        done = sum(counts.values())
+        return f"送达 {counts['delivered']}，失败 {counts['failed']}，已屏蔽 bot {counts['blocked']}（{done}/{total}）"
+
+    async def report_progress():
+        last = None
+        while True:
+            await asyncio.sleep(BROADCAST_PROGRESS_INTERVAL)
+            txt = "📣 广播进行中：" + summary()
+            if txt != last:
+                try:
+                    await progress.edit_text(txt)
+                    last = txt
+                except TelegramError:
+                    pass
+
+    reporter = asyncio.create_task(report_progress())
+    try:
+        await asyncio.gather(*(worker() for _ in range(min(t.cfg.BROADCAST_CONCURRENCY, total) or 1)))
+    finally:
+        reporter.cancel()
+    try:
+        await progress.edit_text("✅ 广播完成：" + summary())
+    except TelegramError:
+        t.log.exception("更新广播结果失败")
+    t.log.info("广播完成：" + summary())
+
+# ----------------- APPLY DIGEST -----------------
+class Digest:
+    """一轮汇总：包含的申请（uid -> username，按到达顺序）、每个管理员那条汇总消息的 id"""
+
+    __slots__ = ("id", "members", "received", "messages", "note", "rendered", "lock")
+
+    def __init__(self, digest_id: int):
+        self.id = digest_id
+        self.members: Dict[int, Optional[str]] = {}
+        self.received = 0
+        self.messages: Dict[object, int] = {}
+        self.note = ""
+        self.rendered = ""
+        self.lock = asyncio.Lock()
+
+class ApplyDigest:
+    """新申请通知的自适应合并：最近 DIGEST_RATE_WINDOW 秒内的申请数低于 threshold 时逐条通知；
+    达到后开启一轮汇总，每 interval 秒把新申请并入每个管理员的一条汇总消息（原地编辑），
+    带“全部同意 / 全部拒绝 / 逐个审核”按钮；申请降下来且一个周期内没有新申请后结束这一轮。
+
+    申请本身始终在 pending_requests 里（持久化），汇总只影响通知方式，不会丢申请"""
+
+    KEEP_DIGESTS = 20      # 已结束的汇总保留多少轮，供按钮回调使用
+    LIST_LIMIT = 15        # 汇总消息里列出的申请条数
+
+    def __init__(self, t: "Tenant", threshold: int, interval: float):
+        self.tenant = t
+        self.threshold = threshold
+        self.interval = interval
+        self._recent: deque = deque()
+        self._queued: List[Tuple[int, Optional[str]]] = []
+        self.current: Optional[Digest] = None
+        self._digests: "OrderedDict[int, Digest]" = OrderedDict()
+        self._next_id = 1
+        self._task: Optional[asyncio.Task] = None
+        self._bot = None
+        self.individual = 0
+        self.digested = 0
+
+    def rate(self, now: float) -> int:
+        while self._recent and self._recent[0] < now - DIGEST_RATE_WINDOW:
+            self._recent.popleft()
+        return len(self._recent)
+
+    def submit(self, context: "TenantContext", user_id: int, username: Optional[str]):
+        now = time.monotonic()
+        self._recent.append(now)
+        if self.current is None and (not self.threshold or self.rate(now) < self.threshold):
+            self.individual += 1
+            notify_admins_new_request(user_id, username, context)
+            return
+        if self.current is None:
+            self.current = Digest(self._next_id)
+            self._next_id += 1
+            self._digests[self.current.id] = self.current
+            while len(self._digests) > self.KEEP_DIGESTS:
+                self._digests.popitem(last=False)
+            self.tenant.log.info(f"申请速率过高，开启第 {self.current.id} 轮汇总通知")
+        self._queued.append((user_id, username))
+        self.digested += 1
+        self._bot = context.bot
+        if self._task is None:
+            self._task = context.application.create_task(self._run())
+
+    async def _run(self):
+        try:
+            while self.current is not None:
+                await asyncio.sleep(self.interval)
+                got_new = self._absorb()
+                digest = self.current
+                if not got_new and self.rate(time.monotonic()) < self.threshold:
+                    self.current = None
+                await self.render(self._bot, digest)
+        finally:
+            self._task = None
+
+    def _absorb(self) -> bool:
+        queued, self._queued = self._queued, []
+        for uid, name in queued:
+            self.current.members[uid] = name
+        self.current.received += len(queued)
+        return bool(queued)
+
+    def _text(self, digest: Digest) -> Tuple[str, Optional[InlineKeyboardMarkup]]:
+        live = [(u, n) for u, n in digest.members.items() if u in self.tenant.pending_requests]
+        head = f"📌 申请汇总 #{digest.id}（高峰期合并通知）\n本轮收到 {digest.received} 个申请，仍待处理 {len(live)} 个"
+        if digest.note:
+            head += f"\n{digest.note}"
+        if not live:
+            return head + "\n\n✅ 本轮申请已全部处理。", None
+        lines = [f"• {'@' + n if n else '（无用户名）'}  {u}" for u, n in live[-self.LIST_LIMIT:]]
+        if len(live) > self.LIST_LIMIT:
+            lines.insert(0, f"…… 较早的 {len(live) - self.LIST_LIMIT} 个未列出")
+        ref = f"{WORKER_INDEX}:{digest.id}"
+        kb = InlineKeyboardMarkup([
+            [
+                InlineKeyboardButton(f"✅ 全部同意（{len(live)}）", callback_data=f"digest_accept:{ref}"),
+                InlineKeyboardButton("❌ 全部拒绝", callback_data=f"digest_reject:{ref}"),
+            ],
+            [InlineKeyboardButton("👀 逐个审核", callback_data=f"digest_review:{ref}")],
+        ])
+        return head + "\n\n" + "\n".join(lines), kb
+
+    async def render(self, bot, digest: Digest):
+        """把汇总同步到每个管理员：已有消息就编辑，没有（或编辑失败）就新发一条。
+        同一轮的渲染串行执行（否则上一次还没拿到消息 id 时会重复新发），内容没变就跳过"""
+        outbound_priority.set(PRIO_NOTIFY)
+        async with digest.lock:
+            text, kb = self._text(digest)
+            if text != digest.rendered:
+                await self._sync(bot, digest, text, kb)
+                digest.rendered = text
+
+    async def _sync(self, bot, digest: Digest, text: str, kb: Optional[InlineKeyboardMarkup]):
+
+        async def sync(target):
+            mid = digest.messages.get(target)
+            try:
+                if mid is not None:
+                    try:
+                        await bot.edit_message_text(text, chat_id=target, message_id=mid, reply_markup=kb)
+                        return
+                    except BadRequest as e:
+                        if "not modified" in str(e).lower():
+                            return
+                sent = await bot.send_message(chat_id=target, text=text, reply_markup=kb)
+                digest.messages[target] = sent.message_id
+            except Exception:
+                self.tenant.log.exception(f"无法向管理员 {target} 发送申请汇总")
+
+        await asyncio.gather(*(sync(target) for target in self.tenant.admin_chat_targets()))
+
+    def resolve(self, digest_id: int) -> Optional[Tuple[Digest, List[int]]]:
+        """按钮回调：返回该轮汇总和其中仍待处理的申请；汇总已过期（重启 / 太旧）返回 None"""
+        digest = self._digests.get(digest_id)
+        if digest is None:
+            return None
+        # 只处理管理员已经看到的（排队中还没并入的留到下一次渲染）
+        return digest, [u for u in digest.members if u in self.tenant.pending_requests]
+
+    async def stop(self):
+        """关闭前把排队中的申请并入汇总并发出去"""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self.current is not None and self._bot is not None:
+            self._absorb()
+            digest, self.current = self.current, None
+            await self.render(self._bot, digest)
+
+    def stats_text(self) -> str:
+        mode = f"汇总中（#{self.current.id}）" if self.current else "逐条"
+        return f"申请通知：{mode}，逐条 {self.individual} 个，合并 {self.digested} 个，最近一分钟 {self.rate(time.monotonic())} 个"
+
+# ----------------- FLOOD CONTROL -----------------
+class FloodLimiter:
+    """按用户的滑动窗口限流。用前后两个固定窗口的加权计数近似滑动窗口，
+    每个用户只保存 [窗口序号, 上窗计数, 本窗计数, 已提醒窗口, 超限次数]；
+    空闲超过两个窗口的用户会被定期清理"""
+
+    def __init__(self, name: str, limit: int, window: float):
+        self.name = name
+        self.limit = limit
+        self.window = window
+        self._entries: Dict[int, List[int]] = {}
+        self._last_sweep = 0
+        self.allowed = 0
+        self.throttled = 0
+
+    def _sweep(self, w: int):
+        stale = [uid for uid, e in self._entries.items() if e[0] < w - 1]
+        for uid in stale:
+            del self._entries[uid]
+        self._last_sweep = w
+
+    def hit(self, user_id: int) -> Tuple[bool, bool, int]:
+        """记一次操作，返回 (是否放行, 是否需要提醒用户, 累计超限窗口数)"""
+        now = time.monotonic()
+        w = int(now // self.window)
+        if w - self._last_sweep >= 2:
+            self._sweep(w)
+        e = self._entries.get(user_id)
+        if e is None:
+            e = self._entries[user_id] = [w, 0, 0, -1, 0]
+        elif e[0] != w:
+            e[1] = e[2] if e[0] == w - 1 else 0
+            e[2] = 0
+            e[0] = w
+        frac = (now % self.window) / self.window
+        if e[1] * (1 - frac) + e[2] < self.limit:
+            e[2] += 1
+            self.allowed += 1
+            return True, False, e[4]
+        self.throttled += 1
+        if e[3] == w:
+            return False, False, e[4]
+        e[3] = w
+        e[4] += 1
+        return False, True, e[4]
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats_text(self) -> str:
+        return f"{self.name}限流（{self.limit}/{self.window:g}s）：跟踪 {len(self._entries)} 个用户，放行 {self.allowed}，拦截 {self.throttled}"
+
+async def flood_escalate(user_id: int, context: "TenantContext"):
+    """反复超限的用户自动写入 banned 表"""
+    t = context.tenant
+    await asyncio.to_thread(t.ban_user, user_id)
+    t.pending_requests.discard(user_id)
+    t.end_session(user_id)
+    t.flood_bans += 1
+    t.log.warning(f"用户 {user_id} 多次触发限流，已自动封禁")
+    fan_out_to_admins(context, f"🚫 用户 `{user_id}` 多次触发限流，已自动封禁（/unban 可解封）。", parse_mode="Markdown")
+
+async def check_flood(limiter: FloodLimiter, user_id: int, context: "TenantContext") -> Tuple[bool, bool]:
+    """返回 (是否放行, 是否需要提醒用户)；达到 FLOOD_BAN_STRIKES 时升级封禁"""
+    if replaying_backlog.get():
+        # 积压是停机期间陆续发来的，回放时挤在一起，不算刷屏
+        return True, False
+    ok, notify, strikes = limiter.hit(user_id)
+    strikes_limit = context.tenant.cfg.FLOOD_BAN_STRIKES
+    if not ok and notify and strikes_limit and strikes >= strikes_limit:
+        await flood_escalate(user_id, context)
+    return ok, notify
+
+# ----------------- IDLE EXPIRY -----------------
+class ExpiryTimer:
+    """活动会话的空闲超时和申请的 TTL，全部由一个最小堆驱动（不是每个用户一个定时任务）。
+
+    touch 只更新内存里的最后活动时间（O(1)，relay 路径上调用）；堆顶到期时才核对真实截止时间，
+    仍然活跃就按新的截止时间重新入堆。每个条目每个超时周期至多一次堆操作，与消息量无关。
+    条目被提前移除（结束会话 / 撤销申请）时不删堆，弹出时核对集合成员和代号即可丢弃"""
+
+    TICK = 1.0  # seconds
+    MAX_PER_TICK = 5000
+
+    def __init__(self, timeouts: Dict[str, float]):
+        self.timeouts = timeouts
+        self._last: Dict[Tuple[str, int], Tuple[float, int]] = {}
+        self._heap: List[Tuple[float, int, str, int]] = []
+        self._gen = 0
+        self.expired = {kind: 0 for kind in timeouts}
+
+    def track(self, kind: str, user_id: int, now: Optional[float] = None):
+        """条目进入 pending / active 时调用（重复进入会换新代号，旧的堆项作废）"""
+        timeout = self.timeouts.get(kind)
+        if not timeout:
+            return
+        now = time.monotonic() if now is None else now
+        self._gen += 1
+        self._last[(kind, user_id)] = (now, self._gen)
+        heapq.heappush(self._heap, (now + timeout, self._gen, kind, user_id))
+
+    def touch(self, kind: str, user_id: int):
+        entry = self._last.get((kind, user_id))
+        if entry is not None:
+            self._last[(kind, user_id)] = (time.monotonic(), entry[1])
+
+    def due(self, now: float, members: Dict[str, Set[int]], limit: int = 0) -> List[Tuple[str, int]]:
+        """弹出已到期的条目；members 用来丢弃已经不在集合里的。
+        limit>0 时每次最多处理这么多个堆项，剩下的留给下一个 tick，避免大批同时到期时卡住事件循环"""
+        out = []
+        budget = limit or -1
+        while self._heap and self._heap[0][0] <= now and budget != 0:
+            budget -= 1
+            _, gen, kind, uid = heapq.heappop(self._heap)
+            key = (kind, uid)
+            entry = self._last.get(key)
+            if entry is None or entry[1] != gen:
+                continue
+            if uid not in members[kind]:
+                del self._last[key]
+                continue
+            deadline = entry[0] + self.timeouts[kind]
+            if deadline > now:
+                heapq.heappush(self._heap, (deadline, gen, kind, uid))
+                continue
+            del self._last[key]
+            self.expired[kind] += 1
+            out.append(key)
+        return out
+
+    def __len__(self) -> int:
+        return len(self._last)
+
+class ExpiryManager:
+    """按 ExpiryTimer 的结果结束空闲会话 / 撤销过期申请，通知攒够 EXPIRY_NOTICE_INTERVAL 秒再合并发送：
+    用户各收一条，管理员每人收一条汇总"""
+
+    def __init__(self, t: "Tenant", idle_timeout: float, pending_ttl: float):
+        self.tenant = t
+        self.timer = ExpiryTimer({"active": idle_timeout, "pending": pending_ttl})
+        self._user_notices: Dict[str, List[int]] = {"active": [], "pending": []}
+        self._admin_notices: Dict[Optional[int], Dict[str, List[int]]] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._senders: Set[asyncio.Task] = set()
+
+    @property
+    def enabled(self) -> bool:
+        return any(self.timer.timeouts.values())
+
+    def track_loaded(self):
+        """启动时恢复的条目：最后活动时间没有持久化，统一从现在开始计时；多进程时只管本分片的用户"""
+        now = time.monotonic()
+        t = self.tenant
+        for kind, members in (("active", t.active_sessions), ("pending", t.pending_requests)):
+            for uid in members:
+                if WORKERS <= 1 or uid % WORKERS == WORKER_INDEX:
+                    self.timer.track(kind, uid, now)
+
+    def expire(self, now: float):
+        t = self.tenant
+        for kind, uid in self.timer.due(now, {"active": t.active_sessions, "pending": t.pending_requests}, self.timer.MAX_PER_TICK):
+            if kind == "active":
+                admin_id = t.session_admin.get(uid)
+                t.end_session(uid)
+            else:
+                admin_id = None
+                t.pending_requests.discard(uid)
+            self._user_notices[kind].append(uid)
+            self._admin_notices.setdefault(admin_id, {"active": [], "pending": []})[kind].append(uid)
+
+    async def _send_notices(self, bot, users: Dict[str, List[int]], admins: Dict[Optional[int], Dict[str, List[int]]]):
+        outbound_priority.set(PRIO_BULK)
+
+        async def send(chat_id, text, **kw):
+            try:
+                await bot.send_message(chat_id=chat_id, text=text, **kw)
+            except Exception:
+                self.tenant.log.warning(f"过期通知发送失败：{chat_id}")
+
+        jobs = [send(uid, "⌛ 由于长时间没有消息，本次会话已自动结束。如需继续请重新申请。",
+                     reply_markup=user_main_keyboard(False, False)) for uid in users["active"]]
+        jobs += [send(uid, "⌛ 你的申请长时间未被处理，已自动撤销，可以重新申请。",
+                      reply_markup=user_main_keyboard(False, False)) for uid in users["pending"]]
+        # 没有负责管理员的条目（申请、未分配的会话）汇总给所有管理员
+        shared = admins.pop(None, {"active": [], "pending": []})
+        for admin_id in self.tenant.admin_chat_targets():
+            mine = admins.get(admin_id, {"active": [], "pending": []})
+            ended, dropped = mine["active"] + shared["active"], mine["pending"] + shared["pending"]
+            if not ended and not dropped:
+                continue
+            lines = []
+            if ended:
+                lines.append(f"⌛ {len(ended)} 个会话空闲超时已结束：" + ", ".join(map(str, ended[:50])) + (" …" if len(ended) > 50 else ""))
+            if dropped:
+                lines.append(f"⌛ {len(dropped)} 个申请超时已撤销：" + ", ".join(map(str, dropped[:50])) + (" …" if len(dropped) > 50 else ""))
+            jobs.append(send(admin_id, "\n".join(lines)))
+        await asyncio.gather(*jobs)
+
+    def flush_notices(self, bot):
+        if not any(self._user_notices.values()):
+            return
+        users, self._user_notices = self._user_notices, {"active": [], "pending": []}
+        admins, self._admin_notices = self._admin_notices, {}
+        task = asyncio.create_task(self._send_notices(bot, users, admins))
+        self._senders.add(task)
+        task.add_done_callback(self._senders.discard)
+
+    async def _run(self, bot):
+        last_flush = time.monotonic()
+        while True:
+            await asyncio.sleep(self.timer.TICK)
+            now = time.monotonic()
+            self.expire(now)
+            if now - last_flush >= EXPIRY_NOTICE_INTERVAL:
+                self.flush_notices(bot)
+                last_flush = now
+
+    def start(self, bot):
+        if self.enabled:
+            self._task = asyncio.create_task(self._run(bot))
+
+    async def stop(self, bot):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self.flush_notices(bot)
+        if self._senders:
+            await asyncio.gather(*self._senders, return_exceptions=True)
+
+    def stats_text(self) -> str:
+        if not self.enabled:
+            return "空闲过期：未开启"
+        return f"空闲过期：跟踪 {len(self.timer)} 个，已结束会话 {self.timer.expired['active']}，已撤销申请 {self.timer.expired['pending']}"
+
+# ----------------- TENANT -----------------
+# 可以按租户覆盖的配置项（租户配置里的 "env"）和它们的解析方式，未覆盖的沿用进程环境变量。
+# 其余配置（Bot API 地址、HTTP 连接池、状态后端、DB_PATH、指标端口等）属于进程，所有租户相同
+TENANT_SETTINGS = {
+    "REPLY_MAP_HOT_SIZE": int,
+    "ARCHIVE_ENABLED": lambda v: str(v) != "0",
+    "RELAY_BATCH_WINDOW": float,
+    "UPDATE_CONCURRENCY": int,
+    "UPDATE_LANE_LIMIT": int,
+    "OUTBOUND_RATE": float,
+    "OUTBOUND_CONCURRENCY": int,
+    "OUTBOUND_PER_CHAT": int,
+    "OUTBOUND_QUEUE_LIMIT": int,
+    "BROADCAST_CONCURRENCY": int,
+    "DIGEST_THRESHOLD": int,
+    "DIGEST_INTERVAL": float,
+    "FLOOD_MSG_LIMIT": int,
+    "FLOOD_MSG_WINDOW": float,
+    "FLOOD_CB_LIMIT": int,
+    "FLOOD_CB_WINDOW": float,
+    "FLOOD_BAN_STRIKES": int,
+    "SESSION_IDLE_TIMEOUT": float,
+    "PENDING_TTL": float,
+    "CATCHUP_RATE": float,
+}
+
+class TenantContext(CallbackContext):
+    """handler 收到的 context：context.tenant 是这个 Application 所属的 bot"""
+
+    @property
+    def tenant(self) -> "Tenant":
+        return self.application.bot_data["tenant"]
+
+class Tenant:
+    """一个 bot 的全部状态：配置、状态存储和内存视图、管理员、限流、出站队列、更新车道、指标和 Application。
+    单 bot 部署（以及每个分片 worker）只有一个；多租户时一个进程里有多个，共用宿主的 Database 和 HTTP 连接池"""
+
+    def __init__(self, db: Database, token: str, admins: List[str], admins_file: str = "", name: str = "",
+                 table_prefix: str = "", redis_prefix: str = REDIS_PREFIX, settings: Optional[Dict[str, object]] = None,
+                 serve_metrics: bool = False):
+        self.name = name
+        self.token = token
+        self.db = db
+        self.table_prefix = table_prefix
+        self.redis_prefix = redis_prefix
+        self.serve_metrics = serve_metrics
+        self.log = TenantLogAdapter(logger, {"tenant": name})
+        values = {k: globals()[k] for k in TENANT_SETTINGS}
+        for k, v in (settings or {}).items():
+            if k not in TENANT_SETTINGS:
+                raise ValueError(f"配置项 {k} 不能按租户覆盖")
+            values[k] = TENANT_SETTINGS[k](v)
+        self.cfg = types.SimpleNamespace(**values)
+        cfg = self.cfg
+        self.app = None
+        self._ban_sync: Optional[asyncio.Task] = None
+        self._metrics_server: Optional[asyncio.AbstractServer] = None
+
+        # handler 和 Bot API 的指标按 bot 分开，附加到进程的注册表（多租户时带 tenant 标签）
+        self.metrics = MetricsRegistry()
+        self.handler_latency = self.metrics.histogram("bot_handler_seconds", "Update handler latency", ("handler",))
+        self.handler_errors = self.metrics.counter("bot_handler_errors_total", "Update handler exceptions", ("handler",))
+        self.api_latency = self.metrics.histogram("bot_api_request_seconds", "Bot API request latency", ("method",))
+        self.api_errors = self.metrics.counter("bot_api_errors_total", "Bot API errors by status code", ("method", "code"))
+        metrics.attach(self.metrics, f'tenant="{name}"' if name else "")
+
+        # 以下结构的修改会通过 state_store 异步批量写入状态后端（默认 bot_state.db），重启后自动恢复
+        self.state_store = StateStore(self.log)
+        self.pending_requests: Set[int] = PersistentSet(self.state_store, "pending")        # user ids waiting approval
+        self.active_sessions: Set[int] = PersistentSet(self.state_store, "active")          # user ids connected
+        self.admin_msgid_to_user = ReplyMap(self.state_store, cfg.REPLY_MAP_HOT_SIZE)  # (admin_chat_id, admin_msg_id) -> user_id mapping (bounded, spills to sqlite)
+        self.session_admin: Dict[int, int] = PersistentDict(self.state_store, "session_admin")  # user -> assigned admin id
+        # resolved numeric admin ids (may be empty until resolved or registered)
+        self.numeric_admin_ids: Set[int] = set()
+        # lowercase username -> numeric id（解析、/register_admin 或管理员首次交互时得到），持久化在 admin_ids 表
+        self.admin_ids_by_username: Dict[str, int] = PersistentDict(self.state_store, "admin_ids")
+        self.banned_index = BanIndex(self.log)
+
+        self.archive = ConversationArchive(db, table_prefix, cfg.ARCHIVE_ENABLED, self.log)
+        self.session_router = SessionRouter(self.session_admin, self.active_sessions, self.numeric_admin_ids, self.log)
+        self.admin_resolver = AdminResolver(admins, admins_file, self.admin_ids_by_username, self.numeric_admin_ids, self.log,
+                                            on_change=self.session_router.reassign_orphans)
+        # 多进程时各 worker 平分全局速率（Telegram 的限额按 bot 计，而不是按连接）
+        self.outbox = OutboundScheduler(cfg.OUTBOUND_RATE / max(WORKERS, 1), cfg.OUTBOUND_CONCURRENCY, cfg.OUTBOUND_PER_CHAT,
+                                        cfg.OUTBOUND_QUEUE_LIMIT, OUTBOUND_MAX_ATTEMPTS, self.log)
+        self.apply_digest = ApplyDigest(self, cfg.DIGEST_THRESHOLD, cfg.DIGEST_INTERVAL)
+        self.message_limiter = FloodLimiter("消息", cfg.FLOOD_MSG_LIMIT, cfg.FLOOD_MSG_WINDOW)
+        self.callback_limiter = FloodLimiter("按钮", cfg.FLOOD_CB_LIMIT, cfg.FLOOD_CB_WINDOW)
+        self.flood_bans = 0
+        self.expiry = ExpiryManager(self, cfg.SESSION_IDLE_TIMEOUT, cfg.PENDING_TTL)
+        self.relay_batcher = RelayBatcher(self, cfg.RELAY_BATCH_WINDOW)
+        self.update_lanes = LaneUpdateProcessor(self, cfg.UPDATE_CONCURRENCY, cfg.UPDATE_LANE_LIMIT)
+        self.backlog = BacklogCatchUp(self, cfg.CATCHUP_RATE)
+        self._register_collected()
+
+    @classmethod
+    def from_env(cls, db: Database) -> "Tenant":
+        """单 bot 部署 / 分片 worker：全部使用进程配置，/metrics 由它自己开启"""
+        return cls(db, BOT_TOKEN, ADMIN_USERNAMES, ADMINS_FILE, table_prefix=DB_TABLE_PREFIX, serve_metrics=True)
+
+    @classmethod
+    def from_spec(cls, spec: dict, db: Database) -> "Tenant":
+        """多租户配置里的一项：表名前缀 "<name>_"，Redis 键前缀 "REDIS_PREFIX:<name>"""
+        name = spec["name"]
+        return cls(db, spec["token"], spec.get("admins", []), spec.get("admins_file", ""), name=name,
+                   table_prefix=f"{name}_", redis_prefix=f"{REDIS_PREFIX}:{name}", settings=spec.get("env"))
+
+    def _register_collected(self):
+        g = self.metrics.gauge
+        c = self.metrics.counter_fn
+        g("bot_pending_requests", "Users waiting for approval", lambda: len(self.pending_requests))
+        g("bot_active_sessions", "Connected users", lambda: len(self.active_sessions))
+        g("bot_reply_map_hot_entries", "admin_msgid_to_user entries held in memory", lambda: len(self.admin_msgid_to_user))
+        c("bot_reply_map_hits_total", "admin_msgid_to_user hot-tier hits", lambda: self.admin_msgid_to_user.hits)
+        c("bot_reply_map_cold_hits_total", "admin_msgid_to_user state backend hits", lambda: self.admin_msgid_to_user.cold_hits)
+        c("bot_reply_map_misses_total", "admin_msgid_to_user misses", lambda: self.admin_msgid_to_user.misses)
+        for prio, name in enumerate(PRIORITY_NAMES):
+            g(f"bot_outbound_queue_{name}", f"Outbound calls waiting in the {name} queue", functools.partial(self.outbox.depth, prio))
+        g("bot_archive_pending_rows", "Transcript rows waiting to be written", lambda: len(self.archive._items))
+        g("bot_expiry_tracked", "Sessions and requests tracked for idle expiry", lambda: len(self.expiry.timer))
+        g("bot_update_lanes", "Users with updates queued or running", lambda: self.update_lanes.lanes())
+        g("bot_backlog_pending", "Backlog updates waiting to be replayed", lambda: len(self.backlog._pending))
+        c("bot_updates_dropped_total", "Updates dropped because their lane was full", lambda: self.update_lanes.dropped)
+        g("bot_banned_users", "Rows in the ban index", lambda: len(self.banned_index))
+        c("bot_flood_throttled_messages_total", "Messages dropped by flood control", lambda: self.message_limiter.throttled)
+        c("bot_flood_throttled_callbacks_total", "Callbacks dropped by flood control", lambda: self.callback_limiter.throttled)
 
-# ----------------- KEYBOARDS -----------------
-def user_main_keyboard(is_pending: bool, is_active: bool) -> InlineKeyboardMarkup:
-    if is_active:
-        kb = [[InlineKeyboardButton("🔚 结束聊天", callback_data="user_end")]]
-    elif is_pending:
-        kb = [[InlineKeyboardButton("⏳ 取消申请", callback_data="user_cancel")]]
-    else:
-        kb = [[InlineKeyboardButton("📨 申请与管理员连接", callback_data="user_apply")]]
-    return InlineKeyboardMarkup(kb)
+    # ---- 状态 ----
+    @timed_db("init")
+    def init_db(self):
+        backend = make_state_backend(self.db, self.table_prefix, self.redis_prefix)
+        backend.init()
+        self.state_store.backend = backend
+        self.banned_index.load(backend)
+        self.state_store.load({
+            "pending": self.pending_requests,
+            "active": self.active_sessions,
+            "admin_msg_map": self.admin_msgid_to_user,
+            "session_admin": self.session_admin,
+            "admin_ids": self.admin_ids_by_username,
+        })
+        if self.cfg.ARCHIVE_ENABLED:
+            self.archive.init_schema()
+        self.admin_resolver.set_usernames(self.admin_resolver.file.read() or self.admin_resolver.usernames)
+        self.session_router.rebuild()
 
-def admin_panel_keyboard() -> InlineKeyboardMarkup:
-    kb = [
-        [
-            InlineKeyboardButton("📥 查看申请", callback_data="admin_view_pending"),
-            InlineKeyboardButton("📋 活动会话", callback_data="admin_view_active"),
-        ],
-        [
-            InlineKeyboardButton("📤 主动连接（/connect）", callback_data="admin_hint_connect"),
-            InlineKeyboardButton("🔧 管理帮助", callback_data="admin_help"),
-        ],
-    ]
-    return InlineKeyboardMarkup(kb)
+    @timed_db("ban_user")
+    def ban_user(self, user_id: int):
+        self.banned_index.add(self.state_store.backend, user_id)
 
-def pending_item_kb(user_id: int) -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup([
-        [
-            InlineKeyboardButton("✅ 同意", callback_data=f"admin_accept:{user_id}"),
-            InlineKeyboardButton("❌ 拒绝", callback_data=f"admin_reject:{user_id}"),
-        ]
-    ])
+    @timed_db("unban_user")
+    def unban_user(self, user_id: int):
+        self.banned_index.remove(self.state_store.backend, user_id)
 
-def active_item_kb(user_id: int) -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup([
-        [
-            InlineKeyboardButton("🔚 结束该会话", callback_data=f"admin_end:{user_id}"),
-            InlineKeyboardButton("🚫 封禁该用户", callback_data=f"admin_ban:{user_id}"),
-        ]
-    ])
+    @timed_db("ban_users")
+    def ban_users(self, user_ids: Iterable[int]) -> int:
+        return self.banned_index.add_many(self.state_store.backend, user_ids)
 
-# ----------------- HELPERS -----------------
-def username_is_admin(username: Optional[str]) -> bool:
-    if not username:
-        return False
-    return username.lower() in {u.lower() for u in ADMIN_USERNAMES}
+    @timed_db("unban_users")
+    def unban_users(self, user_ids: Iterable[int]) -> int:
+        return self.banned_index.remove_many(self.state_store.backend, user_ids)
+
+    def is_banned(self, user_id: int) -> bool:
+        # 纯内存查询，不计入 bot_sqlite_seconds
+        return user_id in self.banned_index
+
+    def start_session(self, user_id: int, admin_id: Optional[int] = None):
+        self.pending_requests.discard(user_id)
+        self.active_sessions.add(user_id)
+        self.expiry.timer.track("active", user_id)
+        if admin_id is not None:
+            self.session_router.assign(user_id, admin_id)
+
+    def end_session(self, user_id: int):
+        self.active_sessions.discard(user_id)
+        self.session_router.release(user_id)
 
-def is_admin_update(update: Update) -> bool:
-    u = update.effective_user
-    if not u:
+    def purge_banned_sessions(self) -> Tuple[List[int], List[int]]:
+        """批量封禁后一次遍历清掉被封用户的会话和申请，返回 (结束的会话, 撤销的申请)"""
+        ended = [uid for uid in self.active_sessions if uid in self.banned_index]
+        for uid in ended:
+            self.end_session(uid)
+        dropped = [uid for uid in self.pending_requests if uid in self.banned_index]
+        for uid in dropped:
+            self.pending_requests.discard(uid)
+        return ended, dropped
+
+    # ---- 管理员 ----
+    def username_is_admin(self, username: Optional[str]) -> bool:
+        if not username:
+            return False
+        return username.lower() in self.admin_resolver.usernames_lower
+
+    def is_admin_update(self, update: Update) -> bool:
+        u = update.effective_user
+        if not u:
+            return False
+        # check numeric id too
+        if u.id in self.numeric_admin_ids:
+            return True
+        if self.username_is_admin(u.username):
+            # 管理员第一次与 bot 交互时直接记下其 numeric id，不必等 get_chat 解析
+            self.admin_resolver.learn(u.username, u.id)
+            return True
         return False
-    # check numeric id too
-    if u.id in numeric_admin_ids:
-        return True
-    return username_is_admin(u.username)
 
-async def resolve_admin_usernames_to_ids(app):
-    """尝试将 ADMIN_USERNAMES 解析为 numeric ids via get_chat('@username')"""
-    resolved = set()
-    for name in ADMIN_USERNAMES:
-        try:
-            chat = await app.bot.get_chat(f"@{name}")
-            resolved.add(chat.id)
-            logger.info(f"Resolved @{name} -> {chat.id}")
-        except Exception:
-            logger.warning(f"无法解析 @{name}（管理员可能尚未与 bot 对话）")
-    return resolved
+    def admin_chat_targets(self) -> List[object]:
+        """每个管理员恰好一个目标：已知 numeric id 用 id，否则退回 @username"""
+        targets: List[object] = []
+        seen: Set[int] = set()
+        for name in self.admin_resolver.usernames:
+            aid = self.admin_ids_by_username.get(name.lower())
+            if aid is None:
+                targets.append(f"@{name}")
+            elif aid not in seen:
+                seen.add(aid)
+                targets.append(aid)
+        for aid in self.numeric_admin_ids:
+            if aid not in seen:
+                seen.add(aid)
+                targets.append(aid)
+        return targets
 
-async def notify_admins_new_request(user_id: int, username: Optional[str], context: ContextTypes.DEFAULT_TYPE):
-    text = f"📌 新请求：用户 {'@'+username if username else user_id}\\nID: `{user_id}`\\n是否同意？"
-    for name in ADMIN_USERNAMES:
-        try:
-            await context.bot.send_message(chat_id=f"@{name}", text=text, reply_markup=pending_item_kb(user_id), parse_mode="Markdown")
-        except Exception:
-            logger.exception(f"无法发送申请通知给 @{name}")
-    # also attempt to notify numeric admins if resolved
-    for aid in numeric_admin_ids:
-        try:
-            await context.bot.send_message(chat_id=aid, text=text, reply_markup=pending_item_kb(user_id), parse_mode="Markdown")
-        except Exception:
-            pass
+    # ---- Application ----
+    async def post_init(self, app):
+        self.state_store.start()
+        self.archive.start()
+        if WORKERS > 1:
+            self._ban_sync = asyncio.create_task(
+                self.banned_index.sync_forever(self.state_store.backend, BAN_SYNC_INTERVAL, self.purge_banned_sessions))
+        if self.serve_metrics:
+            self._metrics_server = await start_metrics_server()
+        # 已持久化的管理员 id 在 init_db 时就已恢复，其余的在后台解析，不阻塞启动
+        self.admin_resolver.start(app.bot)
+        self.expiry.track_loaded()
+        self.expiry.start(app.bot)
+        # 分片 worker 没有 updater（积压由调度进程拉取）；webhook 模式下积压由 Telegram 推送
+        if self.cfg.CATCHUP_RATE > 0 and BOT_MODE == "polling" and app.updater is not None:
+            await self.backlog.catch_up(app)
+
+    async def post_stop(self, app):
+        # 更新队列和 create_task 任务已由 Application.stop 处理完，这里停掉积压回放（进度已落盘，
+        # 下次启动接着回放），再把攒批中的转发和过期通知发完
+        await self.backlog.stop()
+        await self.relay_batcher.drain()
+        await self.expiry.stop(app.bot)
+        await self.apply_digest.stop()
+
+    async def post_shutdown(self, app):
+        # Database 归创建它的一方（main / worker / 多租户宿主）关闭
+        await self.admin_resolver.stop()
+        if self._ban_sync is not None:
+            self._ban_sync.cancel()
+            self._ban_sync = None
+        if self._metrics_server is not None:
+            self._metrics_server.close()
+            self._metrics_server = None
+        await self.state_store.stop()
+        await self.archive.stop()
+        self.state_store.backend.close()
+
+    def register_handlers(self, app):
+        commands = [
+            ("start", start_cmd),
+            ("help", help_cmd),
+            ("register_admin", register_admin_cmd),
+            ("reload_admins", reload_admins_cmd),
+            ("connect", connect_cmd),
+            ("end", end_cmd),
+            ("ban", ban_cmd),
+            ("unban", unban_cmd),
+            ("list", list_cmd),
+            ("stats", stats_cmd),
+            ("handoff", handoff_cmd),
+            ("send", send_cmd),
+            ("broadcast", broadcast_cmd),
+            ("search", search_cmd),
+            ("export", export_cmd),
+            ("import_bans", import_bans_cmd),
+            ("export_bans", export_bans_cmd),
+        ]
+        wrap = functools.partial(instrument_handler, latency=self.handler_latency, errors=self.handler_errors)
+        for name, fn in commands:
+            app.add_handler(CommandHandler(name, wrap(fn)))
+
+        app.add_handler(CallbackQueryHandler(wrap(callback_query_handler)))
+        # 附言为 /import_bans 的文件（说明文字里的命令不会触发 CommandHandler）
+        app.add_handler(MessageHandler(filters.Document.ALL & filters.CaptionRegex(r"^/import_bans(@\w+)?\b"), wrap(import_bans_cmd)))
+        app.add_handler(MessageHandler(filters.ALL & (~filters.COMMAND), wrap(message_relay_handler)))
+
+    def _request(self, pool: str, pool_size: int, transport: Optional[httpx.AsyncBaseTransport]) -> InstrumentedRequest:
+        return InstrumentedRequest(latency=self.api_latency, errors=self.api_errors, **http_request_kwargs(pool, pool_size, transport))
+
+    def build_application(self, updater: bool = True, transports: Optional[Tuple[httpx.AsyncBaseTransport, httpx.AsyncBaseTransport]] = None):
+        """transports：多租户时宿主的 (发送用, getUpdates 用) 两个连接池，经 SharedTransport 接入；为空时自建"""
+        send, poll = (SharedTransport(tr) for tr in transports) if transports else (None, None)
+        builder = (
+            ApplicationBuilder()
+            .token(self.token)
+            .context_types(ContextTypes(context=TenantContext))
+            .post_init(self.post_init)
+            .post_stop(self.post_stop)
+            .post_shutdown(self.post_shutdown)
+        )
+        if BOT_API_BASE_URL:
+            builder = builder.base_url(BOT_API_BASE_URL)
+        # UPDATE_CONCURRENCY=1 时也经过车道（只有一个执行名额）：积压回放和实时更新排在同一条链上
+        builder = builder.rate_limiter(self.outbox).concurrent_updates(self.update_lanes)
+        builder = builder.request(self._request("send", HTTP_POOL_SIZE, send))
+        if updater:
+            builder = builder.get_updates_request(self._request("poll", 1, poll))
+        else:
+            # 分片 worker：更新由调度进程拉取后送进 update_queue
+            builder = builder.updater(None)
+        app = builder.build()
+        app.bot_data["tenant"] = self
+        self.register_handlers(app)
+        self.app = app
+        return app
 
 # ----------------- COMMANDS -----------------
-async def start_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def start_cmd(update: Update, context: TenantContext):
+    t = context.tenant
     uid = update.effective_user.id
-    if is_admin_update(update):
+    if t.is_admin_update(update):
         await update.message.reply_text("欢迎管理员。管理面板：", reply_markup=admin_panel_keyboard())
     else:
-        is_pending = uid in pending_requests
-        is_active = uid in active_sessions
+        is_pending = uid in t.pending_requests
+        is_active = uid in t.active_sessions
         await update.message.reply_text("欢迎。点击下方按钮申请与管理员连接。", reply_markup=user_main_keyboard(is_pending, is_active))
 
-async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if is_admin_update(update):
+async def help_cmd(update: Update, context: TenantContext):
+    t = context.tenant
+    if t.is_admin_update(update):
         txt = (
             "/start - 管理面板\n"
             "/connect <user_id> - 主动连接用户\n"
             "/end <user_id> - 结束某用户会话\n"
-            "/ban <user_id> - 封禁用户\n"
-            "/unban <user_id> - 解封用户\n"
+            "/ban <user_id> [...] - 封禁用户（可多个）\n"
+            "/unban <user_id> [...] - 解封用户（可多个）\n"
+            "/import_bans - 附在 CSV / 文本文件上，批量导入封禁\n"
+            "/export_bans - 导出封禁列表\n"
             "/list - 列出活动/待处理\n"
+            "/handoff <user_id> [admin_id] - 把会话移交给其他管理员\n"
+            "/stats - 查看运行统计\n"
             "/send <user_id> <消息> - 给某用户发消息\n"
             "/broadcast <消息> - 向所有活动用户广播\n"
+            "/search <关键词> - 全文搜索会话存档\n"
+            "/export <user_id> - 导出某用户的会话记录\n"
             "/register_admin - 管理员私聊注册（仅在解析失败时使用）\n"
+            "/reload_admins - 重新加载 ADMINS_FILE 中的管理员列表\n"
         )
         await update.message.reply_text(txt)
     else:
         await update.message.reply_text("使用 /start 并点击按钮申请与管理员连接。")
 
-async def register_admin_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def register_admin_cmd(update: Update, context: TenantContext):
     """管理员在与 bot 私聊时可用此命令注册自己的 numeric id（备用）"""
-    if not username_is_admin(update.effective_user.username):
+    t = context.tenant
+    if not t.username_is_admin(update.effective_user.username):
         await update.message.reply_text("仅允许预设用户名的管理员使用此命令（请确保你是管理员用户名）。")
         return
-    numeric_admin_ids.add(update.effective_user.id)
+    t.admin_resolver.learn(update.effective_user.username, update.effective_user.id)
     await update.message.reply_text(f"已注册管理员 id: {update.effective_user.id}")
-    logger.info(f"管理员 {update.effective_user.username} 注册为 numeric id {update.effective_user.id}")
+    t.log.info(f"管理员 {update.effective_user.username} 注册为 numeric id {update.effective_user.id}")
+
+async def reload_admins_cmd(update: Update, context: TenantContext):
+    t = context.tenant
+    if not t.is_admin_update(update):
+        return
+    if not t.admin_resolver.file.path:
+        await update.message.reply_text("未配置 ADMINS_FILE，无法热加载管理员列表。")
+        return
+    t.admin_resolver.reload(force=True)
+    await t.admin_resolver.resolve_due(context.bot)
+    pending = t.admin_resolver.unresolved()
+    txt = f"当前管理员：{', '.join('@' + n for n in t.admin_resolver.usernames)}"
+    if pending:
+        txt += f"\n尚未解析 id：{', '.join('@' + n for n in pending)}（请对方私聊 bot 发送 /start）"
+    await update.message.reply_text(txt)
 
-async def connect_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_admin_update(update):
+async def connect_cmd(update: Update, context: TenantContext):
+    t = context.tenant
+    if not t.is_admin_update(update):
         return
     if not context.args:
         await update.message.reply_text("用法：/connect <user_id>")
@@ -198,19 +2677,20 @@ async def connect_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except ValueError:
         await update.message.reply_text("user_id 必须是数字")
         return
-    if is_banned_db(uid):
+    if t.is_banned(uid):
         await update.message.reply_text("该用户已被封禁，无法连接。")
         return
-    pending_requests.discard(uid)
-    active_sessions.add(uid)
+    t.start_session(uid, update.effective_user.id)
     await update.message.reply_text(f"✅ 已主动与用户 {uid} 建立会话。")
     try:
         await context.bot.send_message(chat_id=uid, text="✅ 管理员已主动与你建立专属聊天通道。")
-    except Exception:
+    except TelegramError as e:
+        t.log.warning(f"无法通知用户 {uid}：{e}")
         await update.message.reply_text("警告：向用户发送消息失败，用户可能未与 bot 对话过。")
 
-async def end_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_admin_update(update):
+async def end_cmd(update: Update, context: TenantContext):
+    t = context.tenant
+    if not t.is_admin_update(update):
         return
     if not context.args:
         await update.message.reply_text("用法：/end <user_id>")
@@ -220,59 +2700,178 @@ async def end_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except ValueError:
         await update.message.reply_text("user_id 必须是数字")
         return
-    if uid in active_sessions:
-        active_sessions.discard(uid)
+    if uid in t.active_sessions:
+        t.end_session(uid)
         try:
             await context.bot.send_message(chat_id=uid, text="⚠️ 管理员已结束本次会话。")
-        except:
-            pass
+        except TelegramError as e:
+            t.log.warning(f"无法通知用户 {uid}：{e}")
         await update.message.reply_text(f"已结束与用户 {uid} 的会话。")
     else:
         await update.message.reply_text("该用户当前没有活动会话。")
 
-async def ban_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_admin_update(update):
+async def ban_cmd(update: Update, context: TenantContext):
+    t = context.tenant
+    if not t.is_admin_update(update):
         return
-    if not context.args:
-        await update.message.reply_text("用法：/ban <user_id>")
+    bad: List[str] = []
+    uids = list(iter_user_ids(context.args, bad))
+    if not uids:
+        await update.message.reply_text("用法：/ban <user_id> [user_id ...]（空格或逗号分隔）\n大批量请发送 CSV / 文本文件并附言 /import_bans")
         return
-    try:
-        uid = int(context.args[0])
-    except ValueError:
-        await update.message.reply_text("user_id 必须是数字")
+    added = await asyncio.to_thread(t.ban_users, uids)
+    ended, dropped = t.purge_banned_sessions()
+    # 单个封禁总是通知本人；批量时只通知被断开会话 / 撤销申请的用户
+    notify_users_bulk(context, uids if len(uids) == 1 else ended + dropped, "🚫 你已被管理员封禁，无法与管理员聊天。")
+    if len(uids) == 1:
+        await update.message.reply_text(f"已封禁用户 {uids[0]} 并断开任何会话。")
         return
-    ban_user_db(uid)
-    pending_requests.discard(uid)
-    active_sessions.discard(uid)
-    try:
-        await context.bot.send_message(chat_id=uid, text="🚫 你已被管理员封禁，无法与管理员聊天。")
-    except:
-        pass
-    await update.message.reply_text(f"已封禁用户 {uid} 并断开任何会话。")
+    txt = f"已封禁 {added} 个用户（共 {len(uids)} 个 id，其余原本已封禁），断开 {len(ended)} 个会话，撤销 {len(dropped)} 个申请。"
+    if bad:
+        txt += f"\n忽略无效 id {len(bad)} 个：{' '.join(bad[:10])}"
+    await update.message.reply_text(txt)
+
+async def unban_cmd(update: Update, context: TenantContext):
+    t = context.tenant
+    if not t.is_admin_update(update):
+        return
+    bad: List[str] = []
+    uids = list(iter_user_ids(context.args, bad))
+    if not uids:
+        await update.message.reply_text("用法：/unban <user_id> [user_id ...]（空格或逗号分隔）")
+        return
+    removed = await asyncio.to_thread(t.unban_users, uids)
+    if len(uids) == 1:
+        await update.message.reply_text(f"已解封用户 {uids[0]}。")
+        return
+    txt = f"已解封 {removed} 个用户（共 {len(uids)} 个 id）。"
+    if bad:
+        txt += f"\n忽略无效 id {len(bad)} 个：{' '.join(bad[:10])}"
+    await update.message.reply_text(txt)
+
+def import_bans_file(t: Tenant, f) -> Tuple[int, int, List[str]]:
+    """在线程里执行：逐行读文件、一次 executemany 写入，返回 (新增, 读到的 id 数, 无效项)"""
+    bad: List[str] = []
+    seen = 0
+
+    def counted(ids):
+        nonlocal seen
+        for uid in ids:
+            seen += 1
+            yield uid
 
-async def unban_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_admin_update(update):
+    lines = io.TextIOWrapper(f, encoding="utf-8-sig", errors="replace")
+    added = t.ban_users(counted(iter_user_ids(lines, bad)))
+    return added, seen, bad
+
+async def import_bans_cmd(update: Update, context: TenantContext):
+    """发送文件时附言 /import_bans，或用 /import_bans 回复一条文件消息"""
+    t = context.tenant
+    if not t.is_admin_update(update):
+        return
+    msg = update.effective_message
+    doc = msg.document or (msg.reply_to_message.document if msg.reply_to_message else None)
+    if doc is None:
+        await msg.reply_text("用法：发送 CSV / 文本文件（每行或逗号分隔的 user_id）并附言 /import_bans，或用 /import_bans 回复该文件。")
+        return
+    progress = await msg.reply_text("📥 正在导入封禁列表…")
+    with tempfile.TemporaryFile() as f:
+        tg_file = await doc.get_file()
+        await tg_file.download_to_memory(out=f)
+        f.seek(0)
+        added, seen, bad = await asyncio.to_thread(import_bans_file, t, f)
+    ended, dropped = t.purge_banned_sessions()
+    notify_users_bulk(context, ended + dropped, "🚫 你已被管理员封禁，无法与管理员聊天。")
+    txt = f"✅ 导入完成：读取 {seen} 个 id，新增封禁 {added} 个，断开 {len(ended)} 个会话，撤销 {len(dropped)} 个申请。"
+    if bad:
+        txt += f"\n忽略无效项 {len(bad)} 个：{' '.join(bad[:10])}"
+    await progress.edit_text(txt)
+
+def export_bans_file(t: Tenant, f) -> int:
+    f.write(b"user_id\n")
+    n = 0
+    for uid in t.state_store.backend.iter_members("banned"):
+        f.write(b"%d\n" % uid)
+        n += 1
+    return n
+
+async def export_bans_cmd(update: Update, context: TenantContext):
+    t = context.tenant
+    if not t.is_admin_update(update):
+        return
+    with tempfile.TemporaryFile() as f:
+        n = await asyncio.to_thread(export_bans_file, t, f)
+        f.seek(0)
+        # read_file_handle=False：上传时分块读文件，不把整份 CSV 读进内存
+        doc = InputFile(f, filename="banned_users.csv", read_file_handle=False)
+        await update.message.reply_document(document=doc, caption=f"封禁列表，共 {n} 个用户")
+
+async def list_cmd(update: Update, context: TenantContext):
+    t = context.tenant
+    if not t.is_admin_update(update):
+        return
+    active, pending = await t.active_sessions.global_members(), await t.pending_requests.global_members()
+    txt = f"🟢 活动会话（{len(active)}）：\n" + ("\n".join(map(str, active)) if active else "无")
+    txt += f"\n\n⏳ 待处理申请（{len(pending)}）：\n" + ("\n".join(map(str, pending)) if pending else "无")
+    await update.message.reply_text(txt)
+
+async def handoff_cmd(update: Update, context: TenantContext):
+    t = context.tenant
+    if not t.is_admin_update(update):
         return
     if not context.args:
-        await update.message.reply_text("用法：/unban <user_id>")
+        await update.message.reply_text("用法：/handoff <user_id> [admin_id]")
         return
     try:
         uid = int(context.args[0])
+        target = int(context.args[1]) if len(context.args) > 1 else None
     except ValueError:
-        await update.message.reply_text("user_id 必须是数字")
+        await update.message.reply_text("user_id / admin_id 必须是数字")
+        return
+    if uid not in t.active_sessions:
+        await update.message.reply_text("该用户当前没有活动会话。")
+        return
+    current = t.session_router.admin_of(uid)
+    if target is None:
+        target = t.session_router.pick(exclude={current, update.effective_user.id} - {None})
+    elif target not in t.numeric_admin_ids:
+        await update.message.reply_text("目标不是已注册的管理员 id。")
         return
-    unban_user_db(uid)
-    await update.message.reply_text(f"已解封用户 {uid}。")
+    if target is None:
+        await update.message.reply_text("没有其他可用的管理员。")
+        return
+    t.session_router.assign(uid, target)
+    await update.message.reply_text(f"已将用户 {uid} 的会话移交给管理员 {target}。")
+    try:
+        await context.bot.send_message(chat_id=target, text=f"📨 用户 `{uid}` 的会话已移交给你。", parse_mode="Markdown")
+    except Exception:
+        t.log.exception(f"无法通知管理员 {target} 会话移交")
 
-async def list_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_admin_update(update):
+async def stats_cmd(update: Update, context: TenantContext):
+    t = context.tenant
+    if not t.is_admin_update(update):
         return
-    txt = f"🟢 活动会话（{len(active_sessions)}）：\n" + ("\n".join(map(str, active_sessions)) if active_sessions else "无")
-    txt += f"\n\n⏳ 待处理申请（{len(pending_requests)}）：\n" + ("\n".join(map(str, pending_requests)) if pending_requests else "无")
+    banned = len(t.banned_index) if WORKERS <= 1 else await asyncio.to_thread(t.state_store.backend.count, "banned")
+    active, pending = await t.active_sessions.global_members(), await t.pending_requests.global_members()
+    txt = f"🟢 活动会话：{len(active)}\n⏳ 待处理申请：{len(pending)}\n🚫 封禁用户：{banned}\n"
+    if WORKERS > 1:
+        txt += f"🧩 worker {WORKER_INDEX + 1}/{WORKERS}（以下统计只含本进程）\n"
+    txt += t.admin_msgid_to_user.stats_text() + "\n"
+    txt += t.relay_batcher.stats_text() + "\n"
+    txt += t.message_limiter.stats_text() + "\n"
+    txt += t.callback_limiter.stats_text() + "\n"
+    txt += f"限流自动封禁：{t.flood_bans}\n"
+    txt += t.archive.stats_text() + "\n"
+    txt += t.expiry.stats_text() + "\n"
+    txt += t.apply_digest.stats_text() + "\n"
+    txt += t.update_lanes.stats_text() + "\n"
+    txt += t.backlog.stats_text() + "\n"
+    txt += t.outbox.stats_text()
     await update.message.reply_text(txt)
 
-async def send_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_admin_update(update):
+async def send_cmd(update: Update, context: TenantContext):
+    t = context.tenant
+    if not t.is_admin_update(update):
         return
     if len(context.args) < 2:
         await update.message.reply_text("用法：/send <user_id> <消息>")
@@ -284,185 +2883,279 @@ async def send_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     text = " ".join(context.args[1:])
     try:
-        await context.bot.send_message(chat_id=uid, text=text)
+        sent = await context.bot.send_message(chat_id=uid, text=text)
+        t.archive.add_message(uid, "out", sent, admin_id=update.effective_user.id)
+        t.expiry.timer.touch("active", uid)
         await update.message.reply_text("已发送。")
     except Exception as e:
         await update.message.reply_text(f"发送失败：{e}")
 
-async def broadcast_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_admin_update(update):
+async def broadcast_cmd(update: Update, context: TenantContext):
+    t = context.tenant
+    if not t.is_admin_update(update):
         return
     if not context.args:
         await update.message.reply_text("用法：/broadcast <消息>")
         return
     text = " ".join(context.args)
-    count = 0
-    for uid in list(active_sessions):
-        try:
-            await context.bot.send_message(chat_id=uid, text=text)
-            count += 1
-        except:
-            pass
-    await update.message.reply_text(f"已向 {count} 个活动用户广播。")
+    recipients = list(await t.active_sessions.global_members())
+    progress = await update.message.reply_text(f"📣 开始向 {len(recipients)} 个活动用户广播…")
+    # 后台执行，命令立即返回，不阻塞其它更新
+    context.application.create_task(run_broadcast(t, context.bot, text, recipients, progress), update=update)
+
+async def search_page(t: Tenant, query: str, page: int) -> Tuple[str, Optional[InlineKeyboardMarkup]]:
+    total, hits = await asyncio.to_thread(t.archive.search, query, page * SEARCH_PAGE_SIZE, SEARCH_PAGE_SIZE)
+    if not total:
+        return f"🔍 没有找到与「{query}」相关的记录。", None
+    pages = -(-total // SEARCH_PAGE_SIZE)
+    lines = [f"🔍「{query}」共 {total} 条，第 {page + 1}/{pages} 页"]
+    for uid, direction, ts, snippet in hits:
+        stamp = time.strftime("%Y-%m-%d %H:%M", time.localtime(ts))
+        lines.append(f"\n👤 {uid} · {t.archive.DIRECTIONS[direction]} · {stamp}\n{snippet}")
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton("⬅️ 上一页", callback_data=f"search_page:{page - 1}"))
+    if page < pages - 1:
+        nav.append(InlineKeyboardButton("下一页 ➡️", callback_data=f"search_page:{page + 1}"))
+    return "\n".join(lines), (InlineKeyboardMarkup([nav]) if nav else None)
+
+async def search_cmd(update: Update, context: TenantContext):
+    t = context.tenant
+    if not t.is_admin_update(update):
+        return
+    if not context.args:
+        await update.message.reply_text("用法：/search <关键词>（多个关键词用空格分隔，需同时出现）")
+        return
+    # 翻页按钮的 callback_data 放不下查询词，记在该管理员的 user_data 里
+    query = context.user_data["search_query"] = " ".join(context.args)
+    text, kb = await search_page(t, query, 0)
+    await update.message.reply_text(text, reply_markup=kb)
+
+async def export_cmd(update: Update, context: TenantContext):
+    t = context.tenant
+    if not t.is_admin_update(update):
+        return
+    if not context.args:
+        await update.message.reply_text("用法：/export <user_id>")
+        return
+    try:
+        uid = int(context.args[0])
+    except ValueError:
+        await update.message.reply_text("user_id 必须是数字")
+        return
+    # 先落到临时文件（磁盘），再作为文档上传
+    with tempfile.TemporaryFile() as f:
+        n = await asyncio.to_thread(t.archive.export, uid, f)
+        if not n:
+            await update.message.reply_text(f"用户 {uid} 没有存档记录。")
+            return
+        f.seek(0)
+        # read_file_handle=False：上传时从文件分块读取，不把整份记录读进内存
+        doc = InputFile(f, filename=f"transcript_{uid}.txt", read_file_handle=False)
+        await update.message.reply_document(document=doc, caption=f"用户 {uid} 的会话记录，共 {n} 条")
 
 # ----------------- CALLBACK HANDLER -----------------
-async def callback_query_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+def parse_item_callback(data: str) -> Tuple[int, Optional[int]]:
+    """admin_xxx:<uid>[:<page>]，带页码表示按钮来自分页视图"""
+    parts = data.split(":")
+    return int(parts[1]), (int(parts[2]) if len(parts) > 2 else None)
+
+async def show_admin_view(t: Tenant, query, kind: str, page: int, notice: str = ""):
+    index = t.pending_requests if kind == "pending" else t.active_sessions
+    if not await index.global_members():
+        empty = "当前没有待处理申请。" if kind == "pending" else "当前没有活动会话。"
+        text, kb = (notice + "\n\n" if notice else "") + empty, admin_panel_keyboard()
+    else:
+        text, kb = await admin_view_page(t, kind, page)
+        if notice:
+            text = notice + "\n\n" + text
+    try:
+        await query.edit_message_text(text, reply_markup=kb, parse_mode="Markdown")
+    except BadRequest as e:
+        # 刷新同一页且内容未变时 Telegram 会报 "message is not modified"
+        if "not modified" not in str(e).lower():
+            raise
+
+async def finish_item_action(t: Tenant, query, kind: str, page: Optional[int], result: str):
+    """单条通知里的按钮：把消息改成结果；分页视图里的按钮：原地刷新当前页"""
+    if page is None:
+        await query.edit_message_text(result, parse_mode="Markdown")
+    else:
+        await show_admin_view(t, query, kind, page, notice=result)
+
+async def answer_query(query, text: Optional[str] = None):
+    """应答按钮回调。超过约 15 秒的回调（积压回放时）已无法应答，失败不影响执行操作本身"""
+    try:
+        await query.answer(text=text)
+    except BadRequest as e:
+        logger.debug(f"应答回调失败: {e}")
+
+async def callback_query_handler(update: Update, context: TenantContext):
+    t = context.tenant
     query = update.callback_query
-    await query.answer()
     data = query.data
     caller = query.from_user
     caller_uid = caller.id
     caller_username = caller.username
 
+    if data.startswith("user_") and not t.is_admin_update(update):
+        ok, notify = await check_flood(t.callback_limiter, caller_uid, context)
+        if not ok:
+            # 每个窗口只提醒一次，其余静默应答
+            await answer_query(query, "操作太频繁，请稍后再试。" if notify else None)
+            return
+    await answer_query(query)
+
     # ---- user actions ----
     if data == "user_apply":
-        if is_banned_db(caller_uid):
+        if t.is_banned(caller_uid):
             await query.edit_message_text("你已被封禁，无法申请。")
             return
-        if caller_uid in active_sessions:
+        if caller_uid in t.active_sessions:
             await query.edit_message_text("你已在会话中，点结束以断开。", reply_markup=user_main_keyboard(False, True))
             return
-        if caller_uid in pending_requests:
+        if caller_uid in t.pending_requests:
             await query.edit_message_text("你已申请，请耐心等待。", reply_markup=user_main_keyboard(True, False))
             return
-        pending_requests.add(caller_uid)
+        t.pending_requests.add(caller_uid)
+        t.expiry.timer.track("pending", caller_uid)
         await query.edit_message_text("✅ 已发送申请，请等待管理员确认。", reply_markup=user_main_keyboard(True, False))
-        await notify_admins_new_request(caller_uid, caller_username, context)
+        t.apply_digest.submit(context, caller_uid, caller_username)
         return
 
     if data == "user_cancel":
-        if caller_uid in pending_requests:
-            pending_requests.discard(caller_uid)
+        if caller_uid in t.pending_requests:
+            t.pending_requests.discard(caller_uid)
             await query.edit_message_text("已取消申请。", reply_markup=user_main_keyboard(False, False))
             # notify admins optionally
-            for name in ADMIN_USERNAMES:
-                try:
-                    await context.bot.send_message(chat_id=f"@{name}", text=f"ℹ️ 用户 `{caller_uid}` 取消了申请。", parse_mode="Markdown")
-                except:
-                    pass
+            fan_out_to_admins(context, f"ℹ️ 用户 `{caller_uid}` 取消了申请。", parse_mode="Markdown")
         else:
             await query.edit_message_text("你当前没有申请。", reply_markup=user_main_keyboard(False, False))
         return
 
     if data == "user_end":
-        if caller_uid in active_sessions:
-            active_sessions.discard(caller_uid)
+        if caller_uid in t.active_sessions:
+            t.end_session(caller_uid)
             await query.edit_message_text("你已结束会话。", reply_markup=user_main_keyboard(False, False))
-            for name in ADMIN_USERNAMES:
-                try:
-                    await context.bot.send_message(chat_id=f"@{name}", text=f"⚠️ 用户 `{caller_uid}` 已结束会话。", parse_mode="Markdown")
-                except:
-                    pass
+            fan_out_to_admins(context, f"⚠️ 用户 `{caller_uid}` 已结束会话。", parse_mode="Markdown")
         else:
             await query.edit_message_text("你当前没有会话。", reply_markup=user_main_keyboard(False, False))
         return
 
     # ---- admin actions ----
-    if data == "admin_view_pending":
-        if not is_admin_update(update):
+    if data in ("admin_view_pending", "admin_view_active") or data.startswith("admin_page:"):
+        if not t.is_admin_update(update):
             await query.edit_message_text("仅管理员可查看。")
             return
-        if not pending_requests:
-            await query.edit_message_text("当前没有待处理申请。", reply_markup=admin_panel_keyboard())
-            return
-        await query.edit_message_text("以下为待处理申请：", reply_markup=admin_panel_keyboard())
-        for uid in list(pending_requests):
-            txt = f"📌 申请用户 ID: `{uid}`"
-            try:
-                # send to this admin (by numeric if possible, else by username)
-                target_chat = update.effective_user.id if update.effective_user.id in numeric_admin_ids else f"@{update.effective_user.username}"
-                await context.bot.send_message(chat_id=target_chat, text=txt, reply_markup=pending_item_kb(uid), parse_mode="Markdown")
-            except:
-                logger.exception("向管理员发送 pending item 失败")
+        if data.startswith("admin_page:"):
+            _, kind, page = data.split(":")
+            page = int(page)
+        else:
+            kind, page = data[len("admin_view_"):], 0
+        await show_admin_view(t, query, kind, page)
         return
 
-    if data == "admin_view_active":
-        if not is_admin_update(update):
-            await query.edit_message_text("仅管理员可查看。")
+    if data == "admin_panel":
+        await query.edit_message_text("管理面板：", reply_markup=admin_panel_keyboard())
+        return
+
+    if data.startswith(("digest_accept:", "digest_reject:", "digest_review:")):
+        if not t.is_admin_update(update):
             return
-        if not active_sessions:
-            await query.edit_message_text("当前没有活动会话。", reply_markup=admin_panel_keyboard())
+        action, _, digest_id = data.split(":")
+        if action == "digest_review":
+            text, kb = await admin_view_page(t, "pending", 0)
+            await context.bot.send_message(chat_id=caller_uid, text=text, reply_markup=kb, parse_mode="Markdown")
             return
-        await query.edit_message_text("活动会话列表：", reply_markup=admin_panel_keyboard())
-        for uid in list(active_sessions):
-            txt = f"🟢 活动用户 ID: `{uid}`"
-            try:
-                target_chat = update.effective_user.id if update.effective_user.id in numeric_admin_ids else f"@{update.effective_user.username}"
-                await context.bot.send_message(chat_id=target_chat, text=txt, reply_markup=active_item_kb(uid), parse_mode="Markdown")
-            except:
-                logger.exception("向管理员发送 active item 失败")
+        resolved = t.apply_digest.resolve(int(digest_id))
+        if resolved is None:
+            await query.edit_message_text("该汇总已过期，请在管理面板“查看申请”中逐个处理。", reply_markup=admin_panel_keyboard())
+            return
+        digest, uids = resolved
+        who = f"@{caller_username}" if caller_username else str(caller_uid)
+        if action == "digest_accept":
+            for uid in uids:
+                t.start_session(uid, caller_uid)
+            notify_users_bulk(context, uids, "✅ 管理员已同意你的申请，你现在已连接到管理员。")
+            digest.note = f"{who} 已全部同意 {len(uids)} 个"
+        else:
+            for uid in uids:
+                t.pending_requests.discard(uid)
+            notify_users_bulk(context, uids, "很抱歉，管理员拒绝了你的聊天申请。")
+            digest.note = f"{who} 已全部拒绝 {len(uids)} 个"
+        # 所有管理员的汇总消息同步为处理后的状态
+        context.application.create_task(t.apply_digest.render(context.bot, digest))
         return
 
     if data.startswith("admin_accept:"):
         try:
-            uid = int(data.split(":",1)[1])
-        except:
+            uid, page = parse_item_callback(data)
+        except (ValueError, IndexError):
             await query.edit_message_text("ID 格式错误")
             return
-        if uid in pending_requests:
-            pending_requests.discard(uid)
-            active_sessions.add(uid)
-            await query.edit_message_text(f"✅ 已同意用户 `{uid}` 的申请。", parse_mode="Markdown")
+        if uid in t.pending_requests:
+            t.start_session(uid, caller_uid)
+            await finish_item_action(t, query, "pending", page, f"✅ 已同意用户 `{uid}` 的申请。")
             try:
                 await context.bot.send_message(chat_id=uid, text="✅ 管理员已同意你的申请，你现在已连接到管理员。")
-            except:
-                pass
+            except TelegramError as e:
+                t.log.warning(f"无法通知用户 {uid}：{e}")
             try:
                 await context.bot.send_message(chat_id=caller_uid, text=f"🟢 已与用户 `{uid}` 建立连接。", parse_mode="Markdown")
-            except:
-                pass
+            except TelegramError as e:
+                t.log.warning(f"无法通知管理员 {caller_uid}：{e}")
         else:
-            await query.edit_message_text("该用户不在申请队列或已被处理。")
+            await finish_item_action(t, query, "pending", page, "该用户不在申请队列或已被处理。")
         return
 
     if data.startswith("admin_reject:"):
         try:
-            uid = int(data.split(":",1)[1])
-        except:
+            uid, page = parse_item_callback(data)
+        except (ValueError, IndexError):
             await query.edit_message_text("ID 格式错误")
             return
-        if uid in pending_requests:
-            pending_requests.discard(uid)
-            await query.edit_message_text(f"❌ 已拒绝用户 `{uid}` 的申请。", parse_mode="Markdown")
+        if uid in t.pending_requests:
+            t.pending_requests.discard(uid)
+            await finish_item_action(t, query, "pending", page, f"❌ 已拒绝用户 `{uid}` 的申请。")
             try:
                 await context.bot.send_message(chat_id=uid, text="很抱歉，管理员拒绝了你的聊天申请。")
-            except:
-                pass
+            except TelegramError as e:
+                t.log.warning(f"无法通知用户 {uid}：{e}")
         else:
-            await query.edit_message_text("该用户不在申请队列或已被处理。")
+            await finish_item_action(t, query, "pending", page, "该用户不在申请队列或已被处理。")
         return
 
     if data.startswith("admin_end:"):
         try:
-            uid = int(data.split(":",1)[1])
-        except:
+            uid, page = parse_item_callback(data)
+        except (ValueError, IndexError):
             await query.edit_message_text("ID 格式错误")
             return
-        if uid in active_sessions:
-            active_sessions.discard(uid)
-            await query.edit_message_text(f"🔚 已结束用户 `{uid}` 的会话。", parse_mode="Markdown")
+        if uid in t.active_sessions:
+            t.end_session(uid)
+            await finish_item_action(t, query, "active", page, f"🔚 已结束用户 `{uid}` 的会话。")
             try:
                 await context.bot.send_message(chat_id=uid, text="⚠️ 管理员已结束本次会话。")
-            except:
-                pass
+            except TelegramError as e:
+                t.log.warning(f"无法通知用户 {uid}：{e}")
         else:
-            await query.edit_message_text("该用户当前没有活动会话。")
+            await finish_item_action(t, query, "active", page, "该用户当前没有活动会话。")
         return
 
     if data.startswith("admin_ban:"):
         try:
-            uid = int(data.split(":",1)[1])
-        except:
+            uid, page = parse_item_callback(data)
+        except (ValueError, IndexError):
             await query.edit_message_text("ID 格式错误")
             return
-        ban_user_db(uid)
-        pending_requests.discard(uid)
-        active_sessions.discard(uid)
-        await query.edit_message_text(f"🚫 已封禁用户 `{uid}`。", parse_mode="Markdown")
+        await asyncio.to_thread(t.ban_user, uid)
+        t.pending_requests.discard(uid)
+        t.end_session(uid)
+        await finish_item_action(t, query, "active", page, f"🚫 已封禁用户 `{uid}`。")
         try:
             await context.bot.send_message(chat_id=uid, text="你已被管理员封禁，无法再申请或接收管理员消息。")
-        except:
-            pass
+        except TelegramError as e:
+            t.log.warning(f"无法通知用户 {uid}：{e}")
         return
 
     if data == "admin_hint_connect":
@@ -473,112 +3166,822 @@ async def callback_query_handler(update: Update, context: ContextTypes.DEFAULT_T
         await query.edit_message_text("管理员帮助：使用 /help 查看完整命令。", reply_markup=admin_panel_keyboard())
         return
 
+    if data.startswith("search_page:"):
+        if not t.is_admin_update(update):
+            return
+        search_query = context.user_data.get("search_query")
+        if search_query is None:
+            await query.edit_message_text("搜索结果已过期，请重新 /search。")
+            return
+        text, kb = await search_page(t, search_query, int(data.split(":")[1]))
+        await query.edit_message_text(text, reply_markup=kb)
+        return
+
     await query.answer(text="未识别的操作。")
 
 # ----------------- MESSAGE RELAY -----------------
-async def message_relay_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def copy_batch_to(t: Tenant, bot, chat_id, sender_id: int, msgs: List[Message]):
+    """单条用 copyMessage，多条用一次 copyMessages；按 (管理员聊天 id, 消息 id) 记录所有生成的 admin 消息"""
+    t.relay_batcher.api_calls += 1
+    if len(msgs) == 1:
+        ids = [(await msgs[0].copy(chat_id=chat_id)).message_id]
+    else:
+        copied = await bot.copy_messages(chat_id=chat_id, from_chat_id=sender_id, message_ids=sorted(m.message_id for m in msgs))
+        ids = [m.message_id for m in copied]
+    admin_chat_id = await resolve_chat_id(t, bot, chat_id) if ids else None
+    for mid in ids:
+        t.admin_msgid_to_user[(admin_chat_id, mid)] = sender_id
+
+async def resolve_chat_id(t: Tenant, bot, chat_id) -> int:
+    """"@name" 形式的目标换成数字聊天 id（回复映射的 key 需要它），优先用已缓存的管理员 id"""
+    if isinstance(chat_id, int):
+        return chat_id
+    aid = t.admin_ids_by_username.get(chat_id.lstrip("@").lower())
+    if aid is None:
+        aid = (await bot.get_chat(chat_id)).id
+    return aid
+
+def chat_unreachable(e: TelegramError) -> bool:
+    """目标聊天本身不可达（bot 被屏蔽 / 聊天不存在），而不是这一次请求出错"""
+    return isinstance(e, Forbidden) or (isinstance(e, BadRequest) and "chat not found" in e.message.lower())
+
+async def relay_to_admin(t: Tenant, bot, sender_id: int, msgs: List[Message]) -> bool:
+    # 会话固定路由到分配的管理员；不可达时迁移到下一个。返回 False 表示没有可达的管理员
+    tried: Set[int] = set()
+    aid = t.session_router.route(sender_id)
+    while aid is not None and aid not in tried:
+        try:
+            await copy_batch_to(t, bot, aid, sender_id, msgs)
+            return True
+        except RetryAfter:
+            raise
+        except TelegramError as e:
+            if not chat_unreachable(e):
+                # 消息在攒批窗口内被用户删掉、超时、网络错误等，不是管理员的问题：不迁移会话
+                t.log.warning(f"转发用户 {sender_id} 的消息给管理员 {aid} 失败，跳过：{e}")
+                return True
+            tried.add(aid)
+            t.session_router.mark_unreachable(aid)
+            aid = t.session_router.route(sender_id)
+    # fallback: try username list
+    for name in t.admin_resolver.usernames:
+        try:
+            await copy_batch_to(t, bot, f"@{name}", sender_id, msgs)
+            return True
+        except TelegramError as e:
+            t.log.warning(f"转发用户 {sender_id} 的消息给 @{name} 失败：{e}")
+    return False
+
+class RelayBatcher:
+    """用户 -> 管理员的消息攒批：同一用户 window 秒内的连续消息（包括相册）
+    合并成一次 copyMessages 转发；同一用户的批次严格按顺序发送"""
+
+    MAX_BATCH = 100  # copyMessages 单次上限
+
+    def __init__(self, t: Tenant, window: float):
+        self.tenant = t
+        self.window = window
+        self._buffers: Dict[int, List[Message]] = {}
+        self._tails: Dict[int, asyncio.Task] = {}
+        self._bot = None
+        self.messages = 0
+        self.api_calls = 0
+
+    def add(self, bot, sender_id: int, msg: Message):
+        self._bot = bot
+        self.messages += 1
+        if self.window <= 0:
+            self._schedule(bot, sender_id, [msg])
+            return
+        buf = self._buffers.get(sender_id)
+        if buf is None:
+            buf = self._buffers[sender_id] = []
+            asyncio.get_running_loop().call_later(self.window, self._flush, bot, sender_id)
+        buf.append(msg)
+        if len(buf) >= self.MAX_BATCH:
+            self._flush(bot, sender_id)
+
+    def _flush(self, bot, sender_id: int):
+        batch = self._buffers.pop(sender_id, None)
+        if batch:
+            self._schedule(bot, sender_id, batch)
+
+    def _schedule(self, bot, sender_id: int, batch: List[Message]):
+        prev = self._tails.get(sender_id)
+        task = asyncio.create_task(self._send_after(prev, bot, sender_id, batch))
+        self._tails[sender_id] = task
+        task.add_done_callback(lambda t: self._tails.pop(sender_id) if self._tails.get(sender_id) is t else None)
+
+    async def _send_after(self, prev: Optional[asyncio.Task], bot, sender_id: int, batch: List[Message]):
+        if prev is not None:
+            await asyncio.wait([prev])
+        try:
+            if not await relay_to_admin(self.tenant, bot, sender_id, batch):
+                await batch[-1].reply_text("发送失败：管理员不可达。")
+        except Exception:
+            self.tenant.log.exception("user -> admin copy failed")
+            try:
+                await batch[-1].reply_text("发送失败，请稍后重试。")
+            except TelegramError as e:
+                self.tenant.log.warning(f"无法通知用户 {sender_id} 发送失败：{e}")
+
+    async def drain(self):
+        """立即发出所有攒批中的消息并等待全部发送完成（用于优雅退出）"""
+        for sender_id in list(self._buffers):
+            self._flush(self._bot, sender_id)
+        while self._tails:
+            await asyncio.wait(list(self._tails.values()))
+
+    def stats_text(self) -> str:
+        return f"转发：{self.messages} 条用户消息，{self.api_calls} 次复制调用"
+
+async def message_relay_handler(update: Update, context: TenantContext):
+    t = context.tenant
     msg: Message = update.effective_message
     sender_id = update.effective_user.id
 
     # ADMIN path: if admin replies to one of the admin-side messages (we mapped msg_id->user)
-    if is_admin_update(update):
+    if t.is_admin_update(update):
         reply = msg.reply_to_message
-        if reply and reply.message_id in admin_msgid_to_user:
-            target_user = admin_msgid_to_user[reply.message_id]
+        target_user = await t.admin_msgid_to_user.get((msg.chat_id, reply.message_id)) if reply else None
+        if target_user is not None:
             try:
-                copied = await msg.copy(chat_id=target_user)
-                user_last_admin_msgid[target_user] = copied.message_id
+                await msg.copy(chat_id=target_user)
+                t.archive.add_message(target_user, "out", msg, admin_id=sender_id)
+                t.expiry.timer.touch("active", target_user)
                 await msg.reply_text(f"已发送给用户 {target_user}")
             except Exception as e:
-                logger.exception("admin -> user copy failed")
+                t.log.exception("admin -> user copy failed")
                 await msg.reply_text(f"发送失败：{e}")
             return
         await msg.reply_text("要回复某个用户，请在管理面板查看活动会话并回复对应消息，或使用 /connect <user_id>。")
         return
 
     # USER path
-    if is_banned_db(sender_id):
+    if t.is_banned(sender_id):
         await msg.reply_text("你已被封禁，无法使用该服务。")
         return
 
-    if sender_id in active_sessions:
-        try:
-            # send to first numeric admin if available, else try username of first admin
-            sent_to = None
-            # try numeric admins first
-            for aid in numeric_admin_ids:
-                try:
-                    copied = await msg.copy(chat_id=aid)
-                    admin_msgid_to_user[copied.message_id] = sender_id
-                    user_last_admin_msgid[sender_id] = copied.message_id
-                    sent_to = aid
-                    break
-                except:
-                    continue
-            if sent_to is None:
-                # fallback: try username list
-                for name in ADMIN_USERNAMES:
-                    try:
-                        copied = await msg.copy(chat_id=f"@{name}")
-                        admin_msgid_to_user[copied.message_id] = sender_id
-                        user_last_admin_msgid[sender_id] = copied.message_id
-                        sent_to = name
-                        break
-                    except:
-                        continue
-            if sent_to is None:
-                await msg.reply_text("发送失败：管理员不可达。")
-        except Exception:
-            logger.exception("user -> admin copy failed")
-            try:
-                await msg.reply_text("发送失败，请稍后重试。")
-            except:
-                pass
+    ok, notify = await check_flood(t.message_limiter, sender_id, context)
+    if not ok:
+        if notify and not t.is_banned(sender_id):
+            await msg.reply_text("⚠️ 你发送得太快了，部分消息未转发，请稍后再试。")
+        return
+
+    if sender_id in t.active_sessions:
+        t.relay_batcher.add(context.bot, sender_id, msg)
+        t.archive.add_message(sender_id, "in", msg)
+        t.expiry.timer.touch("active", sender_id)
         return
 
-    if sender_id in pending_requests:
+    if sender_id in t.pending_requests:
         await msg.reply_text("⏳ 你的申请正在等待管理员处理，请耐心等待或点击取消。", reply_markup=user_main_keyboard(is_pending=True, is_active=False))
         return
 
     await msg.reply_text("你当前尚未申请与管理员聊天。点击下面按钮申请：", reply_markup=user_main_keyboard(is_pending=False, is_active=False))
     return
 
-# ----------------- STARTUP / MAIN -----------------
-def main():
-    init_db()
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+# ----------------- UPDATE LANES -----------------
+# 管理员针对某个用户的操作：按钮（callback_data 第二段是 user_id）和第一个参数是 user_id 的命令；
+# 申请汇总的按钮第二段是生成它的 worker 编号，按它分道 / 分片，回到持有这一轮汇总的进程
+TARGET_CALLBACKS = ("admin_accept:", "admin_reject:", "admin_end:", "admin_ban:", "digest_accept:", "digest_reject:", "digest_review:")
+TARGET_COMMANDS = frozenset({"connect", "end", "ban", "unban", "send", "handoff", "export"})
+
+def lane_key(t: Tenant, update: Update) -> Optional[int]:
+    """更新作用于哪个用户：管理员对某个用户的操作（按钮、带 user_id 的命令、回复转发来的消息）
+    归到该用户，和用户自己的消息排在同一条车道上；其余按发送者"""
+    user = update.effective_user
+    if user is None:
+        return None
+    if not t.is_admin_update(update):
+        return user.id
+    cq = update.callback_query
+    if cq is not None:
+        if cq.data and cq.data.startswith(TARGET_CALLBACKS):
+            try:
+                return int(cq.data.split(":")[1])
+            except (ValueError, IndexError):
+                pass
+        return user.id
+    msg = update.effective_message
+    if msg is not None:
+        parts = (msg.text or "").split()
+        if parts and parts[0].startswith("/") and parts[0][1:].split("@")[0] in TARGET_COMMANDS:
+            if len(parts) > 1 and parts[1].lstrip("-").isdigit():
+                return int(parts[1])
+        if msg.reply_to_message is not None:
+            target = t.admin_msgid_to_user.cached((msg.chat_id, msg.reply_to_message.message_id))[1]
+            if target is not None:
+                return target
+    return user.id
+
+async def resolve_lane(t: Tenant, update: Update) -> Optional[int]:
+    """lane_key 之前先确保管理员回复的那条消息的映射在内存里（热层或未命中缓存），
+    回表在线程里做，结果留给处理器直接用"""
+    msg = update.effective_message
+    if (update.callback_query is None and msg is not None and msg.reply_to_message is not None
+            and t.is_admin_update(update)):
+        await t.admin_msgid_to_user.get((msg.chat_id, msg.reply_to_message.message_id), count=False)
+    return lane_key(t, update)
+
+class LaneUpdateProcessor(BaseUpdateProcessor):
+    """并发处理更新，同一车道（用户）内严格按到达顺序：
+    - 不同用户的更新最多 concurrency 个同时执行；
+    - 同一车道的更新排成链，前一个结束后一个才开始（排队时不占执行名额）；
+    - 每条车道最多积压 lane_limit 个更新，超出的丢弃（单用户限流本来也会丢），按发送者计数，
+      车道排空前只提醒发送者一次；
+    - 车道排空即删除，空闲用户不占内存"""
+
+    def __init__(self, t: Tenant, concurrency: int, lane_limit: int):
+        # 基类的信号量只用来让 Application 进入并发模式；真正的并发上限是 self._slots。
+        # 这样 do_process_update 总是按到达顺序立即进入，车道登记的先后就是更新的先后
+        super().__init__(2 ** 30)
+        self.tenant = t
+        self.concurrency = concurrency
+        self.lane_limit = lane_limit
+        self._slots: Optional[asyncio.Semaphore] = None
+        # 分道可能要回表（await）；持锁完成分道和登记，保证更新仍按到达顺序进车道。
+        # 不需要回表时锁无竞争，不会让出事件循环
+        self._entry: Optional[asyncio.Lock] = None
+        self._tails: Dict[Optional[int], asyncio.Future] = {}
+        self._depth: Dict[Optional[int], int] = {}
+        self._warned: Set[Optional[int]] = set()  # 满了之后已提醒过发送者、尚未排空的车道
+        self._notices: Set[asyncio.Task] = set()
+        self.processed = 0
+        self.dropped = 0
+        self.dropped_by_user: Dict[int, int] = {}
+
+    async def initialize(self):
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.concurrency)
+            self._entry = asyncio.Lock()
+
+    async def shutdown(self):
+        pass
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        async with self._entry:
+            key = await resolve_lane(self.tenant, update) if isinstance(update, Update) else None
+            if self.tenant.backlog.active:
+                # 这个用户还有没回放的积压：先排进车道，保证他的更新先后不乱
+                self.tenant.backlog.release(key)
+            lane = self._enter(key, coroutine)
+        if lane is None:
+            if isinstance(update, Update):
+                self._on_drop(key, update)
+            return
+        await self._run(key, coroutine, *lane)
+
+    def _on_drop(self, key: Optional[int], update: Update):
+        user = update.effective_user
+        if user is not None:
+            self.dropped_by_user[user.id] = self.dropped_by_user.get(user.id, 0) + 1
+        chat = update.effective_chat
+        if chat is None or key in self._warned:
+            return
+        self._warned.add(key)
+        task = asyncio.create_task(self._notify_dropped(update.get_bot(), chat.id))
+        self._notices.add(task)
+        task.add_done_callback(self._notices.discard)
+
+    async def _notify_dropped(self, bot, chat_id: int):
+        try:
+            await bot.send_message(chat_id=chat_id, text="⚠️ 处理繁忙，你的部分消息未能处理，请稍后重新发送。")
+        except TelegramError as e:
+            self.tenant.log.warning(f"无法提醒 {chat_id} 更新被丢弃：{e}")
+
+    def submit(self, key: Optional[int], coroutine) -> asyncio.Task:
+        """不经 Application 直接把协程排进 key 的车道（积压回放用）。不受 lane_limit 限制：
+        积压已经落盘，丢掉就再也回放不到。登记是同步的，返回执行它的任务"""
+        lane = self._enter(key, coroutine, limit=False)
+        return asyncio.create_task(self._run(key, coroutine, *lane))
+
+    def _enter(self, key: Optional[int], coroutine, limit: bool = True) -> Optional[tuple]:
+        depth = self._depth.get(key, 0)
+        if limit and depth >= self.lane_limit:
+            coroutine.close()
+            self.dropped += 1
+            self.tenant.log.warning(f"车道 {key} 积压超过 {self.lane_limit}，丢弃更新")
+            return None
+        self._depth[key] = depth + 1
+        prev = self._tails.get(key)
+        done = asyncio.get_running_loop().create_future()
+        self._tails[key] = done
+        return prev, done
+
+    async def _run(self, key: Optional[int], coroutine, prev: Optional[asyncio.Future], done: asyncio.Future):
+        started = False
+        try:
+            if prev is not None:
+                await asyncio.shield(prev)
+            async with self._slots:
+                started = True
+                await coroutine
+        finally:
+            if not started:
+                coroutine.close()
+            done.set_result(None)
+            if self._tails.get(key) is done:
+                del self._tails[key]
+            if self._depth[key] == 1:
+                del self._depth[key]
+                self._warned.discard(key)
+            else:
+                self._depth[key] -= 1
+            self.processed += 1
+
+    def lanes(self) -> int:
+        return len(self._tails)
+
+    def stats_text(self) -> str:
+        txt = (
+            f"更新车道：活跃 {len(self._tails)}，积压 {sum(self._depth.values())}，"
+            f"已处理 {self.processed}，丢弃 {self.dropped}（并发上限 {self.concurrency}）"
+        )
+        if self.dropped_by_user:
+            top = heapq.nlargest(5, self.dropped_by_user.items(), key=lambda kv: kv[1])
+            txt += "\n丢弃最多的用户：" + "，".join(f"{uid}×{n}" for uid, n in top)
+        return txt
+
+# ----------------- BACKLOG CATCH-UP -----------------
+# 回放积压的任务里为 True：出站调用降到通知优先级（实时转发先走），也不计入单用户限流
+replaying_backlog: ContextVar[bool] = ContextVar("replaying_backlog", default=False)
+
+class BacklogCatchUp(WriteBehindQueue):
+    """停机期间积压的更新。启动时（updater 开始拉取之前）逐页取回 Telegram 里待取的更新，
+    先写进本地 SQLite 的 catchup 表再确认 offset，然后：
+    - 合并冗余：同一车道里紧挨着的同类更新只留最后一个（连发的 /start、反复点申请 / 取消、
+      对同一条消息同一个按钮的重复点击）；
+    - 以 CATCHUP_RATE 条/秒经更新车道回放，同一用户仍按顺序，且每条车道同时最多一条在途；
+      实时更新由 updater 照常拉取、不受限速，某个用户有实时更新到达时，他剩下的积压排在这条更新之前
+      逐条回放完；回放不受 UPDATE_LANE_LIMIT 限制，已落盘的积压不会被丢弃；
+    - 按 update_id 顺序连续处理完的部分（水位）之前的行从表里删掉：崩溃重启后只回放水位之后的，
+      最多重复水位之后已处理的少数几条"""
+
+    FLUSH_INTERVAL = 0.2  # seconds，崩溃时最多重复这段时间里处理完的几条
+    PAGE = 100
+
+    def __init__(self, t: Tenant, rate: float):
+        super().__init__(self.FLUSH_INTERVAL, t.log)
+        self.tenant = t
+        self.db = t.db
+        self.rate = rate
+        self.table = t.table_prefix + "catchup"
+        self.active = False
+        self.fetched = 0
+        self.coalesced = 0
+        self.replayed = 0
+        self._app = None
+        self._order: deque = deque()  # 表里全部 update_id（升序），水位之后的
+        self._done: Set[int] = set()
+        self._pending: Dict[int, Tuple[Optional[int], Update]] = {}  # 还没排进车道的：update_id -> (车道, 更新)
+        self._by_lane: Dict[Optional[int], List[int]] = {}  # 车道 -> 积压的 update_id（可能含已放行的）
+        self._inflight: Dict[Optional[int], asyncio.Task] = {}  # 车道 -> 按速率放出、还在车道里的那一条
+        self._tasks: Set[asyncio.Task] = set()
+        self._feeder: Optional[asyncio.Task] = None
+
+    def init_schema(self):
+        conn = self.db.get()
+        with self.db.lock:
+            conn.execute(f"CREATE TABLE IF NOT EXISTS {self.table} (update_id INTEGER PRIMARY KEY, data TEXT NOT NULL)")
+            conn.commit()
+
+    def _save(self, updates: List[Update]):
+        conn = self.db.get()
+        with self.db.lock:
+            conn.executemany(
+                f"INSERT OR IGNORE INTO {self.table}(update_id, data) VALUES (?, ?)",
+                [(u.update_id, json.dumps(u.to_dict())) for u in updates],
+            )
+            conn.commit()
+
+    def _load(self) -> List[tuple]:
+        with self.db.lock:
+            return self.db.get().execute(f"SELECT update_id, data FROM {self.table} ORDER BY update_id").fetchall()
+
+    @timed_db("catchup_flush")
+    def _write(self, items: List[tuple]):
+        watermark = max(i[0] for i in items)
+        conn = self.db.get()
+        with self.db.lock:
+            conn.execute(f"DELETE FROM {self.table} WHERE update_id <= ?", (watermark,))
+            conn.commit()
+
+    async def fetch(self, bot) -> int:
+        """把 Telegram 里待取的更新全部取回落盘；每页写入成功后才用下一页的 offset 确认它"""
+        # 上次以 webhook 模式运行时 webhook 仍然挂着，getUpdates 会返回 409 Conflict
+        await bot.delete_webhook()
+        offset = None
+        n = 0
+        while True:
+            updates = await bot.get_updates(offset=offset, timeout=0, limit=self.PAGE)
+            if not updates:
+                break
+            await asyncio.to_thread(self._save, updates)
+            n += len(updates)
+            offset = updates[-1].update_id + 1
+            if len(updates) < self.PAGE:
+                await bot.get_updates(offset=offset, timeout=0, limit=1)
+                break
+        return n
+
+    @staticmethod
+    def coalesce_key(update: Update) -> Optional[tuple]:
+        user = update.effective_user
+        if user is None:
+            return None
+        cq = update.callback_query
+        if cq is not None:
+            if cq.data in ("user_apply", "user_cancel"):
+                return ("apply", user.id)
+            return ("callback", user.id, cq.data, cq.message.message_id if cq.message else None)
+        msg = update.message
+        if msg is not None and msg.text and msg.text.split()[0].split("@")[0] == "/start":
+            return ("start", user.id)
+        return None
+
+    def _coalesce(self, updates: List[Update]) -> List[Update]:
+        last: Dict[Optional[int], Tuple[Optional[tuple], int]] = {}
+        dropped: Set[int] = set()
+        for u in updates:
+            key = lane_key(self.tenant, u)
+            ckey = self.coalesce_key(u)
+            prev = last.get(key)
+            if ckey is not None and prev is not None and prev[0] == ckey:
+                dropped.add(prev[1])
+            last[key] = (ckey, u.update_id)
+        self.coalesced += len(dropped)
+        for uid in dropped:
+            self._mark_done(uid)
+        return [u for u in updates if u.update_id not in dropped]
+
+    async def catch_up(self, app):
+        """post_init 里调用：取回积压、合并，后台开始回放"""
+        await asyncio.to_thread(self.init_schema)
+        self.fetched = await self.fetch(app.bot)
+        rows = await asyncio.to_thread(self._load)
+        if not rows:
+            return
+        self._app = app
+        updates = [Update.de_json(json.loads(data), app.bot) for _, data in rows]
+        for u in updates:
+            await resolve_lane(self.tenant, u)  # 管理员回复的映射先装进内存，下面分道时不用回表
+        self._order.extend(u.update_id for u in updates)
+        for u in self._coalesce(updates):
+            key = lane_key(self.tenant, u)
+            self._pending[u.update_id] = (key, u)
+            self._by_lane.setdefault(key, []).append(u.update_id)
+        self.log.info(
+            f"积压更新 {len(rows)} 条（本次取回 {self.fetched}），合并掉 {self.coalesced} 条，"
+            f"以 {self.rate:g} 条/秒回放"
+        )
+        self.active = True
+        self.start()
+        self._feeder = asyncio.create_task(self._feed())
+
+    async def _replay(self, updates: List[Update]):
+        """在车道里按顺序处理同一用户的若干条积压，每条处理完才推进水位；
+        被取消（停机）时剩下的不算完成，下次启动接着回放"""
+        replaying_backlog.set(True)
+        outbound_priority.set(PRIO_NOTIFY)
+        for u in updates:
+            try:
+                await self._app.process_update(u)
+            except Exception:
+                self.log.exception(f"回放积压更新 {u.update_id} 失败")
+            self.replayed += 1
+            self._mark_done(u.update_id)
+
+    def _submit(self, key: Optional[int], updates: List[Update]) -> asyncio.Task:
+        task = self.tenant.update_lanes.submit(key, self._replay(updates))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    def _mark_done(self, update_id: int):
+        self._done.add(update_id)
+        watermark = None
+        while self._order and self._order[0] in self._done:
+            watermark = self._order.popleft()
+            self._done.discard(watermark)
+        if watermark is not None:
+            self.record(watermark)
+
+    def release(self, key: Optional[int]):
+        """这个车道有实时更新到达：把它剩下的积压作为一个任务排在实时更新之前，逐条处理"""
+        ids = self._by_lane.pop(key, None)
+        if not ids:
+            return
+        updates = [self._pending.pop(uid)[1] for uid in ids if uid in self._pending]
+        if updates:
+            self._submit(key, updates)
+
+    async def _feed(self):
+        bucket = TokenBucket(self.rate)
+        try:
+            for uid in list(self._pending):
+                item = self._pending.get(uid)
+                if item is None:
+                    continue  # 已随该用户的实时更新放行
+                key = item[0]
+                # 每条车道最多一条在途，积压不会把车道撑到 UPDATE_LANE_LIMIT、挤掉实时更新
+                prev = self._inflight.get(key)
+                if prev is not None and not prev.done():
+                    await asyncio.wait({prev})
+                await bucket.acquire()
+                item = self._pending.pop(uid, None)
+                if item is None:
+                    continue
+                self._inflight[key] = self._submit(key, [item[1]])
+            while self._tasks:  # 等待期间可能又有用户的剩余积压被放行
+                await asyncio.gather(*list(self._tasks), return_exceptions=True)
+            self.log.info(f"积压回放完成：处理 {self.replayed} 条，合并掉 {self.coalesced} 条")
+        finally:
+            self.active = False
+            self._by_lane.clear()
+            self._inflight.clear()
 
-    # Try to resolve admin usernames to numeric ids on startup
+    async def stop(self):
+        if self._feeder is not None:
+            self._feeder.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._feeder
+            self._feeder = None
+        if self._tasks:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
+        await super().stop()
+
+    def stats_text(self) -> str:
+        state = f"回放中，剩余 {len(self._pending)} 条" if self.active else "空闲"
+        return f"积压回放：{state}；已回放 {self.replayed} 条，合并掉 {self.coalesced} 条"
+
+# ----------------- SHARDED WORKERS -----------------
+# WORKERS>1 时：主进程只负责 getUpdates，按用户 id 把更新分给固定的 worker 进程，
+# 同一用户的更新始终由同一个 worker 按顺序处理；状态经 STATE_BACKEND 在进程间共享
+POLL_TIMEOUT = 10  # seconds
+
+class ShardDispatcher:
+    """把更新映射到“它作用于哪个用户”：管理员对某个用户的操作（按钮、带 user_id 的命令、
+    回复转发来的消息）要和该用户自己的消息落在同一个 worker 上"""
+
+    def __init__(self, backend: StateBackend, workers: int, admins: List[str], admins_file: AdminsFile):
+        self.backend = backend
+        self.workers = workers
+        self.admins_file = admins_file
+        self.admin_usernames: Set[str] = {u.lower() for u in admins}
+        self.admin_ids: Set[int] = set()
+        self.dispatched = [0] * workers
+
+    def refresh_admins(self):
+        names = self.admins_file.read()
+        if names is not None:
+            self.admin_usernames = {u.lower() for u in names}
+        self.admin_ids = {uid for _, uid in self.backend.items("admin_ids")}
+
+    def _is_admin(self, sender: dict) -> bool:
+        return sender.get("id") in self.admin_ids or (sender.get("username") or "").lower() in self.admin_usernames
+
+    def shard_key(self, data: dict) -> int:
+        cq = data.get("callback_query")
+        if cq:
+            sender = cq["from"]
+            payload = cq.get("data") or ""
+            if payload.startswith(TARGET_CALLBACKS) and self._is_admin(sender):
+                try:
+                    return int(payload.split(":")[1])
+                except (ValueError, IndexError):
+                    pass
+            return sender["id"]
+        msg = data.get("message") or data.get("edited_message")
+        if msg:
+            sender = msg.get("from") or msg["chat"]
+            if not self._is_admin(sender):
+                return sender["id"]
+            parts = (msg.get("text") or "").split()
+            if parts and parts[0].startswith("/") and parts[0][1:].split("@")[0] in TARGET_COMMANDS:
+                if len(parts) > 1 and parts[1].lstrip("-").isdigit():
+                    return int(parts[1])
+            reply = msg.get("reply_to_message")
+            if reply:
+                uid = self.backend.get("admin_msg_map", (msg["chat"]["id"], reply["message_id"]))
+                if uid is not None:
+                    return uid
+            return sender["id"]
+        for value in data.values():
+            if isinstance(value, dict) and isinstance(value.get("from"), dict):
+                return value["from"]["id"]
+        return 0
+
+    def shard_of(self, data: dict) -> int:
+        shard = self.shard_key(data) % self.workers
+        self.dispatched[shard] += 1
+        return shard
+
+def _worker_main(index: int, queue):
+    """worker 子进程入口（spawn）：Ctrl+C 交给调度进程处理，收到 None 后处理完剩余更新再退出"""
+    global WORKER_INDEX, METRICS_PORT
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    WORKER_INDEX = index
+    if METRICS_PORT:
+        METRICS_PORT += index
+    db = Database(DB_PATH)
+    tenant = Tenant.from_env(db)
+    tenant.init_db()
+    asyncio.run(_run_worker(tenant.build_application(updater=False), queue))
+    db.close()
+
+async def _run_worker(app, queue):
+    await app.initialize()
+    await app.post_init(app)
+    await app.start()
+    logger.info(f"worker {WORKER_INDEX + 1}/{WORKERS} 已启动")
     try:
-        resolved = app.run_sync(resolve_admin_usernames_to_ids:=lambda app=app: None)  # placeholder to satisfy typing (we'll run proper coro below)
-    except Exception:
-        resolved = None
-
-    async def _startup_resolve():
-        nonlocal numeric_admin_ids
-        res = await resolve_admin_usernames_to_ids(app)
-        numeric_admin_ids.update(res)
-
-    # schedule startup resolution before polling
-    app.job_queue.run_once(lambda ctx: _startup_resolve(), when=0)
-
-    # handlers
-    app.add_handler(CommandHandler("start", start_cmd))
-    app.add_handler(CommandHandler("help", help_cmd))
-    app.add_handler(CommandHandler("register_admin", register_admin_cmd))
-    app.add_handler(CommandHandler("connect", connect_cmd))
-    app.add_handler(CommandHandler("end", end_cmd))
-    app.add_handler(CommandHandler("ban", ban_cmd))
-    app.add_handler(CommandHandler("unban", unban_cmd))
-    app.add_handler(CommandHandler("list", list_cmd))
-    app.add_handler(CommandHandler("send", send_cmd))
-    app.add_handler(CommandHandler("broadcast", broadcast_cmd))
-
-    app.add_handler(CallbackQueryHandler(callback_query_handler))
-    app.add_handler(MessageHandler(filters.ALL & (~filters.COMMAND), message_relay_handler))
-
-    logger.info("Bot starting (polling)...")
-    app.run_polling()
+        while True:
+            data = await asyncio.to_thread(queue.get)
+            if data is None:
+                break
+            await app.update_queue.put(Update.de_json(data, app.bot))
+    finally:
+        await app.stop()
+        await app.post_stop(app)
+        await app.shutdown()
+        await app.post_shutdown(app)
+
+async def _dispatch_updates(queues: list):
+    db = Database(DB_PATH)
+    backend = make_state_backend(db, DB_TABLE_PREFIX)
+    backend.init()
+    dispatcher = ShardDispatcher(backend, len(queues), ADMIN_USERNAMES, AdminsFile(ADMINS_FILE))
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    kwargs = {"base_url": BOT_API_BASE_URL} if BOT_API_BASE_URL else {}
+    bot = Bot(BOT_TOKEN, request=HTTPXRequest(**http_request_kwargs("poll", 1)), **kwargs)
+    offset = None
+    async with bot:
+        await bot.delete_webhook()
+        while not stop.is_set():
+            dispatcher.refresh_admins()
+            poll = asyncio.ensure_future(bot.get_updates(offset=offset, timeout=POLL_TIMEOUT, allowed_updates=Update.ALL_TYPES))
+            waiter = asyncio.ensure_future(stop.wait())
+            await asyncio.wait({poll, waiter}, return_when=asyncio.FIRST_COMPLETED)
+            waiter.cancel()
+            if not poll.done():
+                poll.cancel()
+                break
+            try:
+                updates = poll.result()
+            except TelegramError:
+                logger.exception("getUpdates 失败，稍后重试")
+                await asyncio.sleep(1)
+                continue
+            for u in updates:
+                data = u.to_dict()
+                queues[dispatcher.shard_of(data)].put(data)
+                offset = u.update_id + 1
+        if offset is not None:
+            # 确认已分发的更新，避免重启后重复投递
+            await bot.get_updates(offset=offset, timeout=0, limit=1)
+    backend.close()
+    db.close()
+    logger.info("分片分发统计：" + ", ".join(f"worker{i + 1}={n}" for i, n in enumerate(dispatcher.dispatched)))
+
+def run_sharded(workers: int):
+    ctx = multiprocessing.get_context("spawn")
+    queues = [ctx.Queue() for _ in range(workers)]
+    procs = [ctx.Process(target=_worker_main, args=(i, q), name=f"bot-worker-{i + 1}") for i, q in enumerate(queues)]
+    for p in procs:
+        p.start()
+    logger.info(f"Bot starting (polling, {workers} workers)...")
+    try:
+        asyncio.run(_dispatch_updates(queues))
+    finally:
+        for q in queues:
+            q.put(None)
+        for p in procs:
+            p.join()
+
+# ----------------- MULTI-TENANT -----------------
+# TENANTS_FILE 指定时：一个进程、一个事件循环里跑多个 bot。每个租户是一个 Tenant
+# （自己的管理员、封禁、会话、限流、出站队列和指标），SQLite 表名带 "<租户名>_" 前缀，
+# Redis 键前缀为 "REDIS_PREFIX:<租户名>"；HTTP 连接池和 SQLite 连接（Database）由宿主共享。
+# 配置文件格式：
+#   {"tenants": [{"name": "brand_a", "token": "123:ABC", "admins": ["alice"],
+#                 "env": {"OUTBOUND_RATE": "20"}}]}
+# env 里可以覆盖 TENANT_SETTINGS 中的配置项，未写的沿用进程环境变量
+TENANT_NAME_RE = re.compile(r"[A-Za-z0-9_]{1,32}")
+
+def load_tenant_specs(path: str) -> List[dict]:
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    specs = data.get("tenants", []) if isinstance(data, dict) else data
+    seen: Set[str] = set()
+    for spec in specs:
+        name = spec.get("name", "")
+        if not TENANT_NAME_RE.fullmatch(name) or name in seen:
+            raise ValueError(f"租户名无效或重复: {name!r}（只能用字母、数字、下划线）")
+        if not spec.get("token"):
+            raise ValueError(f"租户 {name} 缺少 token")
+        seen.add(name)
+    if not specs:
+        raise ValueError(f"{path} 里没有租户")
+    return specs
+
+async def _start_tenant(app):
+    await app.initialize()
+    await app.post_init(app)
+    await app.updater.start_polling()
+    await app.start()
+
+async def _stop_tenant(app):
+    if app.updater.running:
+        await app.updater.stop()
+    if app.running:
+        await app.stop()
+    await app.post_stop(app)
+    await app.shutdown()
+    await app.post_shutdown(app)
+
+async def _run_tenants(tenants: List[Tenant], transports: Tuple[ShardedPoolTransport, ShardedPoolTransport], db: Database):
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    # 各租户的指标在构造时已带 tenant 标签附加到进程的注册表
+    metrics.gauge("bot_tenants", "Tenants running in this process", lambda: len(tenants))
+    server = await start_metrics_server()
+
+    results = await asyncio.gather(*(_start_tenant(t.app) for t in tenants), return_exceptions=True)
+    for t, result in zip(tenants, results):
+        if isinstance(result, Exception):
+            t.log.error(f"启动失败: {result!r}")
+    logger.info(f"{sum(not isinstance(r, Exception) for r in results)}/{len(tenants)} 个租户已启动")
+    try:
+        await stop.wait()
+    finally:
+        results = await asyncio.gather(*(_stop_tenant(t.app) for t in tenants), return_exceptions=True)
+        for t, result in zip(tenants, results):
+            if isinstance(result, Exception):
+                t.log.error(f"停止时出错: {result!r}")
+        if server is not None:
+            server.close()
+        # 租户关闭的只是各自的 SharedTransport 包装，连接池在这里统一关闭
+        for transport in transports:
+            await transport.aclose()
+        db.close()
+
+def run_tenants(path: str):
+    specs = load_tenant_specs(path)
+    # 所有租户共用一个 SQLite 连接和写锁：同一时刻只有一个写事务
+    db = Database(DB_PATH)
+    # 宿主持有两个连接池：发送请求共用一个；各租户的 getUpdates 长轮询各占一条连接，单独一个池，
+    # 避免长轮询占满发送用的连接
+    transports = (http_transport("send", HTTP_POOL_SIZE), http_transport("poll", len(specs)))
+    tenants = [Tenant.from_spec(spec, db) for spec in specs]
+    for t in tenants:
+        t.init_db()
+        t.build_application(transports=transports)
+    logger.info(f"Bot starting (polling, {len(tenants)} tenants)...")
+    asyncio.run(_run_tenants(tenants, transports, db))
+
+def main():
+    if TENANTS_FILE:
+        if BOT_MODE == "webhook":
+            raise SystemExit("多租户模式目前只支持 polling")
+        if WORKERS > 1:
+            raise SystemExit("多租户模式不支持 WORKERS>1")
+        run_tenants(TENANTS_FILE)
+        return
+    if WORKERS > 1:
+        if BOT_MODE == "webhook":
+            raise SystemExit("WORKERS>1 目前只支持 polling 模式")
+        run_sharded(WORKERS)
+        return
+    if BOT_MODE == "webhook" and not WEBHOOK_URL:
+        # 不设置时 PTB 会拿监听地址拼出 https://0.0.0.0:8443/...，setWebhook 运行时才失败
+        raise SystemExit("webhook 模式必须设置 WEBHOOK_URL（Telegram 访问的公网地址）")
+    db = Database(DB_PATH)
+    tenant = Tenant.from_env(db)
+    tenant.init_db()
+    app = tenant.build_application()
+
+    if BOT_MODE == "webhook":
+        logger.info(f"Bot starting (webhook on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{WEBHOOK_PATH})...")
+        # 未配置证书时以纯 HTTP 监听，由前置 HTTP 服务做 TLS 终止
+        app.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET or None,
+            cert=WEBHOOK_CERT or None,
+            key=WEBHOOK_KEY or None,
+        )
+    else:
+        logger.info("Bot starting (polling)...")
+        app.run_polling()
+    db.close()
 
 if __name__ == "__main__":
     main()